@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compares the memory held by run_queries results for a generated pipeline when
+keeping full QueryJob objects versus compact JobRecords.
+
+    python benchmarks/job_record_memory.py --steps 10000
+"""
+
+import argparse
+import gc
+import tracemalloc
+
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import bigquery
+
+from ox_bqpipeline.job_record import JobRecord
+
+
+def job_resource(i, query_bytes):
+    """
+    Builds a QueryJob API resource shaped like the ones returned by
+    jobs.get for a finished query with a destination table.
+    """
+    destination = {'projectId': 'project', 'datasetId': 'dataset',
+                   'tableId': 'step_{:05d}'.format(i)}
+    return {
+        'jobReference': {'projectId': 'project', 'location': 'US',
+                         'jobId': 'pipeline-{:032x}'.format(i)},
+        'configuration': {'query': {
+            'query': 'SELECT * FROM step_{} -- '.format(i) + 'x' * query_bytes,
+            'destinationTable': destination,
+            'defaultDataset': {'projectId': 'project',
+                               'datasetId': 'dataset'},
+            'createDisposition': 'CREATE_IF_NEEDED',
+            'writeDisposition': 'WRITE_TRUNCATE',
+            'priority': 'BATCH',
+            'useLegacySql': False,
+        }},
+        'status': {'state': 'DONE'},
+        'statistics': {
+            'creationTime': '1562000000000',
+            'startTime': '1562000001000',
+            'endTime': '1562000009000',
+            'totalBytesProcessed': '1048576',
+            'query': {
+                'totalBytesProcessed': '1048576',
+                'totalBytesBilled': '10485760',
+                'totalSlotMs': '4200',
+                'statementType': 'SELECT',
+                'queryPlan': [{
+                    'name': 'S0{}: Stage'.format(stage),
+                    'id': str(stage),
+                    'recordsRead': '1000',
+                    'recordsWritten': '1000',
+                    'steps': [{'kind': 'READ',
+                               'substeps': ['$1:a, $2:b', 'FROM step']}],
+                } for stage in range(4)],
+            },
+        },
+    }
+
+
+def measure(steps, query_bytes, compact):
+    client = bigquery.Client(project='project',
+                             credentials=AnonymousCredentials())
+    gc.collect()
+    tracemalloc.start()
+    jobs = []
+    for i in range(steps):
+        job = bigquery.QueryJob.from_api_repr(job_resource(i, query_bytes),
+                                              client)
+        if compact:
+            job = JobRecord.from_job(job)
+        jobs.append(job)
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--steps', type=int, default=10000)
+    parser.add_argument('--query_bytes', type=int, default=4096,
+                        help='Length of each generated query text.')
+    args = parser.parse_args()
+
+    full = measure(args.steps, args.query_bytes, compact=False)
+    compact = measure(args.steps, args.query_bytes, compact=True)
+    mib = 1024.0 ** 2
+    print('steps={} query_bytes={}'.format(args.steps, args.query_bytes))
+    print('QueryJob:  {:8.1f} MiB ({:6.0f} bytes/step)'.format(
+        full / mib, full / float(args.steps)))
+    print('JobRecord: {:8.1f} MiB ({:6.0f} bytes/step)'.format(
+        compact / mib, compact / float(args.steps)))
+    print('ratio:     {:8.1f}x'.format(full / float(compact)))
+
+
+if __name__ == '__main__':
+    main()
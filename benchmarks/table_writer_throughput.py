@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures TableWriter rows/second against a FakeBackend that simulates the
+latency of each insertAll or load request.
+
+    python benchmarks/table_writer_throughput.py --rows 1000000 --latency 0.05
+"""
+
+import argparse
+
+from ox_bqpipeline.table_writer import AT_LEAST_ONCE, EXACTLY_ONCE, \
+    FakeBackend, TableWriter
+
+
+def generate(count):
+    for i in range(count):
+        yield {'id': i, 'name': 'row-{}'.format(i), 'score': i * 0.5}
+
+
+def measure(count, mode, latency, batch_size, max_in_flight):
+    backend = FakeBackend(latency=latency, keep_rows=False)
+    with TableWriter(backend, 'project.dataset.table', mode=mode,
+                     batch_size=batch_size,
+                     max_in_flight=max_in_flight) as writer:
+        for row in generate(count):
+            writer.write(row)
+    assert backend.row_count == count
+    return writer.rows_per_second(), backend.calls
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Simulated seconds per request.')
+    parser.add_argument('--batch_size', type=int, default=500)
+    parser.add_argument('--max_in_flight', type=int, default=4)
+    args = parser.parse_args()
+
+    print('rows={} latency={}s batch_size={}'.format(
+        args.rows, args.latency, args.batch_size))
+    for mode in (AT_LEAST_ONCE, EXACTLY_ONCE):
+        rate, calls = measure(args.rows, mode, args.latency, args.batch_size,
+                              args.max_in_flight)
+        print('{:14s} {:10.0f} rows/s  {:6d} requests'.format(mode, rate,
+                                                               calls))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+asyncio flavour of BQPipeline. Requires Python 3.7 or later.
+
+google-cloud-bigquery only ships a blocking HTTP transport, so each API call
+(job insert, reload, delete) runs on the event loop's executor. Waiting for a
+job is done on the event loop with asyncio.sleep between reloads, so a running
+job does not occupy a thread and thousands of pipelines can wait concurrently
+with a small, bounded thread pool.
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import logging
+
+from ox_bqpipeline.bqpipeline import BQPipeline
+from ox_bqpipeline.job_record import JobRecord
+
+
+def async_exception_logger(func):
+    """
+    A decorator that wraps the passed in coroutine function and logs
+    exceptions should one occur
+    """
+    logger = logging.getLogger(__name__)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await func(*args, **kwargs)
+        except:
+            # log the exception
+            err = "There was an exception in {}: ".format(func.__name__)
+            err += func.__name__
+            logger.exception(err)
+            raise
+    return wrapper
+
+
+class AsyncBQPipeline(BQPipeline):
+    """
+    BQPipeline with awaitable run_query, run_queries, copy_table,
+    delete_table(s) and GCS export methods. Table resolution, job
+    configuration, query parameters and templating are inherited unchanged.
+    run_query and run_queries take the arguments of their BQPipeline
+    counterparts and raise ValueError for the ones not supported here, so
+    they are never passed to templates by mistake.
+    """
+
+    def __init__(self, job_name, poll_interval=1.0, max_poll_interval=10.0,
+                 executor=None, **kwargs):
+        """
+        :param job_name: used as job name prefix
+        :param poll_interval: initial seconds between job status checks
+        :param max_poll_interval: upper bound of the backed off interval
+        :param executor: (optional) concurrent.futures.Executor for blocking
+            API calls, defaults to the event loop's default executor
+        :param kwargs: BQPipeline arguments
+        """
+        super(AsyncBQPipeline, self).__init__(job_name, **kwargs)
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.executor = executor
+
+    async def _call(self, func, *args, **kwargs):
+        """
+        Runs a blocking function on the executor
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs))
+
+    async def wait_for_job(self, job, timeout=None):
+        """
+        Waits for a job to complete without blocking the event loop
+        :param job: bigquery.job.QueryJob, CopyJob or ExtractJob
+        :param timeout: time in seconds to wait for job to complete
+        :return: the job
+        :raises: concurrent.futures.TimeoutError, like job.result, when the
+            job does not complete in time; the job's error if it failed
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        interval = self.poll_interval
+        while True:
+            await self._call(job.reload)
+            if job.state == 'DONE':
+                break
+            if deadline is not None and loop.time() + interval > deadline:
+                raise concurrent.futures.TimeoutError(
+                    'Job {} did not complete within {}s'.format(job.job_id,
+                                                                timeout))
+            await asyncio.sleep(interval)
+            interval = min(interval * 1.5, self.max_poll_interval)
+        if job.error_result is not None:
+            # result() raises the job's error with the matching exception
+            # type and returns immediately since the job is done.
+            await self._call(job.result)
+        return job
+
+    @async_exception_logger
+    async def run_query(self, query_details, batch=False, wait=True,
+                        create=True, overwrite=True, append=False,
+                        timeout=None, gcs_export_format='CSV', scheduler=None,
+                        intermediate=False, query=None, **kwargs):
+        """
+        Executes a SQL query from a Jinja2 template file
+        :param query_details: path to sql file or tuple of (path to sql file,
+            destination tablespec or GCS path[, query parameters])
+        :param batch: run query with batch priority
+        :param wait: wait for job to complete before returning
+        :param create: if False, destination table must already exist
+        :param overwrite: if False, destination table must not exist
+        :param timeout: time in seconds to wait for job to complete
+        :param gcs_export_format: CSV, AVRO, or JSON.
+        :param scheduler: not supported
+        :param intermediate: track the destination table as intermediate:
+            it expires after intermediate_ttl and is dropped by
+            drop_intermediate_tables
+        :param query: (optional) SQL already rendered from the template,
+            e.g. by prerender
+        :param kwargs: replacements for Jinja2 template
+        :return: bigquery.job.QueryJob
+        """
+        if scheduler is not None:
+            raise ValueError('scheduler is not supported by AsyncBQPipeline')
+        sql_path, destination, query_params, is_gcs_dest = \
+            self.get_query_details(query_details)
+        intermediate = intermediate and destination is not None \
+            and not is_gcs_dest
+        if intermediate:
+            # Tracked before submission so a failed run still drops it.
+            self.mark_intermediate(destination)
+        if query is None:
+            # Reading and rendering the template blocks, keep it off the loop.
+            query = await self._call(self.render_query, sql_path, **kwargs)
+        job = await self._call(self.submit_query, query,
+                               destination=destination, batch=batch,
+                               create=create, overwrite=overwrite,
+                               append=append, query_params=query_params)
+        self.logger.info('Executing query %s %s', sql_path, job.job_id)
+        if wait:
+            await self.wait_for_job(job, timeout=timeout)
+            job = await self._call(self.refresh_job, job)
+            self.logger.info('Finished query %s %s', sql_path, job.job_id)
+            await self._call(self.record_plan, sql_path, job)
+
+        if destination and not is_gcs_dest:
+            self.metadata_cache.invalidate(destination)
+        if intermediate and wait:
+            await self._call(self.expire_intermediate, destination)
+
+        if is_gcs_dest:
+            if gcs_export_format == 'CSV':
+                await self.export_csv_to_gcs(job.destination, destination,
+                                             delimiter=',', header=True)
+            elif gcs_export_format == 'JSON':
+                await self.export_json_to_gcs(job.destination, destination)
+            elif gcs_export_format == 'AVRO':
+                await self.export_avro_to_gcs(job.destination, destination)
+
+        return job
+
+    async def run_queries(self, query_paths, batch=True, wait=True,
+                          create=True, overwrite=True, append=False,
+                          timeout=20*60, deadline=None, step_estimate=10*60,
+                          poll_interval=5, script=False, script_max_steps=50,
+                          compact=False, parallel_locations=True,
+                          concurrency=None, intermediate=(), cleanup=True,
+                          prerender=False, prerender_processes=None,
+                          check_tables=True, prerender_strict=False,
+                          **kwargs):
+        """
+        Runs queries one after the other, like BQPipeline.run_queries
+        :param query_paths: List[Union[str,Tuple[str,str]]] path to sql file or
+                tuple of (path, destination tablespec)
+        :param batch: run query with batch priority
+        :param wait: wait for job to complete before returning
+        :param create: if False, destination table must already exist
+        :param overwrite: if False, destination table must not exist
+        :param timeout: time in seconds to wait for job to complete
+        :param deadline: not supported
+        :param step_estimate: unused without deadline
+        :param poll_interval: unused without deadline
+        :param script: not supported
+        :param script_max_steps: unused without script
+        :param compact: return job_record.JobRecord instead of
+            bigquery.job.QueryJob
+        :param parallel_locations: unused, steps always run in order
+        :param concurrency: not supported, run several pipelines with
+            asyncio.gather instead
+        :param intermediate: destination tablespecs that only feed later
+            steps. They expire after intermediate_ttl and are tracked for
+            drop_intermediate_tables.
+        :param cleanup: drop the intermediate tables when the steps finish,
+            including when a step fails. Ignored without wait.
+        :param prerender: render every template and check query parameters
+            and referenced tables before submitting the first job
+        :param prerender_processes: (optional) worker processes rendering
+            templates in parallel; kwargs must be picklable
+        :param check_tables: with prerender, check that tables read by each
+            step exist or are written by an earlier step
+        :param prerender_strict: with prerender, report undefined template
+            variables as problems
+        :param kwargs: replacements for Jinja2 template
+        :returns: list<bigquery.job.QueryJob>
+        """
+        for name, value in (('deadline', deadline is not None),
+                            ('script', script),
+                            ('concurrency', concurrency is not None)):
+            if value:
+                raise ValueError('{} is not supported by AsyncBQPipeline'
+                                 .format(name))
+        intermediate = set(self.mark_intermediate(table)
+                           for table in intermediate)
+        try:
+            rendered = {}
+            if prerender:
+                rendered = await self._call(self.prerender, query_paths,
+                                            processes=prerender_processes,
+                                            check_tables=check_tables,
+                                            strict=prerender_strict,
+                                            **kwargs)
+            jobs = []
+            for path in query_paths:
+                sql_path, destination = self.get_query_details(path)[:2]
+                job = await self.run_query(
+                    path, batch=batch, wait=wait, create=create,
+                    overwrite=overwrite, append=append, timeout=timeout,
+                    intermediate=destination in intermediate,
+                    query=rendered.get(sql_path), **kwargs)
+                if compact:
+                    job = JobRecord.from_job(job)
+                jobs.append(job)
+            return jobs
+        finally:
+            # Without wait the steps may still be running.
+            if cleanup and wait and intermediate:
+                await self._call(self.drop_intermediate_tables,
+                                 list(intermediate))
+
+    @async_exception_logger
+    async def copy_table(self, src, dest, wait=True, overwrite=True,
+                         timeout=None):
+        """
+        :param src: tablespec 'project.dataset.table'
+        :param dest: tablespec 'project.dataset.table'
+        :param wait: wait until job completes
+        :param overwrite: overwrite destination table
+        :param timeout: time in seconds to wait for operation to complete
+        :return: bigquery.job.CopyJob
+        """
+        src = self.resolve_table_spec(src)
+        dest = self.resolve_table_spec(dest)
+        job = await self._call(self.start_copy_table, src, dest,
+                               overwrite=overwrite)
+        if wait:
+            await self.wait_for_job(job, timeout=timeout)
+            self.logger.info('Finished copying table `%s` to `%s` %s', src,
+                             dest, job.job_id)
+            job = await self._call(self.refresh_job, job)
+            self.metadata_cache.invalidate(dest)
+        return job
+
+    async def delete_table(self, table):
+        """
+        Deletes a table
+        :param table: table spec `project.dataset.table`
+        """
+        await self._call(super(AsyncBQPipeline, self).delete_table, table)
+
+    async def delete_tables(self, tables):
+        """
+        Deletes multiple tables concurrently
+        :param tables: List[str] of table spec `project.dataset.table`
+        """
+        await asyncio.gather(*[self.delete_table(table) for table in tables])
+
+    async def _export(self, start, table, gcs_path, timeout=None, **kwargs):
+        job = await self._call(start, table, gcs_path, **kwargs)
+        await self.wait_for_job(job, timeout=timeout)
+        self.logger.info('Finished Extract to GCS. jobId: %s', job.job_id)
+        return job
+
+    @async_exception_logger
+    async def export_csv_to_gcs(self, table, gcs_path, delimiter=',',
+                                header=True, wait=True, timeout=None):
+        """
+        Export a table to GCS as CSV.
+        :param table: str of table spec `project.dataset.table`
+        :param gcs_path: str of destination GCS path
+        :param delimiter: str field delimiter for output data.
+        :param header: boolean indicates the output CSV file print the header.
+        :return: bigquery.job.ExtractJob
+        """
+        return await self._export(self.start_csv_export, table, gcs_path,
+                                  timeout=timeout, delimiter=delimiter,
+                                  header=header)
+
+    @async_exception_logger
+    async def export_json_to_gcs(self, table, gcs_path, wait=True,
+                                 timeout=None):
+        """
+        Export a table to GCS as a Newline Delimited JSON file.
+        :param table: str of table spec `project.dataset.table`
+        :param gcs_path: str of destination GCS path
+        :return: bigquery.job.ExtractJob
+        """
+        return await self._export(self.start_json_export, table, gcs_path,
+                                  timeout=timeout)
+
+    @async_exception_logger
+    async def export_avro_to_gcs(self, table, gcs_path, compression='snappy',
+                                 wait=True, timeout=None):
+        """
+        Export a table to GCS as AVRO.
+        :param table: str of table spec `project.dataset.table`
+        :param gcs_path: str of destination GCS path
+        :return: bigquery.job.ExtractJob
+        """
+        return await self._export(self.start_avro_export, table, gcs_path,
+                                  timeout=timeout, compression=compression)
@@ -16,6 +16,9 @@
 
 import argparse
 import codecs
+import collections
+import concurrent.futures
+import contextlib
 import datetime
 import functools
 import getpass
@@ -23,14 +26,34 @@ import json
 import os
 import logging
 import logging.handlers
+import re
 import socket
 import sys
+import threading
 
 from google.cloud import bigquery
 from google.cloud.logging import Client as LoggingClient
 from google.cloud.logging.handlers import CloudLoggingHandler
+from jinja2 import FileSystemLoader
 from jinja2.sandbox import SandboxedEnvironment
 
+from google.api_core.exceptions import NotFound
+from ox_bqpipeline import local_export
+from ox_bqpipeline.concurrency import AdaptiveConcurrency
+from ox_bqpipeline.consolidate import ShardConsolidator
+from ox_bqpipeline.escalation import DeadlineScheduler, summarize_escalations
+from ox_bqpipeline.job_record import JobRecord
+from ox_bqpipeline.metadata_cache import DATASET_METADATA_SQL, TableMetadata, \
+    TableMetadataCache, table_spec_str
+from ox_bqpipeline.plan_history import PlanHistory
+from ox_bqpipeline.prerender import Prerenderer
+from ox_bqpipeline.run_context import PipelineCancelled, PipelineRunContext
+from ox_bqpipeline.scripting import ScriptBatcher
+from ox_bqpipeline.table_compare import TableComparison, build_compare_sql, \
+    common_columns
+from ox_bqpipeline.table_writer import BigQueryBackend, TableWriter
+from ox_bqpipeline.watch import PipelineWatcher
+
 
 BQ_SCALAR_TYPE_MAP = {
     str   : 'STRING',
@@ -45,6 +68,9 @@ BQ_SCALAR_TYPE_MAP = {
 NUMERIC_BOUNDS = {'min': -99999999999999999999999999999.999999999,
                   'max': 99999999999999999999999999999.999999999}
 
+# Backticked `project.dataset.table` references in rendered SQL.
+TABLE_REFERENCE = re.compile(r'`([\w-]+\.\w+\.[\w$*-]+)`')
+
 
 def get_logger(name, fmt='%(asctime)-15s %(levelname)s %(message)s'):
     """
@@ -207,7 +233,13 @@ class BQPipeline():
                  location='US',
                  default_project=None,
                  default_dataset=None,
-                 json_credentials_path=None):
+                 json_credentials_path=None,
+                 metadata_ttl=300,
+                 metadata_cache_size=10000,
+                 auto_location=False,
+                 template_dirs=None,
+                 plan_history=None,
+                 intermediate_ttl=24*60*60):
         """
         :param job_name: used as job name prefix
         :param query_project: project used to submit queries
@@ -218,6 +250,19 @@ class BQPipeline():
             dataset, if default_project is also set
         :param json_credentials_path: (optional) path to service account JSON
             credentials file
+        :param metadata_ttl: seconds table metadata is cached for
+        :param metadata_cache_size: maximum number of tables kept in the
+            metadata cache
+        :param auto_location: route each query, copy and extract to the
+            location of the datasets it touches, using one client per
+            location. `location` is used when no dataset location is known.
+        :param template_dirs: (optional) directories Jinja2 `include`,
+            `import` and `extends` tags are resolved against
+        :param plan_history: (optional) path of a plan_history.PlanHistory
+            file, or a PlanHistory, recording the plan and statistics of
+            every finished query by SQL path
+        :param intermediate_ttl: seconds after which intermediate tables
+            expire if the pipeline never drops them
         """
         self.logger = logging.getLogger(__name__)
         self.job_name = job_name
@@ -228,24 +273,144 @@ class BQPipeline():
         self.json_credentials_path = json_credentials_path
         self.default_dataset = default_dataset
         self.bq = None
-        self.jinja2 = SandboxedEnvironment()
-
-
-    def get_client(self):
+        if template_dirs is not None:
+            self.jinja2 = SandboxedEnvironment(
+                loader=FileSystemLoader(template_dirs))
+        else:
+            self.jinja2 = SandboxedEnvironment()
+        self.escalations = []
+        self.metadata_cache = TableMetadataCache(ttl=metadata_ttl,
+                                                 max_size=metadata_cache_size)
+        self.auto_location = auto_location
+        if isinstance(plan_history, str):
+            plan_history = PlanHistory(plan_history)
+        self.plan_history = plan_history
+        self.clients = {}
+        self.dataset_locations = {}
+        self._clients_lock = threading.Lock()
+        self._prefetch_locks = collections.defaultdict(threading.Lock)
+        self.intermediate_ttl = intermediate_ttl
+        self.intermediate_tables = collections.OrderedDict()
+        self._intermediate_lock = threading.Lock()
+        self.active_run = None
+
+
+    def get_client(self, location=None):
         """
         Initializes bigquery.Client
+        :param location: (optional) location the client submits jobs to.
+            Clients for locations other than the pipeline's are built from
+            the same credentials and project, and cached per location.
         :return bigquery.Client
         """
         if self.bq is None:
-            if self.json_credentials_path is not None:
-                self.bq = bigquery.Client.from_service_account_json(self.json_credentials_path)
-            else:
-                self.bq = bigquery.Client(project=self.query_project, location=self.location)
-
+            self.bq = self.create_client(self.query_project, self.location)
             self.query_project = self.bq.project
             if self.default_project is None:
                 self.default_project = self.bq.project
-        return self.bq
+        if location is None or location == self.location:
+            return self.bq
+        with self._clients_lock:
+            if location not in self.clients:
+                self.clients[location] = self.create_client(self.bq.project,
+                                                            location)
+            return self.clients[location]
+
+    def create_client(self, project, location):
+        """
+        Creates a bigquery.Client from json_credentials_path, or from the
+        application default credentials
+        :param project: project used to submit queries, or None to infer it
+            from the credentials
+        :param location: location the client submits jobs to
+        :return bigquery.Client
+        """
+        if self.json_credentials_path is not None:
+            return bigquery.Client.from_service_account_json(
+                self.json_credentials_path, project=project, location=location)
+        return bigquery.Client(project=project, location=location)
+
+    def get_dataset_location(self, dataset):
+        """
+        Looks up the location of a dataset once and caches it
+        :param dataset: DatasetSpec string or partial DatasetSpec string
+        :return: str location, or None if the dataset does not exist
+        """
+        dataset_spec = self.resolve_dataset_spec(dataset)
+        if dataset_spec not in self.dataset_locations:
+            try:
+                location = self.get_client().get_dataset(dataset_spec).location
+            except NotFound:
+                location = None
+            self.dataset_locations[dataset_spec] = location
+        return self.dataset_locations[dataset_spec]
+
+    def get_table_location(self, table):
+        """
+        :param table: TableSpec string, partial TableSpec or TableReference
+        :return: str location of the table's dataset when auto_location is
+            set, the pipeline's location otherwise
+        """
+        if not self.auto_location or table is None:
+            return self.location
+        table_spec = table_spec_str(self.resolve_table_spec(table))
+        return self.get_dataset_location(table_spec.rsplit('.', 1)[0]) \
+            or self.location
+
+    def get_query_location(self, query, destination=None):
+        """
+        Picks the location to run a query in: the destination table's
+        dataset, else the first backticked table referenced by the query,
+        else the default dataset.
+        :param query: str rendered SQL
+        :param destination: tablespec, TableReference or GCS path
+        :return: str location
+        """
+        if not self.auto_location:
+            return self.location
+        if destination is not None and \
+            not str(destination).startswith('gs://'):
+            return self.get_table_location(destination)
+        tables = TABLE_REFERENCE.findall(query)
+        if tables:
+            return self.get_table_location(tables[0])
+        if self.default_project is not None \
+            and self.default_dataset is not None:
+            return self.get_dataset_location(self.default_dataset) \
+                or self.location
+        return self.location
+
+    def get_step_location(self, query_details, query=None, **kwargs):
+        """
+        :param query_details: run_queries step
+        :param query: (optional) SQL already rendered from the template
+        :param kwargs: replacements for Jinja2 template
+        :return: str location the step's query runs in
+        """
+        sql_path, destination, _, is_gcs_dest = \
+            self.get_query_details(query_details)
+        if destination is not None and not is_gcs_dest:
+            return self.get_table_location(destination)
+        if query is None:
+            query = self.render_query(sql_path, **kwargs)
+        return self.get_query_location(query)
+
+    def get_location_client(self, location):
+        """
+        :param location: location of a job or dataset
+        :return: bigquery.Client for the location when auto_location is set,
+            the pipeline's client otherwise
+        """
+        return self.get_client(location if self.auto_location else None)
+
+    def refresh_job(self, job):
+        """
+        Fetches the latest state of a job
+        :param job: bigquery.job.QueryJob, CopyJob or ExtractJob
+        :return: job of the same type
+        """
+        return self.get_location_client(job.location).get_job(
+            job.job_id, location=job.location)
 
     def infer_project(self):
         """
@@ -288,6 +453,113 @@ class BQPipeline():
                 dataset_id = self.default_project + '.' + dataset
         return dataset_id
 
+    def prefetch_table_metadata(self, dataset):
+        """
+        Caches metadata of every table in a dataset with a single
+        INFORMATION_SCHEMA query
+        :param dataset: DatasetSpec string or partial DatasetSpec string
+        :return: List[TableMetadata]
+        """
+        dataset_spec = self.resolve_dataset_spec(dataset)
+        project, dataset_id = dataset_spec.split('.')
+        if self.auto_location:
+            client = self.get_client(self.get_dataset_location(dataset_spec))
+        else:
+            client = self.get_client()
+        query = DATASET_METADATA_SQL.format(project=project, dataset=dataset_id)
+        job = client.query(query, job_id_prefix=self.job_id_prefix)
+        self.logger.info('Prefetching table metadata of `%s.%s` %s', project,
+                         dataset_id, job.job_id)
+        tables = [TableMetadata.from_row(project, dataset_id, row)
+                  for row in job.result()]
+        for metadata in tables:
+            self.metadata_cache.put(metadata)
+        self.metadata_cache.put_dataset(dataset_spec)
+        return tables
+
+    def get_table_metadata(self, table, prefetch=True):
+        """
+        Returns cached schema, freshness, size and partitioning of a table
+        :param table: TableSpec string, partial TableSpec or TableReference
+        :param prefetch: on a cache miss, fill the cache for the whole
+            dataset instead of fetching just this table
+        :return: TableMetadata or None if the table does not exist
+        """
+        table_spec = table_spec_str(self.resolve_table_spec(table))
+        cached, metadata = self.metadata_cache.lookup(table_spec)
+        if cached:
+            return metadata
+        dataset_spec = table_spec.rsplit('.', 1)[0]
+        if prefetch:
+            # One prefetch per dataset, concurrent callers wait for it.
+            with self._clients_lock:
+                lock = self._prefetch_locks[dataset_spec]
+            with lock:
+                if not self.metadata_cache.has_dataset(dataset_spec):
+                    try:
+                        self.prefetch_table_metadata(dataset_spec)
+                    except NotFound:
+                        self.logger.info('Dataset `%s` not found',
+                                         dataset_spec)
+                        self.metadata_cache.put_dataset(dataset_spec)
+                        self.metadata_cache.put_missing(table_spec)
+                        return None
+            cached, metadata = self.metadata_cache.lookup(table_spec)
+            if cached:
+                return metadata
+        try:
+            metadata = TableMetadata.from_table(
+                self.get_client().get_table(table_spec))
+        except NotFound:
+            self.metadata_cache.put_missing(table_spec)
+            return None
+        self.metadata_cache.put(metadata)
+        return metadata
+
+    def compare_tables(self, a, b, partitioned=True):
+        """
+        Compares two tables with one query computing row counts and
+        order-independent fingerprints per partition and column
+        :param a: tablespec 'project.dataset.table'
+        :param b: tablespec 'project.dataset.table'
+        :param partitioned: compare partition by partition when both tables
+            are partitioned on the same column
+        :return: table_compare.TableComparison
+        :raises: NotFound if either table does not exist
+        """
+        metadata = []
+        for table in (a, b):
+            table_metadata = self.get_table_metadata(table)
+            if table_metadata is None:
+                raise NotFound('Table {} not found'.format(
+                    table_spec_str(self.resolve_table_spec(table))))
+            metadata.append(table_metadata)
+        columns, mismatched = common_columns(*metadata)
+        query = build_compare_sql(metadata[0], metadata[1], columns,
+                                  partitioned=partitioned)
+        client = self.get_client(self.get_query_location(query))
+        rows = client.query(query, job_id_prefix=self.job_id_prefix).result()
+        comparison = TableComparison(metadata[0].table_spec,
+                                     metadata[1].table_spec, columns,
+                                     mismatched, [dict(row) for row in rows])
+        self.logger.info(comparison.summary())
+        return comparison
+
+    def compare_table_pairs(self, pairs, max_workers=8, **kwargs):
+        """
+        Compares many table pairs in parallel
+        :param pairs: List[Tuple[str,str]] of tablespecs
+        :param max_workers: maximum concurrent comparison queries
+        :param kwargs: compare_tables arguments
+        :return: List[table_compare.TableComparison] in the order of pairs
+        """
+        if not pairs:
+            return []
+        with concurrent.futures.ThreadPoolExecutor(
+                min(max_workers, len(pairs))) as pool:
+            return list(pool.map(lambda pair: self.compare_tables(
+                pair[0], pair[1], **kwargs), pairs))
+
     @exception_logger
     def create_dataset(self, dataset, exists_ok=False):
         """
@@ -434,7 +706,8 @@ class BQPipeline():
         if isinstance(query_details, tuple) and len(query_details) > 1:
             sql_path = query_details[0]
             destination = query_details[1]
-            is_gcs_dest = query_details[1].startswith('gs://')
+            is_gcs_dest = destination is not None and \
+                destination.startswith('gs://')
             if not is_gcs_dest:
                 destination = self.resolve_table_spec(query_details[1])
             if len(query_details) == 3:
@@ -443,10 +716,68 @@ class BQPipeline():
             sql_path = query_details
         return sql_path, destination, query_params, is_gcs_dest
 
+    def render_query(self, sql_path, **kwargs):
+        """
+        Renders a Jinja2 templated SQL file
+        :param sql_path: path to sql file
+        :param kwargs: replacements for Jinja2 template
+        :return: str rendered SQL
+        """
+        template_str = read_sql(sql_path)
+        template = self.jinja2.from_string(template_str)
+        return template.render(**kwargs)
+
+    def submit_query(self, query, destination=None, batch=False, create=True,
+                     overwrite=True, append=False, query_params=None):
+        """
+        Submits a rendered SQL query without waiting for it to complete
+        :param query: str SQL query
+        :param destination: tablespec of destination table, or a GCS path
+        :param batch: run query with batch priority
+        :param create: if False, destination table must already exist
+        :param overwrite: if False, destination table must not exist
+        :param append: if True, destination table will be appended to
+        :param query_params: dict|list of named or positional parameters
+        :return: bigquery.job.QueryJob
+        """
+        job_config = self.create_job_config(dest=destination, batch=batch,
+            create=create, overwrite=overwrite, append=append,
+            query_params=query_params)
+        if job_config.destination is not None:
+            self.metadata_cache.invalidate(job_config.destination)
+        client = self.get_client(self.get_query_location(query, destination))
+        return self.track_job(client.query(query,
+                                           job_config=job_config,
+                                           job_id_prefix=self.job_id_prefix))
+
+    def track_job(self, job):
+        """
+        Registers a submitted job with the active run context, if any, so
+        that it can be cancelled with the run
+        :param job: bigquery job
+        :return: the job
+        """
+        if self.active_run is not None:
+            self.active_run.track(job)
+        return job
+
+    def run_context(self, deadline=None, **kwargs):
+        """
+        Context manager for a pipeline run. On an error, SIGINT, SIGTERM or
+        when the deadline passes, every outstanding job submitted inside the
+        context is cancelled concurrently and intermediate tables are
+        dropped. The context's `summary` describes what was cancelled.
+        :param deadline: (optional) seconds the run may take
+        :param kwargs: run_context.PipelineRunContext options
+        :return: run_context.PipelineRunContext
+        """
+        return PipelineRunContext(self, deadline=deadline, **kwargs)
+
     @exception_logger
     def run_query(self, query_details, batch=False, wait=True, create=True,
                   overwrite=True, append=False, timeout=None,
-                  gcs_export_format='CSV', **kwargs):
+                  gcs_export_format='CSV', scheduler=None,
+                  intermediate=False, query=None, **kwargs):
         """
         Executes a SQL query from a Jinja2 template file
         :param path: path to sql file or tuple of (path to sql file, destination tablespec)
@@ -456,28 +787,52 @@ class BQPipeline():
         :param overwrite: if False, destination table must not exist
         :param timeout: time in seconds to wait for job to complete
         :param gcs_export_format: CSV, AVRO, or JSON.
+        :param scheduler: (optional) escalation.DeadlineScheduler that submits
+            and waits on the job
+        :param intermediate: track the destination table as intermediate:
+            it expires after intermediate_ttl and is dropped by
+            drop_intermediate_tables
+        :param query: (optional) SQL already rendered from the template,
+            e.g. by prerender
         :param kwargs: replacements for Jinja2 template
         :return: bigquery.job.QueryJob
         """
         sql_path, destination, query_params, is_gcs_dest = self.get_query_details(
             query_details)
-
-        template_str = read_sql(sql_path)
-        template = self.jinja2.from_string(template_str)
-        query = template.render(**kwargs)
-        client = self.get_client()
-        job_config = self.create_job_config(dest=destination, batch=batch,
-            create=create, overwrite=overwrite, append=append,
-            query_params=query_params)
-
-        job = client.query(query,
-                           job_config=job_config,
-                           job_id_prefix=self.job_id_prefix)
-        self.logger.info('Executing query %s %s', sql_path, job.job_id)
-        if wait:
-            job.result(timeout=timeout)  # wait for job to complete
-            job = client.get_job(job.job_id)
-            self.logger.info('Finished query %s %s', sql_path, job.job_id)
+        intermediate = intermediate and destination is not None \
+            and not is_gcs_dest
+        if intermediate:
+            # Tracked before submission so a failed run still drops it.
+            self.mark_intermediate(destination)
+
+        if query is None:
+            query = self.render_query(sql_path, **kwargs)
+        if scheduler is not None:
+            # The scheduler owns submission and waiting so that it can
+            # resubmit the job with a different priority.
+            job = scheduler.run_step(sql_path, query, destination=destination,
+                                     create=create, overwrite=overwrite,
+                                     append=append, query_params=query_params,
+                                     timeout=timeout)
+            job = self.refresh_job(job)
+            self.record_plan(sql_path, job)
+        else:
+            job = self.submit_query(query, destination=destination,
+                                    batch=batch, create=create,
+                                    overwrite=overwrite, append=append,
+                                    query_params=query_params)
+            self.logger.info('Executing query %s %s', sql_path, job.job_id)
+            if wait:
+                job.result(timeout=timeout)  # wait for job to complete
+                job = self.refresh_job(job)
+                self.logger.info('Finished query %s %s', sql_path, job.job_id)
+                self.record_plan(sql_path, job)
+
+        if destination and not is_gcs_dest:
+            # Metadata fetched while the job was running is stale.
+            self.metadata_cache.invalidate(destination)
+        if intermediate and (wait or scheduler is not None):
+            self.expire_intermediate(destination)
 
         if is_gcs_dest:
             if gcs_export_format == 'CSV':
@@ -490,9 +845,25 @@ class BQPipeline():
 
         return job
 
+    def record_plan(self, sql_path, job):
+        """
+        Adds a finished query job to the plan history, if one is configured
+        :param sql_path: path of the step's SQL template
+        :param job: bigquery.job.QueryJob
+        :return: plan_history.PlanRecord or None
+        """
+        if self.plan_history is None:
+            return None
+        return self.plan_history.record(sql_path, job)
+
     def run_queries(self, query_paths, batch=True, wait=True, create=True,
                     overwrite=True, append=False, timeout=20*60,
-                    **kwargs):
+                    deadline=None, step_estimate=10*60, poll_interval=5,
+                    script=False, script_max_steps=50, compact=False,
+                    parallel_locations=True, concurrency=None,
+                    intermediate=(), cleanup=True, prerender=False,
+                    prerender_processes=None, check_tables=True,
+                    prerender_strict=False, **kwargs):
         """
         :param query_paths: List[Union[str,Tuple[str,str]]] path to sql file or
                 tuple of (path, destination tablespec)
@@ -501,16 +872,272 @@ class BQPipeline():
         :param create: if False, destination table must already exist
         :param overwrite: if False, destination table must not exist
         :param timeout: time in seconds to wait for job to complete
+        :param deadline: (optional) datetime or seconds from now by which the
+            pipeline must finish. When set together with batch, queued BATCH
+            jobs are cancelled and resubmitted as INTERACTIVE once the
+            deadline is at risk. Implies wait.
+        :param step_estimate: seconds assumed per step until a step has
+            completed and its runtime can be observed
+        :param poll_interval: seconds between checks of a queued BATCH job
+        :param script: merge consecutive steps into multi-statement script
+            jobs, expressing destinations and write dispositions as DDL/DML.
+            Implies wait. Steps writing to GCS or using positional parameters
+            run as separate jobs.
+        :param script_max_steps: maximum number of steps per script job
+        :param compact: return job_record.JobRecord instead of
+            bigquery.job.QueryJob to keep memory flat for very large
+            pipelines. Use get_job to fetch a full job on demand.
+        :param parallel_locations: with auto_location, run the steps of each
+            location in their own thread. Steps in different locations cannot
+            read each other's tables, so they are independent; steps within a
+            location keep their order.
+        :param concurrency: (optional) concurrency.AdaptiveConcurrency. The
+            steps are treated as independent and run concurrently, with the
+            number in flight adjusted to observed queue times and
+            concurrency-limit errors.
+        :param intermediate: destination tablespecs that only feed later
+            steps. They expire after intermediate_ttl and are tracked for
+            drop_intermediate_tables.
+        :param cleanup: drop the intermediate tables when the steps finish,
+            including when a step fails. Ignored without wait.
+        :param prerender: render every template and check query parameters
+            and referenced tables before submitting the first job. Raises
+            prerender.PipelineValidationError listing all problems.
+        :param prerender_processes: (optional) worker processes rendering
+            templates in parallel; kwargs must be picklable, and the
+            pipeline's custom Jinja2 filters and globals are not available
+        :param check_tables: with prerender, check that tables read by each
+            step exist or are written by an earlier step
+        :param prerender_strict: with prerender, report undefined template
+            variables as problems
         :param kwargs: replacements for Jinja2 template
-        :returns: list<bigquery.job.QueryJob>
-        """
-        jobs = []
-        for path in query_paths:
-            jobs.append(self.run_query(path, batch=batch, wait=wait,
-                                       create=create, overwrite=overwrite,
-                                       append=append, timeout=timeout,
-                                       **kwargs))
-        return jobs
+        :returns: list<bigquery.job.QueryJob>, in script mode the child job
+            of each step
+        """
+        # Without wait the steps may still be running at the end of the call.
+        with self.intermediate_scope(intermediate,
+                                     cleanup and wait) as intermediate:
+            if concurrency is not None and (script or deadline is not None):
+                raise ValueError('concurrency is not supported with script or '
+                                 'deadline')
+            rendered = {}
+            if prerender:
+                rendered = self.prerender(query_paths,
+                                          processes=prerender_processes,
+                                          check_tables=check_tables,
+                                          strict=prerender_strict, **kwargs)
+            if script:
+                if deadline is not None:
+                    raise ValueError('deadline is not supported with script')
+                batcher = ScriptBatcher(self, batch=batch, create=create,
+                                        overwrite=overwrite, append=append,
+                                        timeout=timeout,
+                                        max_steps=script_max_steps,
+                                        rendered=rendered)
+                jobs = batcher.run(query_paths, **kwargs)
+                for table in intermediate:
+                    self.expire_intermediate(table)
+                if compact:
+                    jobs = [JobRecord.from_job(job) for job in jobs]
+                return jobs
+
+            scheduler = None
+            if deadline is not None and batch:
+                scheduler = DeadlineScheduler(self, deadline,
+                                              steps=len(query_paths),
+                                              step_estimate=step_estimate,
+                                              poll_interval=poll_interval)
+
+            def run_step(path):
+                sql_path, destination = self.get_query_details(path)[:2]
+                job = self.run_query(path, batch=batch, wait=wait,
+                                     create=create, overwrite=overwrite,
+                                     append=append, timeout=timeout,
+                                     scheduler=scheduler,
+                                     intermediate=destination in intermediate,
+                                     query=rendered.get(sql_path), **kwargs)
+                if compact:
+                    # Drop the full job before the next step is submitted.
+                    job = JobRecord.from_job(job)
+                return job
+
+            try:
+                if concurrency is not None:
+                    jobs = concurrency.map(run_step, query_paths)
+                    self.logger.info('Concurrency history: %s',
+                                     concurrency.summary()['history'])
+                elif self.auto_location and parallel_locations \
+                        and scheduler is None:
+                    jobs = self.run_by_location(query_paths, run_step,
+                                                rendered=rendered, **kwargs)
+                else:
+                    jobs = [run_step(path) for path in query_paths]
+            finally:
+                if scheduler is not None:
+                    # Escalations already paid for count even if a step
+                    # failed.
+                    self.escalations.extend(scheduler.escalations)
+                    self.logger.info('Priority escalation summary: %s',
+                                     scheduler.summary())
+            return jobs
+
+    def prerender(self, query_paths, processes=None, check_tables=True,
+                  strict=False, **kwargs):
+        """
+        Renders every step's template, checks query parameters with
+        validate_query_params and referenced tables against the metadata
+        cache, and reports all problems at once
+        :param query_paths: run_queries steps
+        :param processes: (optional) worker processes for rendering
+        :param check_tables: check that tables read by each step exist or
+            are written by an earlier step
+        :param strict: report undefined template variables as problems
+        :param kwargs: replacements for Jinja2 template
+        :return: dict of sql path to rendered SQL
+        :raises: prerender.PipelineValidationError
+        """
+        return Prerenderer(self, processes=processes,
+                           check_tables=check_tables,
+                           table_pattern=TABLE_REFERENCE,
+                           strict=strict).run(query_paths, **kwargs)
+
+    def mark_intermediate(self, table):
+        """
+        Tracks a table as intermediate for this run
+        :param table: table spec `project.dataset.table`
+        :return: str resolved table spec
+        """
+        table = table_spec_str(self.resolve_table_spec(table))
+        with self._intermediate_lock:
+            self.intermediate_tables[table] = True
+        return table
+
+    def expire_intermediate(self, table):
+        """
+        Sets an intermediate table to expire after intermediate_ttl, so it
+        is removed even if the run never gets to drop it
+        :param table: table spec `project.dataset.table`
+        """
+        table = table_spec_str(self.resolve_table_spec(table))
+        expires = datetime.datetime.now(datetime.timezone.utc) + \
+            datetime.timedelta(seconds=self.intermediate_ttl)
+        bq_table = bigquery.Table(table)
+        bq_table.expires = expires
+        try:
+            self.get_client(self.get_table_location(table)).update_table(
+                bq_table, ['expires'])
+        except NotFound:
+            self.logger.warning('Intermediate table `%s` was not created',
+                                table)
+
+    def drop_intermediate_tables(self, tables=None, max_workers=8):
+        """
+        Drops intermediate tables concurrently. Failures are logged, not
+        raised, since this also runs while handling a failed step.
+        :param tables: (optional) tables to drop, defaults to every tracked
+            intermediate table
+        :param max_workers: maximum concurrent delete requests
+        :return: List[str] dropped table specs
+        """
+        with self._intermediate_lock:
+            if tables is None:
+                tables = list(self.intermediate_tables)
+            tables = [table_spec_str(self.resolve_table_spec(t))
+                      for t in tables]
+            for table in tables:
+                self.intermediate_tables.pop(table, None)
+        if not tables:
+            return []
+
+        def drop(table):
+            self.metadata_cache.invalidate(table)
+            self.get_client(self.get_table_location(table)).delete_table(
+                table, not_found_ok=True)
+            return table
+
+        dropped = []
+        with concurrent.futures.ThreadPoolExecutor(
+                min(max_workers, len(tables))) as pool:
+            futures = {pool.submit(drop, table): table for table in tables}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    dropped.append(future.result())
+                except Exception:
+                    self.logger.exception('Failed to drop intermediate table '
+                                          '`%s`', futures[future])
+        self.logger.info('Dropped %d of %d intermediate tables', len(dropped),
+                         len(tables))
+        return dropped
+
+    @contextlib.contextmanager
+    def intermediate_scope(self, tables, cleanup=True):
+        """
+        Marks tables as intermediate and drops them on exit, on success or
+        failure
+        :param tables: table specs
+        :param cleanup: drop the tables on exit
+        :return: context manager yielding the set of resolved table specs
+        """
+        tables = [self.mark_intermediate(table) for table in tables]
+        try:
+            yield set(tables)
+        finally:
+            if cleanup and tables:
+                self.drop_intermediate_tables(tables)
+
+    def run_by_location(self, query_paths, run_step, rendered=None, **kwargs):
+        """
+        Runs the steps of each location sequentially, and different locations
+        in parallel
+        :param query_paths: run_queries steps
+        :param run_step: callable running a single step
+        :param rendered: (optional) dict of sql path to rendered SQL, e.g.
+            from prerender
+        :param kwargs: replacements for Jinja2 template
+        :return: list of run_step results in the order of query_paths
+        """
+        rendered = rendered or {}
+        by_location = collections.OrderedDict()
+        for index, path in enumerate(query_paths):
+            sql_path = self.get_query_details(path)[0]
+            location = self.get_step_location(path,
+                                              query=rendered.get(sql_path),
+                                              **kwargs)
+            by_location.setdefault(location, []).append(index)
+        if len(by_location) < 2:
+            return [run_step(path) for path in query_paths]
+
+        self.logger.info('Running steps in %d locations in parallel: %s',
+                         len(by_location), ', '.join(by_location))
+
+        def run_location(indexes):
+            return [(i, run_step(query_paths[i])) for i in indexes]
+
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(len(by_location)) as pool:
+            futures = [pool.submit(run_location, indexes)
+                       for indexes in by_location.values()]
+            for future in futures:
+                results.update(future.result())
+        return [results[i] for i in range(len(query_paths))]
+
+    def get_job(self, job):
+        """
+        Fetches the complete job behind a JobRecord or job id
+        :param job: job_record.JobRecord or str job id
+        :return: bigquery.job.QueryJob, CopyJob or ExtractJob
+        """
+        if isinstance(job, JobRecord):
+            return job.full_job(self.get_location_client(job.location))
+        return self.get_client().get_job(job)
+
+    def escalation_summary(self):
+        """
+        Summarizes BATCH to INTERACTIVE escalations made by this pipeline
+        :return: dict with escalation count, queued seconds lost, and bytes
+            billed and slot milliseconds of the escalated jobs
+        """
+        return summarize_escalations(self.escalations)
 
     @exception_logger
     def copy_table(self, src, dest, wait=True, overwrite=True, timeout=None):
@@ -524,20 +1151,114 @@ class BQPipeline():
         """
         src = self.resolve_table_spec(src)
         dest = self.resolve_table_spec(dest)
-        job = self.get_client().copy_table(
+        job = self.start_copy_table(src, dest, overwrite=overwrite)
+        if wait:
+            job.result(timeout=timeout)  # wait for job to complete
+            self.logger.info('Finished copying table `%s` to `%s` %s', src,
+                             dest, job.job_id)
+            job = self.refresh_job(job)
+            self.metadata_cache.invalidate(dest)
+        return job
+
+    def start_copy_table(self, src, dest, overwrite=True):
+        """
+        Starts a copy job without waiting
+        :param src: tablespec 'project.dataset.table'
+        :param dest: tablespec 'project.dataset.table'
+        :param overwrite: overwrite destination table
+        :return: bigquery.job.CopyJob
+        """
+        self.metadata_cache.invalidate(dest)
+        job = self.get_client(self.get_table_location(src)).copy_table(
             sources=src,
             destination=dest,
             job_id_prefix=self.job_id_prefix,
             job_config=create_copy_job_config(overwrite=overwrite))
+        self.track_job(job)
         self.logger.info('Copying table `%s` to `%s` %s', src, dest,
                          job.job_id)
-        if wait:
-            job.result(timeout=timeout)  # wait for job to complete
-            self.logger.info('Finished copying table `%s` to `%s` %s', src,
-                             dest, job.job_id)
-            job = self.get_client().get_job(job.job_id)
         return job
 
+    def copy_tables(self, pairs, overwrite=True, timeout=None,
+                    concurrency=None):
+        """
+        Copies many tables concurrently
+        :param pairs: List[Tuple[str,str]] of (src, dest) tablespecs
+        :param overwrite: overwrite destination tables
+        :param timeout: time in seconds to wait for each copy to complete
+        :param concurrency: (optional) concurrency.AdaptiveConcurrency
+            controlling the number of copy jobs in flight
+        :return: List[bigquery.job.CopyJob] in the order of pairs
+        """
+        concurrency = concurrency or AdaptiveConcurrency()
+
+        def copy(pair):
+            src = self.resolve_table_spec(pair[0])
+            dest = self.resolve_table_spec(pair[1])
+            job = self.start_copy_table(src, dest, overwrite=overwrite)
+            job.result(timeout=timeout)
+            self.metadata_cache.invalidate(dest)
+            return self.refresh_job(job)
+
+        jobs = concurrency.map(copy, pairs)
+        self.logger.info('Copied %d tables. Concurrency history: %s',
+                         len(jobs), concurrency.summary()['history'])
+        return jobs
+
+    def table_writer(self, table, backend=None, **kwargs):
+        """
+        Opens a batched writer of Python rows into an existing table
+        :param table: table spec `project.dataset.table`
+        :param backend: (optional) table_writer.FakeBackend or other backend,
+            defaults to the client of the table's location
+        :param kwargs: table_writer.TableWriter options, e.g. mode,
+            batch_size, flush_interval, max_in_flight, run_id
+        :return: table_writer.TableWriter context manager
+        """
+        table = self.resolve_table_spec(table)
+        if backend is None:
+            location = self.get_table_location(table)
+            backend = BigQueryBackend(self.get_client(location), location)
+        return TableWriter(backend, table,
+                           on_close=lambda: self.metadata_cache.invalidate(
+                               table),
+                           **kwargs)
+
+    def consolidate_shards(self, prefix, destination, partition_field=None,
+                           clustering_fields=None, mode=None,
+                           state_file=None, verify=True, delete_shards=False,
+                           concurrency=None):
+        """
+        Migrates date-sharded tables `<prefix>YYYYMMDD` into the partitions of
+        one day-partitioned table, resuming from state_file if given
+        :param prefix: shard prefix, e.g. 'dataset.events_'
+        :param destination: tablespec of the partitioned table, created from
+            the newest shard's schema if missing
+        :param partition_field: (optional) DATE column to partition on, added
+            from the shard date if the shards lack it. Ingestion time
+            partitioning when None.
+        :param clustering_fields: (optional) List[str] clustering columns
+        :param mode: consolidate.COPY (copy jobs, ingestion time
+            partitioning only) or consolidate.QUERY (query jobs)
+        :param state_file: (optional) JSON file recording per-shard progress
+        :param verify: compare row counts of every shard and its partition
+        :param delete_shards: delete shards once verified
+        :param concurrency: (optional) concurrency.AdaptiveConcurrency for
+            the per-shard jobs
+        :return: dict summary with shard, row and throughput counts
+        :raises: consolidate.ConsolidationError if row counts differ
+        """
+        consolidator = ShardConsolidator(
+            self, self.resolve_table_spec(prefix),
+            table_spec_str(self.resolve_table_spec(destination)),
+            partition_field=partition_field,
+            clustering_fields=clustering_fields, mode=mode,
+            state_file=state_file,
+            concurrency=concurrency or AdaptiveConcurrency())
+        summary = consolidator.run(verify=verify, delete_shards=delete_shards)
+        self.logger.info('Consolidation summary: %s', summary)
+        return summary
+
     @exception_logger
     def delete_table(self, table):
         """
@@ -546,6 +1267,7 @@ class BQPipeline():
         """
         table = self.resolve_table_spec(table)
         self.logger.info("Deleting table `%s`", table)
+        self.metadata_cache.invalidate(table)
         self.get_client().delete_table(table)
 
     def delete_tables(self, tables):
@@ -567,6 +1289,18 @@ class BQPipeline():
         :param delimiter: str field delimiter for output data.
         :param header: boolean indicates the output CSV file print the header.
         """
+        return self.start_csv_export(table, gcs_path, delimiter=delimiter,
+                                     header=header)
+
+    def start_csv_export(self, table, gcs_path, delimiter=',', header=True):
+        """
+        Starts an extract job of a table to GCS as CSV without waiting.
+        :param table: str of table spec `project.dataset.table`
+        :param gcs_path: str of destination GCS path
+        :param delimiter: str field delimiter for output data.
+        :param header: boolean indicates the output CSV file print the header.
+        :return: bigquery.job.ExtractJob
+        """
         src = self.resolve_table_spec(table)
         extract_job_config = bigquery.job.ExtractJobConfig(
             compression='NONE',
@@ -578,7 +1312,9 @@ class BQPipeline():
         gcs_path = os.path.join(gcs_path, self.job_name, datetime.datetime.now().strftime("jobRunTime=%Y-%m-%dT%H%M%S"),
                                 self.job_name + "-export-*.csv")
 
-        job = self.get_client().extract_table(src, gcs_path, job_config=extract_job_config)
+        job = self.track_job(
+            self.get_client(self.get_table_location(src)).extract_table(
+                src, gcs_path, job_config=extract_job_config))
         self.logger.info('Extracting table `%s` to `%s` as CSV  %s', table, gcs_path, job.job_id)
         return job
 
@@ -590,6 +1326,16 @@ class BQPipeline():
         :param table: str of table spec `project.dataset.table`
         :param gcs_path: str of destination GCS path
         """
+        return self.start_json_export(table, gcs_path)
+
+    def start_json_export(self, table, gcs_path):
+        """
+        Starts an extract job of a table to GCS as Newline Delimited JSON
+        without waiting.
+        :param table: str of table spec `project.dataset.table`
+        :param gcs_path: str of destination GCS path
+        :return: bigquery.job.ExtractJob
+        """
         src = self.resolve_table_spec(table)
         extract_job_config = bigquery.job.ExtractJobConfig(
             compression='NONE',
@@ -599,7 +1345,9 @@ class BQPipeline():
         gcs_path = os.path.join(gcs_path, self.job_name, datetime.datetime.now().strftime("jobRunTime=%Y%m%d%h%m%s"),
                                 self.job_name + "-export-*.json")
 
-        job = self.get_client().extract_table(src, gcs_path, job_config=extract_job_config)
+        job = self.track_job(
+            self.get_client(self.get_table_location(src)).extract_table(
+                src, gcs_path, job_config=extract_job_config))
         self.logger.info('Extracting table `%s` to `%s` as JSON  %s', table, gcs_path, job.job_id)
         return job
 
@@ -612,6 +1360,16 @@ class BQPipeline():
         :param table: str of table spec `project.dataset.table`
         :param gcs_path: str of destination GCS path
         """
+        return self.start_avro_export(table, gcs_path, compression=compression)
+
+    def start_avro_export(self, table, gcs_path, compression='snappy'):
+        """
+        Starts an extract job of a table to GCS as AVRO without waiting.
+        :param table: str of table spec `project.dataset.table`
+        :param gcs_path: str of destination GCS path
+        :param compression: AVRO codec
+        :return: bigquery.job.ExtractJob
+        """
         src = self.resolve_table_spec(table)
         extract_job_config = bigquery.job.ExtractJobConfig(
             compression=compression,
@@ -621,10 +1379,71 @@ class BQPipeline():
         gcs_path = os.path.join(gcs_path, self.job_name, datetime.datetime.now().strftime("jobRunTime=%Y%m%d%h%m%s"),
                                 self.job_name + "-export-*.avro")
 
-        job = self.get_client().extract_table(src, gcs_path, job_config=extract_job_config)
+        job = self.track_job(
+            self.get_client(self.get_table_location(src)).extract_table(
+                src, gcs_path, job_config=extract_job_config))
         self.logger.info('Extracting table `%s` to `%s` as AVRO  %s', table, gcs_path, job.job_id)
         return job
 
+    def export_tables(self, exports, file_format='CSV', timeout=None,
+                      concurrency=None):
+        """
+        Exports many tables to GCS concurrently
+        :param exports: List[Tuple[str,str]] of (table spec, GCS path)
+        :param file_format: CSV, AVRO, or JSON
+        :param timeout: time in seconds to wait for each export to complete
+        :param concurrency: (optional) concurrency.AdaptiveConcurrency
+            controlling the number of extract jobs in flight
+        :return: List[bigquery.job.ExtractJob] in the order of exports
+        """
+        start = {'CSV': self.start_csv_export,
+                 'JSON': self.start_json_export,
+                 'AVRO': self.start_avro_export}[file_format]
+        concurrency = concurrency or AdaptiveConcurrency()
+
+        def export(table_and_path):
+            job = start(*table_and_path)
+            job.result(timeout=timeout)
+            return self.refresh_job(job)
+
+        jobs = concurrency.map(export, exports)
+        self.logger.info('Exported %d tables. Concurrency history: %s',
+                         len(jobs), concurrency.summary()['history'])
+        return jobs
+
+    @exception_logger
+    def export_to_local(self, table_or_job, directory, streams=4,
+                        file_format='PARQUET', compression='auto',
+                        processes=None, read_service=None):
+        """
+        Export a table or query result to local files over parallel BigQuery
+        Storage Read API streams, one file per stream, and write a
+        manifest.json describing them.
+        :param table_or_job: table spec `project.dataset.table`, or a
+            bigquery.job.QueryJob whose destination is exported
+        :param directory: local directory to write files to
+        :param streams: maximum number of parallel read streams
+        :param file_format: PARQUET or AVRO
+        :param compression: auto (snappy for Parquet, deflate for Avro),
+            another codec, or None
+        :param processes: number of worker processes, defaults to one per
+            stream
+        :param read_service: (optional) local_export.LocalReadService to read
+            from instead of BigQuery
+        :return: dict manifest
+        """
+        if isinstance(table_or_job, bigquery.job.QueryJob):
+            table = table_or_job.destination
+        else:
+            table = self.resolve_table_spec(table_or_job)
+        if read_service is None:
+            read_service = local_export.BigQueryReadService(
+                self.infer_project(), self.json_credentials_path)
+        return local_export.export_to_local(
+            read_service, table_spec_str(table), directory, streams=streams,
+            file_format=file_format, compression=compression,
+            processes=processes, prefix=self.job_name)
+
 
 def main():
     """
@@ -641,19 +1460,65 @@ def main():
     log.addHandler(print_handler)
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('--query_file', dest='query_file', required=True,
+    parser.add_argument('--query_file', dest='query_file', required=False,
                         help="Path to your bigquery sql file.")
+    parser.add_argument('--pipeline_file', dest='pipeline_file', required=False,
+                        help="Path to a JSON list of steps, each a list of "
+                             "[sql path, destination, query params].")
     parser.add_argument('--gcs_destination', dest='gcs_destination', required=False,
                         help="GCS wildcard path to write files.", default=None)
     parser.add_argument('--gcs_export_format', dest='gcs_format', required=False,
                         help="Format for export. CSV | AVRO | JSON", default='CSV')
     parser.add_argument('--query_params', dest='query_params', required=False,
                         help="Query parameters", type=json.loads, default=None)
+    parser.add_argument('--watch', dest='watch', action='store_true',
+                        help="Keep running and re-run the steps affected by "
+                             "changes to the SQL templates.")
+    parser.add_argument('--watch_dir', dest='watch_dir', required=False,
+                        help="Template directory to watch. Defaults to the "
+                             "directory of the first sql file.", default=None)
+    parser.add_argument('--poll_interval', dest='poll_interval', type=float,
+                        help="Seconds between template directory scans.",
+                        default=1.0)
+    parser.add_argument('--deadline', dest='deadline', type=float,
+                        help="Seconds the run may take before every "
+                             "outstanding job is cancelled.", default=None)
     args = parser.parse_args()
 
-    bqp = BQPipeline(job_name)
-    bqp.run_query((args.query_file, args.gcs_destination, args.query_params),
-                  gcs_export_format=args.gcs_format)
+    if args.pipeline_file:
+        with open(args.pipeline_file) as pipeline_file:
+            steps = [tuple(step) if isinstance(step, list) else step
+                     for step in json.load(pipeline_file)]
+    elif args.query_file:
+        steps = [(args.query_file, args.gcs_destination, args.query_params)]
+    else:
+        parser.error('one of --query_file or --pipeline_file is required')
+
+    if args.watch:
+        first = steps[0][0] if isinstance(steps[0], tuple) else steps[0]
+        watch_dir = args.watch_dir or os.path.dirname(os.path.abspath(first))
+        bqp = BQPipeline(job_name, template_dirs=[watch_dir])
+        watcher = PipelineWatcher(
+            bqp, steps, watch_dir, poll_interval=args.poll_interval,
+            run_kwargs={'gcs_export_format': args.gcs_format})
+    else:
+        bqp = BQPipeline(job_name)
+
+    try:
+        with bqp.run_context(deadline=args.deadline) as run:
+            if args.watch:
+                watcher.watch()
+            else:
+                for step in steps:
+                    bqp.run_query(step, gcs_export_format=args.gcs_format)
+    except PipelineCancelled as cancelled:
+        if args.watch and cancelled.reason == 'SIGINT':
+            log.info('Stopped watching %s %s', watch_dir,
+                     json.dumps(cancelled.summary))
+            return
+        log.error('%s %s', cancelled, json.dumps(cancelled.summary))
+        sys.exit(1)
+    log.info('Run summary %s', json.dumps(run.summary))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+AIMD (additive increase, multiplicative decrease) control of the number of
+jobs a pipeline keeps in flight.
+
+Every finished job reports its queue time, from creation to start. While jobs
+start promptly the limit grows by `increase` per limit's worth of jobs; when
+jobs queue longer than `target_queue_seconds`, or BigQuery rejects a job for
+too many concurrent jobs, the limit is multiplied by `decrease`. Rejected
+items are retried once the limit has dropped.
+"""
+
+import concurrent.futures
+import logging
+import time
+
+from google.api_core.exceptions import GoogleAPICallError, TooManyRequests
+
+CONCURRENCY_ERROR_REASONS = ('rateLimitExceeded', 'jobRateLimitExceeded')
+
+
+def is_concurrency_error(error):
+    """
+    :param error: exception raised by a BigQuery call
+    :return: True if BigQuery rejected the job for exceeding concurrency or
+        rate limits
+    """
+    if isinstance(error, TooManyRequests):
+        return True
+    if isinstance(error, GoogleAPICallError):
+        return any(e.get('reason') in CONCURRENCY_ERROR_REASONS
+                   for e in error.errors or [] if isinstance(e, dict))
+    return False
+
+
+def queue_seconds(job):
+    """
+    :param job: finished bigquery job
+    :return: seconds between job creation and start, or None if unknown
+    """
+    created = getattr(job, 'created', None)
+    started = getattr(job, 'started', None)
+    if created is None or started is None:
+        return None
+    return max((started - created).total_seconds(), 0.0)
+
+
+class AdaptiveConcurrency():
+    """
+    Runs independent work items with an AIMD-controlled number in flight.
+    One instance can be reused across calls; the limit carries over.
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=32,
+                 target_queue_seconds=10.0, increase=1.0, decrease=0.5,
+                 max_retries=5, retry_wait=5.0, clock=time.time,
+                 sleep=time.sleep):
+        """
+        :param initial: jobs in flight at start
+        :param minimum: lower bound of the limit
+        :param maximum: upper bound of the limit, and worker threads used
+        :param target_queue_seconds: queue time above which the limit drops
+        :param increase: limit added per limit's worth of prompt jobs
+        :param decrease: factor applied to the limit on congestion
+        :param max_retries: attempts per item after concurrency-limit errors
+        :param retry_wait: seconds to wait before retrying a rejected item
+        """
+        self.logger = logging.getLogger(__name__)
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_queue_seconds = target_queue_seconds
+        self.increase = increase
+        self.decrease = decrease
+        self.max_retries = max_retries
+        self.retry_wait = retry_wait
+        self.clock = clock
+        self.sleep = sleep
+        self.started = clock()
+        self.last_decrease = None
+        self.history = [(0.0, int(self.limit), 'initial')]
+        self.limit_errors = 0
+
+    @property
+    def in_flight_limit(self):
+        return max(self.minimum, min(self.maximum, int(self.limit)))
+
+    def _set_limit(self, limit, reason):
+        before = self.in_flight_limit
+        self.limit = max(float(self.minimum), min(float(self.maximum), limit))
+        after = self.in_flight_limit
+        if after != before:
+            self.history.append((self.clock() - self.started, after, reason))
+            self.logger.info('Concurrency %d -> %d (%s)', before, after,
+                             reason)
+
+    def _congested(self, submitted, reason):
+        # Jobs submitted before the last decrease saw the old limit; reacting
+        # to them again would collapse the limit in one burst of feedback.
+        if self.last_decrease is not None and submitted < self.last_decrease:
+            return
+        self.last_decrease = self.clock()
+        self._set_limit(self.limit * self.decrease, reason)
+
+    def observe(self, result, submitted):
+        """
+        Adjusts the limit from a finished job
+        :param result: the job, or a list of jobs, returned by the work item
+        :param submitted: clock time at which the item was started
+        """
+        jobs = result if isinstance(result, (list, tuple)) else [result]
+        waits = [w for w in (queue_seconds(job) for job in jobs)
+                 if w is not None]
+        if waits and max(waits) > self.target_queue_seconds:
+            self._congested(submitted, 'queued {:.1f}s'.format(max(waits)))
+        else:
+            self._set_limit(self.limit + self.increase / self.limit,
+                            'jobs starting promptly')
+
+    def map(self, func, items):
+        """
+        Calls func on every item, keeping at most the current limit in
+        flight, and retries items rejected with concurrency-limit errors
+        :param func: callable taking an item and returning finished job(s)
+        :param items: work items
+        :return: list of results in the order of items
+        :raises: the first error that is not a concurrency-limit error, or a
+            concurrency-limit error after max_retries attempts
+        """
+        items = list(items)
+        pending = list(range(len(items)))
+        attempts = [0] * len(items)
+        results = {}
+        running = {}
+        with concurrent.futures.ThreadPoolExecutor(self.maximum) as pool:
+            while pending or running:
+                while pending and len(running) < self.in_flight_limit:
+                    index = pending.pop(0)
+                    attempts[index] += 1
+                    future = pool.submit(func, items[index])
+                    running[future] = (index, self.clock())
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    index, submitted = running.pop(future)
+                    try:
+                        results[index] = future.result()
+                    except Exception as error:
+                        if (not is_concurrency_error(error) or
+                                attempts[index] >= self.max_retries):
+                            for other in running:
+                                other.cancel()
+                            raise
+                        self.limit_errors += 1
+                        self._congested(submitted, 'concurrency limit error')
+                        self.logger.warning(
+                            'Retrying item %d after concurrency limit error '
+                            '(attempt %d): %s', index, attempts[index], error)
+                        pending.insert(0, index)
+                        self.sleep(self.retry_wait)
+                        continue
+                    self.observe(results[index], submitted)
+        return [results[i] for i in range(len(items))]
+
+    def summary(self):
+        """
+        :return: dict with the current limit, the limit history as
+            (seconds since start, limit, reason) and concurrency-limit errors
+        """
+        return {'limit': self.in_flight_limit,
+                'limit_errors': self.limit_errors,
+                'history': list(self.history)}
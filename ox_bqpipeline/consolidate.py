@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Consolidates date-sharded tables (`events_20190701`, `events_20190702`, ...)
+into one day-partitioned, optionally clustered table.
+
+Each shard becomes one partition, written with WRITE_TRUNCATE to the
+`table$YYYYMMDD` partition decorator, so re-running a shard replaces its
+partition instead of duplicating it. COPY mode uses free copy jobs and needs
+an ingestion-time partitioned destination; QUERY mode runs `SELECT *` per
+shard and, when the partition column is not part of the shards, derives it
+from the shard date.
+
+Progress is kept in a JSON state file after every shard, so an interrupted
+run resumes with the shards that are not done yet.
+"""
+
+import collections
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from google.cloud import bigquery
+
+COPY = 'COPY'
+QUERY = 'QUERY'
+
+SHARD_DATE = re.compile(r'^\d{8}$')
+
+PARTITION_ROWS_SQL = """
+SELECT partition_id, total_rows
+FROM `{project}.{dataset}.INFORMATION_SCHEMA.PARTITIONS`
+WHERE table_name = '{table}'
+"""
+
+DONE = ('copied', 'verified', 'deleted')
+
+
+class ConsolidationError(Exception):
+    """
+    Raised when consolidated partitions do not match their shards.
+    `mismatches` maps shard date to (shard rows, partition rows).
+    """
+
+    def __init__(self, mismatches):
+        self.mismatches = mismatches
+        super(ConsolidationError, self).__init__(
+            'Row counts differ for {} shard(s): {}'.format(
+                len(mismatches), ', '.join(
+                    '{} ({} vs {})'.format(date, *counts)
+                    for date, counts in sorted(mismatches.items()))))
+
+
+def find_shards(tables, prefix):
+    """
+    :param tables: List[TableMetadata] of the shards' dataset
+    :param prefix: str table id prefix, e.g. 'events_'
+    :return: dict of shard date 'YYYYMMDD' to TableMetadata, in date order
+    """
+    shards = {}
+    for metadata in tables:
+        table_id = metadata.table_spec.rsplit('.', 1)[1]
+        suffix = table_id[len(prefix):]
+        if table_id.startswith(prefix) and SHARD_DATE.match(suffix):
+            shards[suffix] = metadata
+    return collections.OrderedDict(sorted(shards.items()))
+
+
+class ConsolidationState():
+    """
+    Per-shard status persisted to a JSON file, or kept in memory without one
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.shards = {}
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path) as state_file:
+                self.shards = json.load(state_file)['shards']
+
+    def status(self, date):
+        return self.shards.get(date, {}).get('status')
+
+    def update(self, date, **fields):
+        with self._lock:
+            self.shards.setdefault(date, {}).update(fields)
+            if self.path is not None:
+                # Replace atomically so an interrupted write cannot corrupt
+                # the state of shards already done.
+                temp_path = self.path + '.tmp'
+                with open(temp_path, 'w') as state_file:
+                    json.dump({'shards': self.shards}, state_file, indent=1,
+                              sort_keys=True)
+                os.replace(temp_path, self.path)
+
+
+class ShardConsolidator():
+    """
+    Migrates date shards into partitions of one table
+    """
+
+    def __init__(self, pipeline, prefix, destination, partition_field=None,
+                 clustering_fields=None, mode=None, state_file=None,
+                 concurrency=None, clock=time.time):
+        """
+        :param pipeline: BQPipeline
+        :param prefix: shard prefix 'project.dataset.events_'
+        :param destination: tablespec of the partitioned table
+        :param partition_field: DATE column to partition on, or None for
+            ingestion time partitioning
+        :param clustering_fields: (optional) List[str] clustering columns
+        :param mode: COPY or QUERY, defaults to COPY for ingestion time
+            partitioning and QUERY otherwise
+        :param state_file: (optional) JSON file recording progress
+        :param concurrency: concurrency.AdaptiveConcurrency running the
+            per-shard jobs
+        """
+        mode = mode or (COPY if partition_field is None else QUERY)
+        if mode == COPY and partition_field is not None:
+            raise ValueError('COPY mode needs ingestion time partitioning; '
+                             'use QUERY mode with partition_field')
+        self.logger = logging.getLogger(__name__)
+        self.pipeline = pipeline
+        self.dataset, self.prefix = prefix.rsplit('.', 1)
+        self.destination = destination
+        self.partition_field = partition_field
+        self.clustering_fields = clustering_fields
+        self.mode = mode
+        self.state = ConsolidationState(state_file)
+        self.concurrency = concurrency
+        self.clock = clock
+        self.shards = {}
+        self._progress_lock = threading.Lock()
+        self._done = 0
+        self._rows = 0
+        self._pending = 0
+        self._started = None
+
+    def discover(self):
+        """
+        :return: dict of shard date to TableMetadata
+        """
+        self.shards = find_shards(
+            self.pipeline.prefetch_table_metadata(self.dataset), self.prefix)
+        self.logger.info('Found %d shards of `%s.%s*`', len(self.shards),
+                         self.dataset, self.prefix)
+        return self.shards
+
+    def ensure_destination(self, client):
+        """
+        Creates the partitioned destination from the schema of the newest
+        shard if it does not exist
+        """
+        newest = self.shards[max(self.shards)]
+        schema = list(client.get_table(newest.table_spec).schema)
+        if self.partition_field is not None and \
+                self.partition_field not in [f.name for f in schema]:
+            schema.append(bigquery.SchemaField(self.partition_field, 'DATE'))
+        table = bigquery.Table(self.destination, schema=schema)
+        table.time_partitioning = bigquery.TimePartitioning(
+            type_=bigquery.TimePartitioningType.DAY,
+            field=self.partition_field)
+        if self.clustering_fields:
+            table.clustering_fields = self.clustering_fields
+        client.create_table(table, exists_ok=True)
+        return schema
+
+    def shard_query(self, date, metadata):
+        """
+        :return: str query selecting a shard's rows for its partition
+        """
+        columns = [name for name, _ in metadata.schema]
+        if self.partition_field is not None and \
+                self.partition_field not in columns:
+            return ("SELECT *, PARSE_DATE('%Y%m%d', '{}') AS `{}` "
+                    'FROM `{}`').format(date, self.partition_field,
+                                        metadata.table_spec)
+        return 'SELECT * FROM `{}`'.format(metadata.table_spec)
+
+    def migrate(self, date):
+        """
+        Writes one shard into its partition
+        :return: bigquery job
+        """
+        metadata = self.shards[date]
+        partition = '{}${}'.format(self.destination, date)
+        if self.mode == COPY:
+            job = self.pipeline.start_copy_table(metadata.table_spec,
+                                                 partition, overwrite=True)
+        else:
+            job = self.pipeline.submit_query(
+                self.shard_query(date, metadata), destination=partition,
+                create=False, overwrite=True)
+        job.result()
+        self.state.update(date, status='copied', job_id=job.job_id,
+                          rows=metadata.num_rows)
+        self._progress(metadata.num_rows or 0)
+        return self.pipeline.refresh_job(job)
+
+    def _progress(self, rows):
+        with self._progress_lock:
+            self._done += 1
+            self._rows += rows
+            elapsed = max(self.clock() - self._started, 1e-9)
+            remaining = self._pending - self._done
+            self.logger.info(
+                'Consolidated %d/%d shards into `%s` (%.2f shards/s, %.0f '
+                'rows/s, ~%.0fs left)', self._done, self._pending,
+                self.destination, self._done / elapsed, self._rows / elapsed,
+                remaining * elapsed / self._done)
+
+    def partition_rows(self, client):
+        """
+        :return: dict of partition id to row count of the destination
+        """
+        project, dataset, table = self.destination.split('.')
+        query = PARTITION_ROWS_SQL.format(project=project, dataset=dataset,
+                                          table=table)
+        job = client.query(query, job_id_prefix=self.pipeline.job_id_prefix)
+        return {row['partition_id']: row['total_rows']
+                for row in job.result()}
+
+    def verify(self, client):
+        """
+        Compares each migrated shard's row count with its partition
+        :raises: ConsolidationError on mismatches
+        """
+        partitions = self.partition_rows(client)
+        mismatches = {}
+        for date, metadata in self.shards.items():
+            if self.state.status(date) not in ('copied', 'verified'):
+                continue
+            expected = metadata.num_rows or 0
+            actual = partitions.get(date, 0)
+            if expected != actual:
+                mismatches[date] = (expected, actual)
+                self.state.update(date, status='mismatch',
+                                  partition_rows=actual)
+            else:
+                self.state.update(date, status='verified')
+        if mismatches:
+            raise ConsolidationError(mismatches)
+        self.logger.info('Verified row counts of %d partitions of `%s`',
+                         len(self.shards), self.destination)
+
+    def delete_shards(self):
+        """
+        Deletes verified shards
+        :return: List[str] deleted table specs
+        """
+        dates = [date for date in self.shards
+                 if self.state.status(date) == 'verified']
+
+        def delete(date):
+            # Through the client, since AsyncBQPipeline.delete_table is a
+            # coroutine
+            table = self.shards[date].table_spec
+            self.pipeline.metadata_cache.invalidate(table)
+            self.pipeline.get_client(
+                self.pipeline.get_table_location(table)).delete_table(
+                    table, not_found_ok=True)
+            self.logger.info('Deleted shard `%s`', table)
+            self.state.update(date, status='deleted')
+            return self.shards[date]
+
+        deleted = self.concurrency.map(delete, dates)
+        self.logger.info('Deleted %d shards', len(deleted))
+        return [metadata.table_spec for metadata in deleted]
+
+    def run(self, verify=True, delete_shards=False):
+        """
+        Discovers shards, creates the destination and migrates every shard
+        not done in an earlier run
+        :param verify: compare row counts of shards and partitions
+        :param delete_shards: delete shards after verification
+        :return: dict summary
+        """
+        if delete_shards and not verify:
+            raise ValueError('delete_shards requires verify')
+        self.discover()
+        if not self.shards:
+            raise ValueError('No shards found for `{}.{}*`'.format(
+                self.dataset, self.prefix))
+        client = self.pipeline.get_client(
+            self.pipeline.get_table_location(self.destination))
+        self.ensure_destination(client)
+        pending = [date for date in self.shards
+                   if self.state.status(date) not in DONE]
+        self.logger.info('Migrating %d of %d shards to `%s` with %s jobs',
+                         len(pending), len(self.shards), self.destination,
+                         self.mode)
+        self._pending = len(pending)
+        self._started = self.clock()
+        jobs = self.concurrency.map(self.migrate, pending)
+        elapsed = self.clock() - self._started
+        if verify:
+            self.verify(client)
+        deleted = self.delete_shards() if delete_shards else []
+        return {
+            'destination': self.destination,
+            'shards': len(self.shards),
+            'migrated': len(jobs),
+            'skipped': len(self.shards) - len(pending),
+            'rows': self._rows,
+            'seconds': elapsed,
+            'rows_per_second': self._rows / elapsed if elapsed > 0 else 0.0,
+            'deleted': deleted,
+        }
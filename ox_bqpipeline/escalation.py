@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import logging
+import time
+
+
+def to_epoch(deadline, clock=time.time):
+    """
+    Converts a deadline to seconds since the epoch
+    :param deadline: datetime.datetime, or number of seconds from now
+    :param clock: callable returning the current time in epoch seconds
+    :return: float epoch seconds
+    """
+    if isinstance(deadline, datetime.datetime):
+        return deadline.timestamp()
+    return clock() + deadline
+
+
+def summarize_escalations(escalations):
+    """
+    Aggregates a list of EscalationRecord
+    :param escalations: List[EscalationRecord]
+    :return: dict with escalation count, queued seconds lost, and bytes
+        billed and slot milliseconds of the escalated jobs
+    """
+    return {
+        'escalations': len(escalations),
+        'queued_seconds': sum(e.queued_seconds for e in escalations),
+        'bytes_billed': sum(e.bytes_billed or 0 for e in escalations),
+        'slot_millis': sum(e.slot_millis or 0 for e in escalations),
+    }
+
+
+class EscalationRecord():
+    """
+    Describes a BATCH job that was cancelled and resubmitted as INTERACTIVE,
+    or a step submitted as INTERACTIVE because the deadline was already at
+    risk
+    """
+
+    def __init__(self, sql_path, batch_job_id, interactive_job_id,
+                 queued_seconds, projected_overrun):
+        """
+        :param sql_path: path to the sql file of the escalated step
+        :param batch_job_id: id of the cancelled BATCH job, or None if the
+            step was never submitted as BATCH
+        :param interactive_job_id: id of the INTERACTIVE replacement job
+        :param queued_seconds: time the BATCH job spent queued
+        :param projected_overrun: seconds past the deadline the pipeline was
+            projected to finish when the job was escalated
+        """
+        self.sql_path = sql_path
+        self.batch_job_id = batch_job_id
+        self.interactive_job_id = interactive_job_id
+        self.queued_seconds = queued_seconds
+        self.projected_overrun = projected_overrun
+        self.bytes_billed = None
+        self.slot_millis = None
+
+    def __repr__(self):
+        return ('EscalationRecord({!r}, {!r} -> {!r}, queued={:.0f}s, '
+                'bytes_billed={})').format(self.sql_path, self.batch_job_id,
+                                           self.interactive_job_id,
+                                           self.queued_seconds,
+                                           self.bytes_billed)
+
+
+class DeadlineScheduler():
+    """
+    Runs the steps of a sequential pipeline as BATCH queries and escalates a
+    queued step to INTERACTIVE priority when the pipeline deadline is at risk.
+    A step is submitted as INTERACTIVE right away if the deadline is already
+    at risk when it starts.
+
+    The remaining critical path is the queued step plus every step after it,
+    each estimated by the mean runtime of the steps completed so far.
+    """
+
+    def __init__(self, pipeline, deadline, steps, step_estimate=10*60,
+                 poll_interval=5, cancel_timeout=60, clock=time.time,
+                 sleep=time.sleep):
+        """
+        :param pipeline: BQPipeline used to submit queries
+        :param deadline: datetime.datetime, or seconds from now
+        :param steps: number of steps in the pipeline
+        :param step_estimate: seconds assumed per step until a step has
+            completed
+        :param poll_interval: seconds between checks of a queued job
+        :param cancel_timeout: seconds to wait for a cancelled BATCH job to
+            stop before giving up on escalating it
+        :param clock: callable returning the current time in epoch seconds
+        :param sleep: callable used to wait between checks
+        """
+        self.logger = logging.getLogger(__name__)
+        self.pipeline = pipeline
+        self.deadline = to_epoch(deadline, clock=clock)
+        self.steps_left = steps
+        self.step_estimate = step_estimate
+        self.poll_interval = poll_interval
+        self.cancel_timeout = cancel_timeout
+        self.clock = clock
+        self.sleep = sleep
+        self.durations = []
+        self.escalations = []
+
+    def estimate_remaining(self):
+        """
+        Estimates the runtime of the current and all following steps
+        :return: float seconds
+        """
+        if self.durations:
+            per_step = sum(self.durations) / len(self.durations)
+        else:
+            per_step = self.step_estimate
+        return per_step * self.steps_left
+
+    def projected_overrun(self):
+        """
+        :return: float seconds the pipeline is projected to finish after the
+            deadline, negative when there is slack
+        """
+        return self.clock() + self.estimate_remaining() - self.deadline
+
+    def summary(self):
+        """
+        :return: dict summarizing the escalations made by this scheduler
+        """
+        return summarize_escalations(self.escalations)
+
+    def run_step(self, sql_path, query, destination=None, create=True,
+                 overwrite=True, append=False, query_params=None,
+                 timeout=None):
+        """
+        Submits a step as a BATCH query, escalates it if needed, and waits
+        for it to complete
+        :return: bigquery.job.QueryJob
+        """
+        settings = {
+            'destination': destination,
+            'create': create,
+            'overwrite': overwrite,
+            'append': append,
+            'query_params': query_params,
+        }
+        overrun = self.projected_overrun()
+        if overrun > 0:
+            job = self.pipeline.submit_query(query, batch=False, **settings)
+            self.escalations.append(EscalationRecord(
+                sql_path, None, job.job_id, queued_seconds=0,
+                projected_overrun=overrun))
+            self.logger.warning('Deadline at risk (projected %.0fs late): '
+                                'executing query %s %s with INTERACTIVE '
+                                'priority', overrun, sql_path, job.job_id)
+        else:
+            job = self.pipeline.submit_query(query, batch=True, **settings)
+            self.logger.info('Executing query %s %s with BATCH priority',
+                             sql_path, job.job_id)
+        submitted = self.clock()
+        while overrun <= 0:
+            job.reload()
+            if job.state != 'PENDING':
+                break
+            overrun = self.projected_overrun()
+            if overrun > 0:
+                job = self._escalate(sql_path, query, job, submitted, overrun,
+                                     settings)
+                break
+            self.sleep(self.poll_interval)
+
+        job.result(timeout=timeout)
+        self.logger.info('Finished query %s %s', sql_path, job.job_id)
+        if self.escalations and \
+            self.escalations[-1].interactive_job_id == job.job_id:
+            self.escalations[-1].bytes_billed = job.total_bytes_billed
+            self.escalations[-1].slot_millis = job.slot_millis
+        if job.started is not None and job.ended is not None:
+            self.durations.append(
+                (job.ended - job.started).total_seconds())
+        self.steps_left -= 1
+        return job
+
+    def _escalate(self, sql_path, query, job, submitted, overrun, settings):
+        """
+        Cancels a queued BATCH job and resubmits it as INTERACTIVE
+        :return: bigquery.job.QueryJob to wait on
+        """
+        job.cancel()
+        give_up = self.clock() + self.cancel_timeout
+        while job.state != 'DONE':
+            if self.clock() >= give_up:
+                # The BATCH job may still commit, so submitting a replacement
+                # could write the same rows twice; keep waiting on it.
+                self.logger.warning('Query %s %s did not stop within %ss of '
+                                    'being cancelled, not escalating',
+                                    sql_path, job.job_id, self.cancel_timeout)
+                return job
+            self.sleep(min(self.poll_interval, 1))
+            job.reload()
+        if job.error_result is None:
+            # The job completed before the cancellation took effect, so
+            # resubmitting it could append the same rows twice.
+            self.logger.info('Query %s %s completed before it could be '
+                             'escalated', sql_path, job.job_id)
+            return job
+
+        replacement = self.pipeline.submit_query(query, batch=False,
+                                                 **settings)
+        record = EscalationRecord(sql_path, job.job_id, replacement.job_id,
+                                  queued_seconds=self.clock() - submitted,
+                                  projected_overrun=overrun)
+        self.escalations.append(record)
+        self.logger.warning('Deadline at risk (projected %.0fs late): '
+                            'escalated %s from BATCH job %s to INTERACTIVE '
+                            'job %s', overrun, sql_path, job.job_id,
+                            replacement.job_id)
+        return replacement
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from ox_bqpipeline.metadata_cache import table_spec_str
+
+
+class JobRecord():
+    """
+    Compact summary of a finished or running BigQuery job. Unlike a
+    bigquery.job.QueryJob it does not hold the API resource, query text or
+    configuration; use full_job to fetch those on demand.
+    """
+
+    __slots__ = ('job_id', 'project', 'location', 'job_type', 'state',
+                 'destination', 'created', 'started', 'ended',
+                 'total_bytes_processed', 'total_bytes_billed',
+                 'error_result')
+
+    def __init__(self, job_id, project=None, location=None, job_type=None,
+                 state=None, destination=None, created=None, started=None,
+                 ended=None, total_bytes_processed=None,
+                 total_bytes_billed=None, error_result=None):
+        self.job_id = job_id
+        self.project = project
+        self.location = location
+        self.job_type = job_type
+        self.state = state
+        self.destination = destination
+        self.created = created
+        self.started = started
+        self.ended = ended
+        self.total_bytes_processed = total_bytes_processed
+        self.total_bytes_billed = total_bytes_billed
+        self.error_result = error_result
+
+    def __repr__(self):
+        return 'JobRecord({!r}, state={!r}, destination={!r})'.format(
+            self.job_id, self.state, self.destination)
+
+    @classmethod
+    def from_job(cls, job):
+        """
+        :param job: bigquery.job.QueryJob, CopyJob or ExtractJob
+        :return: JobRecord
+        """
+        destination = getattr(job, 'destination', None)
+        return cls(job.job_id,
+                   project=job.project,
+                   location=job.location,
+                   job_type=job.job_type,
+                   state=job.state,
+                   destination=table_spec_str(destination),
+                   created=job.created,
+                   started=job.started,
+                   ended=job.ended,
+                   total_bytes_processed=getattr(
+                       job, 'total_bytes_processed', None),
+                   total_bytes_billed=getattr(job, 'total_bytes_billed', None),
+                   error_result=job.error_result)
+
+    @property
+    def duration(self):
+        """
+        :return: float seconds between start and end, or None
+        """
+        if self.started is None or self.ended is None:
+            return None
+        return (self.ended - self.started).total_seconds()
+
+    def done(self):
+        return self.state == 'DONE'
+
+    def full_job(self, client):
+        """
+        Fetches the complete job from BigQuery
+        :param client: bigquery.Client
+        :return: bigquery.job.QueryJob, CopyJob or ExtractJob
+        """
+        return client.get_job(self.job_id, project=self.project,
+                              location=self.location)
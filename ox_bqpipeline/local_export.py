@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Exports BigQuery tables straight to local Parquet or Avro files over parallel
+BigQuery Storage Read API streams, without an extract job or GCS round trip.
+
+Requires the optional dependencies pyarrow, fastavro (for Avro output) and
+google-cloud-bigquery-storage (for BigQueryReadService).
+"""
+
+import concurrent.futures
+import datetime
+import decimal
+import json
+import logging
+import os
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import fastavro
+except ImportError:
+    fastavro = None
+
+
+FILE_EXTENSIONS = {
+    'PARQUET': '.parquet',
+    'AVRO': '.avro',
+}
+
+# Codecs used for compression='auto'. Snappy needs cramjam with fastavro, so
+# Avro files use deflate, which fastavro supports out of the box.
+DEFAULT_COMPRESSION = {
+    'PARQUET': 'snappy',
+    'AVRO': 'deflate',
+}
+
+# Rows per Parquet row group. Stream batches are much smaller, so they are
+# buffered up to this size before being written.
+ROW_GROUP_SIZE = 128 * 1024
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def _require(module, name):
+    if module is None:
+        raise ImportError('{} is required for local exports, install it with '
+                          '`pip install {}`'.format(name, name))
+
+
+class BigQueryReadService():
+    """
+    Reads tables through the BigQuery Storage Read API in Arrow format.
+    Instances are pickled into worker processes, so the client is created
+    lazily in each process.
+    """
+
+    def __init__(self, project, json_credentials_path=None):
+        """
+        :param project: project billed for the read sessions
+        :param json_credentials_path: (optional) path to service account JSON
+            credentials file
+        """
+        self.project = project
+        self.json_credentials_path = json_credentials_path
+        self._client = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_client'] = None
+        return state
+
+    def get_client(self):
+        """
+        Initializes bigquery_storage.BigQueryReadClient
+        :return bigquery_storage.BigQueryReadClient
+        """
+        if self._client is None:
+            from google.cloud import bigquery_storage
+            if self.json_credentials_path is not None:
+                self._client = bigquery_storage.BigQueryReadClient \
+                    .from_service_account_json(self.json_credentials_path)
+            else:
+                self._client = bigquery_storage.BigQueryReadClient()
+        return self._client
+
+    def create_session(self, table_spec, max_streams):
+        """
+        Opens a read session on a table
+        :param table_spec: str 'project.dataset.table'
+        :param max_streams: maximum number of parallel streams
+        :return: Tuple[pyarrow.Schema, List[str]] schema and stream names
+        """
+        from google.cloud.bigquery_storage import types
+        project, dataset_id, table_id = table_spec.split('.')
+        read_session = types.ReadSession(
+            table='projects/{}/datasets/{}/tables/{}'.format(
+                project, dataset_id, table_id),
+            data_format=types.DataFormat.ARROW)
+        session = self.get_client().create_read_session(
+            parent='projects/{}'.format(self.project),
+            read_session=read_session,
+            max_stream_count=max_streams)
+        schema = pyarrow.ipc.read_schema(
+            pyarrow.py_buffer(session.arrow_schema.serialized_schema))
+        return schema, [stream.name for stream in session.streams]
+
+    def read_stream(self, stream_name, schema):
+        """
+        Reads a stream one record batch at a time
+        :param stream_name: name of a stream of a read session
+        :param schema: pyarrow.Schema of the session
+        :return: Iterator[pyarrow.RecordBatch]
+        """
+        for message in self.get_client().read_rows(stream_name):
+            yield pyarrow.ipc.read_record_batch(
+                pyarrow.py_buffer(
+                    message.arrow_record_batch.serialized_record_batch),
+                schema)
+
+
+class LocalReadService():
+    """
+    Offline stand-in for the BigQuery Storage Read API that serves in-memory
+    pyarrow Tables split into contiguous streams.
+    """
+
+    def __init__(self, tables, batch_size=1024):
+        """
+        :param tables: dict of table spec to pyarrow.Table
+        :param batch_size: maximum rows per record batch
+        """
+        self.tables = tables
+        self.batch_size = batch_size
+
+    def create_session(self, table_spec, max_streams):
+        table = self.tables[table_spec]
+        streams = max(min(max_streams, table.num_rows), 1)
+        return table.schema, ['{}/streams/{}/{}'.format(table_spec, i, streams)
+                              for i in range(streams)]
+
+    def read_stream(self, stream_name, schema):
+        table_spec, _, index, count = stream_name.rsplit('/', 3)
+        table = self.tables[table_spec]
+        index, count = int(index), int(count)
+        start = table.num_rows * index // count
+        end = table.num_rows * (index + 1) // count
+        for batch in table.slice(start, end - start).to_batches(
+                max_chunksize=self.batch_size):
+            yield batch
+
+
+def avro_type(arrow_type, name):
+    """
+    Maps an Arrow type to an Avro type
+    :param arrow_type: pyarrow.DataType
+    :param name: field path, used to name nested records
+    :return: str or dict Avro type
+    """
+    types = pyarrow.types
+    if types.is_boolean(arrow_type):
+        return 'boolean'
+    if types.is_integer(arrow_type):
+        return 'long'
+    if types.is_floating(arrow_type):
+        return 'double'
+    if types.is_binary(arrow_type):
+        return 'bytes'
+    if types.is_timestamp(arrow_type):
+        return {'type': 'long', 'logicalType': 'timestamp-micros'}
+    if types.is_date(arrow_type):
+        return {'type': 'int', 'logicalType': 'date'}
+    if types.is_list(arrow_type):
+        return {'type': 'array',
+                'items': avro_type(arrow_type.value_type, name)}
+    if types.is_struct(arrow_type):
+        return {'type': 'record',
+                'name': name,
+                'fields': [avro_field(arrow_type.field(i), name)
+                           for i in range(arrow_type.num_fields)]}
+    # NUMERIC, TIME, GEOGRAPHY and STRING are written as strings.
+    return 'string'
+
+
+def avro_field(field, parent='Root'):
+    """
+    :param field: pyarrow.Field
+    :param parent: name of the enclosing record
+    :return: dict nullable Avro field
+    """
+    name = '{}_{}'.format(parent, field.name)
+    return {'name': field.name, 'type': ['null', avro_type(field.type, name)]}
+
+
+def avro_value(value):
+    """
+    Converts values without a native Avro mapping to strings
+    """
+    if isinstance(value, dict):
+        return {k: avro_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [avro_value(v) for v in value]
+    if isinstance(value, (decimal.Decimal, datetime.time)):
+        return str(value)
+    return value
+
+
+def _avro_records(batches):
+    for batch in batches:
+        for record in batch.to_pylist():
+            yield {k: avro_value(v) for k, v in record.items()}
+
+
+def export_stream(service, stream_name, schema, path, file_format,
+                  compression, row_group_size=ROW_GROUP_SIZE):
+    """
+    Writes a single read stream to a local file, holding at most one
+    Parquet row group or one Avro record batch in memory at a time. Runs in a
+    worker process.
+    :return: dict manifest entry
+    """
+    counter = {'rows': 0}
+
+    def batches():
+        for batch in service.read_stream(stream_name, schema):
+            counter['rows'] += batch.num_rows
+            yield batch
+
+    if file_format == 'PARQUET':
+        writer = pyarrow.parquet.ParquetWriter(path, schema,
+                                               compression=compression)
+        try:
+            buffered, buffered_rows = [], 0
+            for batch in batches():
+                buffered.append(batch)
+                buffered_rows += batch.num_rows
+                while buffered_rows >= row_group_size:
+                    table = pyarrow.Table.from_batches(buffered, schema)
+                    writer.write_table(table.slice(0, row_group_size),
+                                       row_group_size=row_group_size)
+                    # Carry the rest over into the next row group.
+                    buffered = table.slice(row_group_size).to_batches()
+                    buffered_rows -= row_group_size
+            if buffered_rows:
+                writer.write_table(pyarrow.Table.from_batches(buffered, schema),
+                                   row_group_size=row_group_size)
+        finally:
+            writer.close()
+    else:
+        avro_schema = {'type': 'record', 'name': 'Root',
+                       'fields': [avro_field(f) for f in schema]}
+        with open(path, 'wb') as avro_file:
+            fastavro.writer(avro_file, fastavro.parse_schema(avro_schema),
+                            _avro_records(batches()),
+                            codec=compression or 'null')
+    return {'stream': stream_name, 'path': os.path.basename(path),
+            'rows': counter['rows'], 'bytes': os.path.getsize(path)}
+
+
+def export_to_local(service, table_spec, directory, streams=4,
+                    file_format='PARQUET', compression='auto',
+                    processes=None, prefix='part',
+                    row_group_size=ROW_GROUP_SIZE):
+    """
+    Exports a table to one local file per read stream using worker
+    processes, and writes a manifest.json describing the files.
+    :param service: BigQueryReadService or LocalReadService
+    :param table_spec: str 'project.dataset.table'
+    :param directory: local directory to write files to
+    :param streams: maximum number of parallel read streams
+    :param file_format: PARQUET or AVRO
+    :param compression: codec, e.g. snappy, None for no compression, or
+        auto for the DEFAULT_COMPRESSION of the format
+    :param processes: number of worker processes, defaults to one per stream
+    :param prefix: file name prefix
+    :param row_group_size: maximum rows per Parquet row group
+    :return: dict manifest
+    """
+    file_format = file_format.upper()
+    if file_format not in FILE_EXTENSIONS:
+        raise ValueError('Unsupported local export format: {}'.format(
+            file_format))
+    _require(pyarrow, 'pyarrow')
+    if file_format == 'AVRO':
+        _require(fastavro, 'fastavro')
+    if compression == 'auto':
+        compression = DEFAULT_COMPRESSION[file_format]
+
+    logger = logging.getLogger(__name__)
+    schema, stream_names = service.create_session(table_spec, streams)
+    logger.info('Exporting `%s` to %s over %d streams', table_spec,
+                directory, len(stream_names))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    files = []
+    if stream_names:
+        workers = min(processes or len(stream_names), len(stream_names))
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            futures = [
+                pool.submit(export_stream, service, name, schema,
+                            os.path.join(directory, '{}-{:05d}{}'.format(
+                                prefix, i, FILE_EXTENSIONS[file_format])),
+                            file_format, compression, row_group_size)
+                for i, name in enumerate(stream_names)]
+            files = [future.result() for future in futures]
+
+    manifest = {
+        'table': table_spec,
+        'format': file_format,
+        'compression': compression,
+        'schema': [{'name': f.name, 'type': str(f.type)} for f in schema],
+        'files': files,
+        'total_rows': sum(f['rows'] for f in files),
+        'total_bytes': sum(f['bytes'] for f in files),
+    }
+    with open(os.path.join(directory, MANIFEST_FILE), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    logger.info('Finished exporting `%s`: %d rows in %d files', table_spec,
+                manifest['total_rows'], len(files))
+    return manifest
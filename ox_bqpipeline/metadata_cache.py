@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import threading
+import time
+
+from google.cloud import bigquery
+
+
+# Legacy SQL type names returned by the tables API, mapped to the Standard SQL
+# names used by INFORMATION_SCHEMA.
+LEGACY_TYPE_MAP = {
+    'INTEGER': 'INT64',
+    'FLOAT': 'FLOAT64',
+    'BOOLEAN': 'BOOL',
+    'RECORD': 'STRUCT',
+}
+
+# Partition ids that do not correspond to a real partition.
+PSEUDO_PARTITION_IDS = ('__NULL__', '__UNPARTITIONED__')
+
+DATASET_METADATA_SQL = """
+WITH partitions AS (
+  SELECT
+    table_name,
+    SUM(total_rows) AS num_rows,
+    MAX(last_modified_time) AS modified,
+    COUNTIF(partition_id IS NOT NULL
+            AND partition_id NOT IN ('__NULL__', '__UNPARTITIONED__'))
+      AS num_partitions
+  FROM `{project}.{dataset}.INFORMATION_SCHEMA.PARTITIONS`
+  GROUP BY table_name
+), columns AS (
+  SELECT
+    table_name,
+    ARRAY_AGG(STRUCT(column_name, data_type, is_partitioning_column,
+                     clustering_ordinal_position)
+              ORDER BY ordinal_position) AS columns
+  FROM `{project}.{dataset}.INFORMATION_SCHEMA.COLUMNS`
+  GROUP BY table_name
+)
+SELECT
+  t.table_name,
+  t.table_type,
+  p.num_rows,
+  p.modified,
+  p.num_partitions,
+  c.columns
+FROM `{project}.{dataset}.INFORMATION_SCHEMA.TABLES` AS t
+LEFT JOIN partitions AS p USING (table_name)
+LEFT JOIN columns AS c USING (table_name)
+"""
+
+
+def table_spec_str(table):
+    """
+    Formats a TableReference or table spec as 'project.dataset.table'
+    :param table: bigquery.table.TableReference, bigquery.table.Table or str
+    :return: str TableSpec
+    """
+    if isinstance(table, (bigquery.table.TableReference, bigquery.table.Table)):
+        return '{}.{}.{}'.format(table.project, table.dataset_id,
+                                 table.table_id)
+    return table
+
+
+def sql_type(field):
+    """
+    Formats a SchemaField as a Standard SQL type
+    :param field: bigquery.SchemaField
+    :return: str type, e.g. 'ARRAY<STRUCT<a INT64, b STRING>>'
+    """
+    field_type = LEGACY_TYPE_MAP.get(field.field_type, field.field_type)
+    if field_type == 'STRUCT':
+        field_type = 'STRUCT<{}>'.format(', '.join(
+            '{} {}'.format(f.name, sql_type(f)) for f in field.fields))
+    if field.mode == 'REPEATED':
+        field_type = 'ARRAY<{}>'.format(field_type)
+    return field_type
+
+
+class TableMetadata():
+    """
+    Schema, freshness, size and partitioning of a single table
+    """
+
+    def __init__(self, table_spec, table_type=None, schema=None,
+                 modified=None, num_rows=None, partition_field=None,
+                 clustering_fields=None, num_partitions=None):
+        """
+        :param table_spec: str 'project.dataset.table'
+        :param table_type: BASE TABLE, VIEW, ...
+        :param schema: List[Tuple[str,str]] of column name and Standard SQL
+            type
+        :param modified: datetime.datetime of last modification
+        :param num_rows: int number of rows
+        :param partition_field: partitioning column, '_PARTITIONTIME' for
+            ingestion time partitioning, or None
+        :param clustering_fields: List[str] of clustering columns
+        :param num_partitions: int number of partitions
+        """
+        self.table_spec = table_spec
+        self.table_type = table_type
+        self.schema = schema or []
+        self.modified = modified
+        self.num_rows = num_rows
+        self.partition_field = partition_field
+        self.clustering_fields = clustering_fields or []
+        self.num_partitions = num_partitions
+
+    def __repr__(self):
+        return 'TableMetadata({!r}, rows={}, modified={})'.format(
+            self.table_spec, self.num_rows, self.modified)
+
+    @property
+    def column_names(self):
+        return [name for name, _ in self.schema]
+
+    @classmethod
+    def from_table(cls, table):
+        """
+        Creates TableMetadata from the tables API
+        :param table: bigquery.table.Table
+        :return: TableMetadata
+        """
+        partition_field = None
+        if table.time_partitioning is not None:
+            partition_field = table.time_partitioning.field or '_PARTITIONTIME'
+        elif table.range_partitioning is not None:
+            partition_field = table.range_partitioning.field
+        return cls(table_spec_str(table),
+                   table_type={'TABLE': 'BASE TABLE'}.get(table.table_type,
+                                                          table.table_type),
+                   schema=[(f.name, sql_type(f)) for f in table.schema],
+                   modified=table.modified,
+                   num_rows=table.num_rows,
+                   partition_field=partition_field,
+                   clustering_fields=table.clustering_fields)
+
+    @classmethod
+    def from_row(cls, project, dataset, row):
+        """
+        Creates TableMetadata from a row of DATASET_METADATA_SQL
+        :param project: project id
+        :param dataset: dataset id
+        :param row: bigquery.table.Row
+        :return: TableMetadata
+        """
+        schema, partition_field, clustering = [], None, []
+        for column in row['columns'] or []:
+            if column['is_partitioning_column'] == 'YES':
+                partition_field = column['column_name']
+            if column['clustering_ordinal_position'] is not None:
+                clustering.append((column['clustering_ordinal_position'],
+                                   column['column_name']))
+            if not column['column_name'].startswith('_PARTITION'):
+                schema.append((column['column_name'], column['data_type']))
+        return cls('{}.{}.{}'.format(project, dataset, row['table_name']),
+                   table_type=row['table_type'],
+                   schema=schema,
+                   modified=row['modified'],
+                   num_rows=row['num_rows'],
+                   partition_field=partition_field,
+                   clustering_fields=[name for _, name in sorted(clustering)],
+                   num_partitions=row['num_partitions'])
+
+
+class TableMetadataCache():
+    """
+    Thread-safe LRU cache of TableMetadata with a time-to-live. Tables known
+    not to exist are cached too, as are the datasets that have been
+    prefetched as a whole.
+    """
+
+    def __init__(self, ttl=300, max_size=10000, clock=time.monotonic):
+        """
+        :param ttl: seconds an entry stays valid
+        :param max_size: maximum number of entries, least recently used
+            entries are evicted first
+        :param clock: callable returning monotonic seconds
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self._entries = collections.OrderedDict()
+        self._datasets = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, table):
+        return self.get(table) is not None
+
+    def get(self, table):
+        """
+        :param table: table spec or TableReference
+        :return: TableMetadata or None if missing or expired
+        """
+        return self.lookup(table)[1]
+
+    def lookup(self, table):
+        """
+        :param table: table spec or TableReference
+        :return: Tuple[bool,TableMetadata] whether the table is cached, and
+            its metadata or None if it is cached as not existing
+        """
+        key = table_spec_str(table)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            fetched, metadata = entry
+            if self.clock() - fetched > self.ttl:
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, metadata
+
+    def put(self, metadata):
+        """
+        :param metadata: TableMetadata
+        """
+        self._put(metadata.table_spec, metadata)
+
+    def put_missing(self, table):
+        """
+        Records that a table does not exist
+        :param table: table spec or TableReference
+        """
+        self._put(table_spec_str(table), None)
+
+    def _put(self, key, metadata):
+        with self._lock:
+            self._entries[key] = (self.clock(), metadata)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def put_dataset(self, dataset_spec):
+        """
+        Records that every table of a dataset has just been cached
+        :param dataset_spec: str 'project.dataset'
+        """
+        with self._lock:
+            self._datasets[dataset_spec] = self.clock()
+
+    def has_dataset(self, dataset_spec):
+        """
+        :param dataset_spec: str 'project.dataset'
+        :return: bool whether the dataset was prefetched within the ttl
+        """
+        with self._lock:
+            fetched = self._datasets.get(dataset_spec)
+            return fetched is not None and self.clock() - fetched <= self.ttl
+
+    def invalidate(self, table):
+        """
+        Removes a table, typically because it has been written or deleted
+        :param table: table spec or TableReference
+        """
+        with self._lock:
+            self._entries.pop(table_spec_str(table), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._datasets.clear()
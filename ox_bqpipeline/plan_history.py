@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Local history of finished query plans, keyed by SQL path, used to flag skewed
+stages and shuffle spill and to detect steps that got slower than their
+rolling baseline.
+
+Records are derived from the job's API resource only, so recorded resources
+(e.g. saved `bq show --format=json -j` output) can be analysed offline.
+"""
+
+import json
+import logging
+import os
+import threading
+
+REGRESSION_METRICS = ('slot_ms', 'bytes_processed')
+
+STAGE_PHASES = ('wait', 'read', 'compute', 'write')
+
+
+def _int(value):
+    return int(value) if value is not None else 0
+
+
+def _float(value):
+    return float(value) if value is not None else 0.0
+
+
+def median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+
+# API resource keys of a query plan stage and the QueryPlanEntry attributes
+# holding them.
+STAGE_ATTRIBUTES = (
+    ('name', 'name'),
+    ('slotMs', 'slot_ms'),
+    ('recordsRead', 'records_read'),
+    ('recordsWritten', 'records_written'),
+    ('shuffleOutputBytes', 'shuffle_output_bytes'),
+    ('shuffleOutputBytesSpilled', 'shuffle_output_bytes_spilled'),
+) + tuple((phase + suffix, '{}_{}'.format(phase, attribute))
+          for phase in STAGE_PHASES
+          for suffix, attribute in (('MsAvg', 'ms_avg'),
+                                    ('MsMax', 'ms_max'),
+                                    ('RatioAvg', 'ratio_avg'),
+                                    ('RatioMax', 'ratio_max')))
+
+
+def job_resource(job):
+    """
+    Builds the parts of the API resource PlanRecord reads from a job's public
+    statistics. QueryJob.to_api_repr only returns the configuration.
+    :param job: bigquery.job.QueryJob or its API resource dict
+    :return: dict API resource
+    """
+    if isinstance(job, dict):
+        return job
+    stages = []
+    for entry in job.query_plan or []:
+        stage = {}
+        for key, attribute in STAGE_ATTRIBUTES:
+            value = getattr(entry, attribute, None)
+            if value is not None:
+                stage[key] = value
+        stages.append(stage)
+    statistics = {
+        'query': {
+            'totalSlotMs': job.slot_millis,
+            'totalBytesProcessed': job.total_bytes_processed,
+            'totalBytesBilled': job.total_bytes_billed,
+            'queryPlan': stages,
+        },
+    }
+    if job.ended is not None:
+        statistics['endTime'] = int(job.ended.timestamp() * 1000)
+    return {'jobReference': {'projectId': job.project,
+                             'location': job.location,
+                             'jobId': job.job_id},
+            'statistics': statistics}
+
+
+def analyze_stage(stage, skew_ratio=4.0, min_skew_ms=1000):
+    """
+    :param stage: dict query plan stage from the job resource
+    :param skew_ratio: max/avg compute time above which a stage is skewed
+    :param min_skew_ms: slowest worker compute time below which skew is
+        ignored
+    :return: dict stage summary
+    """
+    summary = {
+        'name': stage.get('name'),
+        'slot_ms': _int(stage.get('slotMs')),
+        'records_read': _int(stage.get('recordsRead')),
+        'records_written': _int(stage.get('recordsWritten')),
+        'shuffle_bytes': _int(stage.get('shuffleOutputBytes')),
+        'spilled_bytes': _int(stage.get('shuffleOutputBytesSpilled')),
+    }
+    for phase in STAGE_PHASES:
+        summary[phase + '_ratio_avg'] = _float(stage.get(phase + 'RatioAvg'))
+        summary[phase + '_ratio_max'] = _float(stage.get(phase + 'RatioMax'))
+    compute_avg = _float(stage.get('computeMsAvg'))
+    compute_max = _float(stage.get('computeMsMax'))
+    if compute_avg > 0:
+        summary['skew'] = compute_max / compute_avg
+    elif summary['compute_ratio_avg'] > 0:
+        # Older resources only carry ratios relative to the slowest stage.
+        summary['skew'] = (summary['compute_ratio_max'] /
+                           summary['compute_ratio_avg'])
+    else:
+        summary['skew'] = 1.0
+    summary['skewed'] = (summary['skew'] >= skew_ratio and
+                         compute_max >= min_skew_ms)
+    return summary
+
+
+class PlanRecord():
+    """
+    Statistics and stage plan of one finished query job
+    """
+    FIELDS = ('sql_path', 'job_id', 'end_time', 'slot_ms', 'bytes_processed',
+              'bytes_billed', 'shuffle_bytes', 'spilled_bytes', 'stages',
+              'flags')
+
+    def __init__(self, **fields):
+        for name in self.FIELDS:
+            setattr(self, name, fields.get(name))
+        self.alerts = []
+
+    @classmethod
+    def from_resource(cls, sql_path, resource, skew_ratio=4.0,
+                      min_skew_ms=1000):
+        """
+        :param sql_path: path of the step's SQL template
+        :param resource: dict query job API resource
+        :return: PlanRecord
+        """
+        statistics = resource.get('statistics', {})
+        query_stats = statistics.get('query', {})
+        stages = [analyze_stage(stage, skew_ratio, min_skew_ms)
+                  for stage in query_stats.get('queryPlan', [])]
+        flags = []
+        for stage in stages:
+            if stage['skewed']:
+                flags.append('skew: {} slowest worker {:.1f}x average'.format(
+                    stage['name'], stage['skew']))
+            if stage['spilled_bytes']:
+                flags.append('spill: {} spilled {} shuffle bytes to '
+                             'disk'.format(stage['name'],
+                                           stage['spilled_bytes']))
+        return cls(
+            sql_path=sql_path,
+            job_id=resource.get('jobReference', {}).get('jobId'),
+            end_time=_int(statistics.get('endTime')),
+            slot_ms=_int(query_stats.get('totalSlotMs',
+                                         statistics.get('totalSlotMs'))),
+            bytes_processed=_int(query_stats.get(
+                'totalBytesProcessed', statistics.get('totalBytesProcessed'))),
+            bytes_billed=_int(query_stats.get('totalBytesBilled')),
+            shuffle_bytes=sum(stage['shuffle_bytes'] for stage in stages),
+            spilled_bytes=sum(stage['spilled_bytes'] for stage in stages),
+            stages=stages,
+            flags=flags)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+
+class PlanHistory():
+    """
+    Append-only JSON lines store of PlanRecords, grouped by SQL path.
+
+    A step regresses when its slot-ms or bytes processed exceed the median of
+    its previous `window` runs by more than `margin`.
+    """
+
+    def __init__(self, path, window=10, margin=0.5, min_history=3,
+                 skew_ratio=4.0, min_skew_ms=1000):
+        """
+        :param path: JSON lines file holding the history
+        :param window: number of previous runs forming the baseline
+        :param margin: fraction above the baseline that raises an alert
+        :param min_history: runs needed before regressions are reported
+        :param skew_ratio: max/avg worker compute time flagged as skew
+        :param min_skew_ms: ignore skew in stages faster than this
+        """
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.window = window
+        self.margin = margin
+        self.min_history = min_history
+        self.skew_ratio = skew_ratio
+        self.min_skew_ms = min_skew_ms
+        self.records = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as history_file:
+                for line in history_file:
+                    if line.strip():
+                        record = PlanRecord(**json.loads(line))
+                        self.records.setdefault(record.sql_path,
+                                                []).append(record)
+
+    def history(self, sql_path):
+        """
+        :return: List[PlanRecord] of a step, oldest first
+        """
+        with self._lock:
+            return list(self.records.get(sql_path, []))
+
+    def baseline(self, sql_path, metric):
+        """
+        :param metric: PlanRecord attribute, e.g. 'slot_ms'
+        :return: median over the last `window` runs, or None without enough
+            history
+        """
+        previous = self.history(sql_path)[-self.window:]
+        if len(previous) < self.min_history:
+            return None
+        return median([getattr(record, metric) for record in previous])
+
+    def regressions(self, record):
+        """
+        :param record: PlanRecord not yet added to the history
+        :return: List[str] alerts for metrics above baseline plus margin
+        """
+        alerts = []
+        for metric in REGRESSION_METRICS:
+            baseline = self.baseline(record.sql_path, metric)
+            value = getattr(record, metric)
+            if baseline and value > baseline * (1 + self.margin):
+                alerts.append('{} {} is {:.0%} above baseline {}'.format(
+                    metric, value, float(value) / baseline - 1, baseline))
+        return alerts
+
+    def record(self, sql_path, job):
+        """
+        Analyses a finished query job, compares it to the step's baseline and
+        appends it to the history.
+        :param sql_path: path of the step's SQL template
+        :param job: bigquery.job.QueryJob or its recorded API resource
+        :return: PlanRecord with `flags` and `alerts`
+        """
+        record = PlanRecord.from_resource(sql_path, job_resource(job),
+                                          skew_ratio=self.skew_ratio,
+                                          min_skew_ms=self.min_skew_ms)
+        record.alerts = self.regressions(record)
+        for flag in record.flags:
+            self.logger.warning('Query plan %s %s: %s', sql_path,
+                                record.job_id, flag)
+        for alert in record.alerts:
+            self.logger.warning('Performance regression %s %s: %s', sql_path,
+                                record.job_id, alert)
+        with self._lock:
+            self.records.setdefault(sql_path, []).append(record)
+            with open(self.path, 'a') as history_file:
+                history_file.write(json.dumps(record.to_dict(),
+                                              sort_keys=True) + '\n')
+        return record
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Pre-flight stage for run_queries: renders every template up front, checks
+query parameters and referenced tables, and reports all problems at once
+before the first job is submitted.
+
+Templates are rendered in process with the pipeline's Jinja2 environment, so
+its filters and globals apply exactly as when the steps run. With strict, an
+overlay of that environment uses StrictUndefined, so a missing template
+variable fails here instead of silently rendering as an empty string. Worker
+processes cannot share the environment and build a plain sandboxed one from
+the template directories instead. Steps of a pipeline share one set of
+template variables, so each template is rendered once however many steps use
+it.
+"""
+
+import codecs
+import concurrent.futures
+import logging
+
+from jinja2 import FileSystemLoader, StrictUndefined
+from jinja2.sandbox import SandboxedEnvironment
+
+from ox_bqpipeline.metadata_cache import table_spec_str
+
+
+class PipelineValidationError(ValueError):
+    """
+    Raised when pre-flight checks fail. `errors` lists
+    (step index, sql path, message) for every problem found.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super(PipelineValidationError, self).__init__(
+            '{} problem(s) in pipeline:\n{}'.format(len(errors), '\n'.join(
+                '  step {} {}: {}'.format(index, sql_path, message)
+                for index, sql_path, message in errors)))
+
+
+def render_source(environment, sql_path, kwargs):
+    """
+    :param environment: jinja2.Environment
+    :param sql_path: path to sql file
+    :param kwargs: replacements for Jinja2 template
+    :return: Tuple[str,str] of rendered SQL and error message, one of them
+        None
+    """
+    try:
+        with codecs.open(sql_path, mode='r', encoding='utf-8') as sql_file:
+            template = environment.from_string(sql_file.read())
+        return template.render(**kwargs), None
+    except Exception as error:
+        return None, '{}: {}'.format(type(error).__name__, error)
+
+
+def render_template(sql_path, template_dirs, kwargs, strict=False):
+    """
+    Renders a template in a new sandboxed environment. A module level
+    function so that it can run in a worker process.
+    :param sql_path: path to sql file
+    :param template_dirs: directories for include/import, or None
+    :param kwargs: replacements for Jinja2 template
+    :param strict: treat undefined variables as errors
+    :return: Tuple[str,str] of rendered SQL and error message, one of them
+        None
+    """
+    loader = FileSystemLoader(template_dirs) if template_dirs else None
+    if strict:
+        environment = SandboxedEnvironment(loader=loader,
+                                           undefined=StrictUndefined)
+    else:
+        environment = SandboxedEnvironment(loader=loader)
+    return render_source(environment, sql_path, kwargs)
+
+
+def render_all(sql_paths, environment=None, template_dirs=None,
+               processes=None, strict=False, **kwargs):
+    """
+    :param sql_paths: template paths
+    :param environment: (optional) jinja2.Environment to render with in this
+        process
+    :param template_dirs: directories for include/import in worker
+        processes, or without environment
+    :param processes: worker processes, or None to render in this process
+    :param strict: treat undefined variables as errors
+    :param kwargs: replacements for Jinja2 template, picklable when processes
+        is set
+    :return: dict of sql path to (rendered SQL, error message)
+    """
+    sql_paths = list(dict.fromkeys(sql_paths))
+    if not processes or len(sql_paths) < 2:
+        if environment is None:
+            return {path: render_template(path, template_dirs, kwargs,
+                                          strict=strict)
+                    for path in sql_paths}
+        if strict:
+            environment = environment.overlay(undefined=StrictUndefined)
+        return {path: render_source(environment, path, kwargs)
+                for path in sql_paths}
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        futures = [pool.submit(render_template, path, template_dirs, kwargs,
+                               strict)
+                   for path in sql_paths]
+        return {path: future.result()
+                for path, future in zip(sql_paths, futures)}
+
+
+def referenced_tables(pattern, query):
+    """
+    :param pattern: compiled regex with one group matching quoted table specs
+    :return: List[str] table specs read by a query, without wildcards,
+        decorators and INFORMATION_SCHEMA views
+    """
+    tables = []
+    for table in pattern.findall(query):
+        if '*' in table or '$' in table or 'INFORMATION_SCHEMA' in table:
+            continue
+        if table not in tables:
+            tables.append(table)
+    return tables
+
+
+class Prerenderer():
+    """
+    Renders and validates run_queries steps
+    """
+
+    def __init__(self, pipeline, processes=None, check_tables=True,
+                 table_pattern=None, strict=False):
+        """
+        :param pipeline: BQPipeline
+        :param processes: worker processes for rendering, None to render in
+            the calling process with the pipeline's Jinja2 environment
+        :param check_tables: check that tables read by each step exist or are
+            written by an earlier step
+        :param table_pattern: regex finding table specs in rendered SQL
+        :param strict: treat undefined template variables as errors
+        """
+        self.logger = logging.getLogger(__name__)
+        self.pipeline = pipeline
+        self.processes = processes
+        self.check_tables = check_tables
+        self.table_pattern = table_pattern
+        self.strict = strict
+
+    def run(self, query_paths, **kwargs):
+        """
+        :param query_paths: run_queries steps
+        :param kwargs: replacements for Jinja2 template
+        :return: dict of sql path to rendered SQL
+        :raises: PipelineValidationError listing every problem found
+        """
+        steps = [self.pipeline.get_query_details(path) for path in query_paths]
+        loader = self.pipeline.jinja2.loader
+        template_dirs = getattr(loader, 'searchpath', None)
+        rendered = render_all([step[0] for step in steps],
+                              environment=self.pipeline.jinja2,
+                              template_dirs=template_dirs,
+                              processes=self.processes, strict=self.strict,
+                              **kwargs)
+        errors = []
+        written = set()
+        for index, (sql_path, destination, query_params, is_gcs_dest) in \
+                enumerate(steps):
+            query, error = rendered[sql_path]
+            if error is not None:
+                errors.append((index, sql_path, error))
+            if query_params and \
+                    not self.pipeline.validate_query_params(query_params):
+                errors.append((index, sql_path,
+                               'invalid query parameters {!r}'.format(
+                                   query_params)))
+            if query is not None and self.check_tables:
+                for table in referenced_tables(self.table_pattern, query):
+                    if table in written:
+                        continue
+                    if self.pipeline.get_table_metadata(table) is None:
+                        errors.append((index, sql_path,
+                                       'table `{}` does not exist'.format(
+                                           table)))
+            if destination is not None and not is_gcs_dest:
+                written.add(table_spec_str(destination))
+        if errors:
+            raise PipelineValidationError(errors)
+        self.logger.info('Pre-rendered %d templates for %d steps',
+                         len(rendered), len(steps))
+        return {path: result[0] for path, result in rendered.items()}
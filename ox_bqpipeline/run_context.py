@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Pipeline run context: an overall deadline and SIGINT/SIGTERM handling that
+cancel every job the pipeline submitted inside the context, concurrently,
+and drop the run's intermediate tables.
+
+    with bqp.run_context(deadline=3600) as run:
+        bqp.run_queries(steps, wait=False)
+        ...
+    print(run.summary)
+
+A signal only interrupts the run; the jobs are cancelled when the context
+exits, outside the signal handler. A second signal during that cleanup gets
+the handler that was installed before the context, e.g. KeyboardInterrupt.
+
+BigQuery jobs commit atomically, so a cancelled job leaves no partial
+destination behind. The partial state a stopped run does leave is the set of
+intermediate tables written by steps that finished, which are dropped.
+"""
+
+import concurrent.futures
+import logging
+import signal
+import threading
+import time
+
+SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+
+class PipelineCancelled(Exception):
+    """
+    Raised when a run is stopped by a signal or its deadline. `summary`
+    describes the cancelled jobs.
+    """
+
+    def __init__(self, reason, summary=None):
+        super(PipelineCancelled, self).__init__(
+            'Pipeline cancelled: {}'.format(reason))
+        self.reason = reason
+        self.summary = summary
+
+
+class PipelineRunContext():
+    """
+    Tracks the jobs submitted by a pipeline and cancels the outstanding ones
+    when the context exits with an error, receives a signal or runs past its
+    deadline. Exiting a run that was cancelled raises PipelineCancelled, also
+    when the block itself completed.
+    """
+
+    def __init__(self, pipeline, deadline=None, signals=SIGNALS,
+                 cleanup=True, max_workers=16, clock=time.time):
+        """
+        :param pipeline: BQPipeline whose jobs are tracked
+        :param deadline: (optional) seconds the run may take
+        :param signals: signals that cancel the run. Handlers are only
+            installed when entered from the main thread.
+        :param cleanup: drop the pipeline's intermediate tables on
+            cancellation
+        :param max_workers: maximum concurrent cancel requests
+        """
+        self.logger = logging.getLogger(__name__)
+        self.pipeline = pipeline
+        self.deadline = deadline
+        self.signals = signals
+        self.cleanup = cleanup
+        self.max_workers = max_workers
+        self.clock = clock
+        self.jobs = []
+        self.submitted = 0
+        self.reason = None
+        self.summary = None
+        self.started = None
+        self._lock = threading.Lock()
+        self._timer = None
+        self._handlers = {}
+        self._cancelled = False
+        self._cancel_done = threading.Event()
+        self._exiting = False
+        self._previous = None
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def __enter__(self):
+        self.started = self.clock()
+        self._previous = self.pipeline.active_run
+        self.pipeline.active_run = self
+        if threading.current_thread() is threading.main_thread():
+            for signum in self.signals:
+                self._handlers[signum] = signal.signal(signum,
+                                                       self._on_signal)
+        if self.deadline is not None:
+            self._timer = threading.Timer(self.deadline, self._on_deadline)
+            self._timer.daemon = True
+            self._timer.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._exiting = True
+        if self._timer is not None:
+            self._timer.cancel()
+        self._restore_handlers()
+        self.pipeline.active_run = self._previous
+        # Set by the deadline timer, a signal or an explicit cancel().
+        stopped = self._cancelled or self.reason is not None
+        if exc_type is not None and self.reason is None:
+            self.reason = 'error: {}'.format(
+                exc_type.__name__ if exc_value is None else repr(exc_value))
+        if self.reason is not None:
+            self.cancel(self.reason)
+        else:
+            self.summary = self._summary([], [])
+        if isinstance(exc_value, PipelineCancelled):
+            if exc_value.summary is None:
+                exc_value.summary = self.summary
+            return False
+        if stopped:
+            # The job failures caused by cancelling are not the root cause.
+            raise PipelineCancelled(self.reason, self.summary)
+        return False
+
+    def _restore_handlers(self):
+        handlers, self._handlers = self._handlers, {}
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+
+    def _on_signal(self, signum, frame):
+        # Runs on the main thread between any two bytecodes, possibly while
+        # it holds a lock, so it only records the reason and interrupts.
+        name = signal.Signals(signum).name
+        self.logger.warning('Received %s, cancelling pipeline jobs', name)
+        self.reason = self.reason or name
+        self._restore_handlers()
+        if not self._exiting:
+            raise PipelineCancelled(name)
+
+    def _on_deadline(self):
+        self.logger.warning('Pipeline deadline of %ss exceeded, cancelling '
+                            'jobs', self.deadline)
+        self.reason = 'deadline'
+        self.cancel('deadline')
+
+    def track(self, job):
+        """
+        Registers a submitted job. Jobs submitted after cancellation are
+        cancelled immediately. Jobs known to be done are no longer tracked,
+        so long runs do not hold on to every job they submitted.
+        :raises: PipelineCancelled if the run was already cancelled
+        """
+        with self._lock:
+            self.jobs = [tracked for tracked in self.jobs
+                         if tracked.state != 'DONE']
+            self.jobs.append(job)
+            self.submitted += 1
+            cancelled = self._cancelled
+        if cancelled:
+            self._cancel_job(job)
+            raise PipelineCancelled(self.reason, self.summary)
+        return job
+
+    def outstanding(self):
+        """
+        :return: tracked jobs not known to be done
+        """
+        with self._lock:
+            return [job for job in self.jobs if job.state != 'DONE']
+
+    def _cancel_job(self, job):
+        job.cancel()
+        return job
+
+    def cancel(self, reason='cancelled'):
+        """
+        Cancels every outstanding job concurrently, then drops the
+        pipeline's intermediate tables. Safe to call more than once.
+        :param reason: recorded in the summary
+        :return: dict summary
+        """
+        with self._lock:
+            first = not self._cancelled
+            self._cancelled = True
+            self.reason = self.reason or reason
+        if not first:
+            # Another thread, e.g. the deadline timer, is cancelling.
+            self._cancel_done.wait()
+            return self.summary
+        try:
+            jobs = self.outstanding()
+            cancelled, failed = [], []
+            if jobs:
+                with concurrent.futures.ThreadPoolExecutor(
+                        min(self.max_workers, len(jobs))) as pool:
+                    futures = {pool.submit(self._cancel_job, job): job
+                               for job in jobs}
+                    for future in concurrent.futures.as_completed(futures):
+                        job = futures[future]
+                        try:
+                            future.result()
+                            cancelled.append(job.job_id)
+                        except Exception:
+                            self.logger.exception('Failed to cancel job %s',
+                                                  job.job_id)
+                            failed.append(job.job_id)
+            dropped = []
+            if self.cleanup:
+                dropped = self.pipeline.drop_intermediate_tables()
+            self.summary = self._summary(cancelled, failed, dropped)
+            self.logger.warning('Pipeline cancelled (%s): %d jobs cancelled, '
+                                '%d failed to cancel, %d tables dropped',
+                                self.reason, len(cancelled), len(failed),
+                                len(dropped))
+        finally:
+            self._cancel_done.set()
+        return self.summary
+
+    def _summary(self, cancelled, failed, dropped=()):
+        return {
+            'reason': self.reason,
+            'elapsed_seconds': self.clock() - self.started,
+            'submitted_jobs': self.submitted,
+            'cancelled_jobs': sorted(cancelled),
+            'failed_to_cancel': sorted(failed),
+            'dropped_tables': sorted(dropped),
+        }
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Runs consecutive pipeline steps as a single multi-statement script job, so
+that a chain of small steps pays for job creation and scheduling once.
+"""
+
+import logging
+import re
+
+from google.api_core.exceptions import GoogleAPICallError
+from google.cloud import bigquery
+
+
+# BigQuery reports the failing script position as "at [line:column]".
+ERROR_POSITION = re.compile(r'at \[(\d+):(\d+)\]')
+
+CreateDisposition = bigquery.job.CreateDisposition
+WriteDisposition = bigquery.job.WriteDisposition
+
+
+class ScriptStepError(Exception):
+    """
+    Raised when a statement of a script job fails, naming the pipeline step
+    it was generated from
+    """
+
+    def __init__(self, step, job_id, message):
+        super(ScriptStepError, self).__init__(
+            'Step {} ({}) of script job {} failed: {}'.format(
+                step.index, step.sql_path, job_id, message))
+        self.step = step
+        self.job_id = job_id
+
+
+class ScriptStep():
+    """
+    A pipeline step rendered as one or more script statements
+    """
+
+    def __init__(self, index, sql_path, statement, query_params=None,
+                 destination=None):
+        """
+        :param index: position of the step in the pipeline
+        :param sql_path: path to the sql file of the step
+        :param statement: str DDL/DML for the step
+        :param query_params: dict of named query parameters
+        :param destination: bigquery.table.TableReference written by the step
+        """
+        self.index = index
+        self.sql_path = sql_path
+        self.statement = statement
+        self.destination = destination
+        self.query_params = query_params or {}
+        self.first_line = None
+        self.last_line = None
+
+
+def quote_table(table):
+    return '`{}.{}.{}`'.format(table.project, table.dataset_id, table.table_id)
+
+
+def table_exists(table):
+    """
+    :param table: bigquery.table.TableReference
+    :return: str condition that is true if the table exists
+    """
+    return ('EXISTS (SELECT 1 FROM `{}.{}.INFORMATION_SCHEMA.TABLES` '
+            'WHERE table_name = \'{}\')').format(
+                table.project, table.dataset_id, table.table_id)
+
+
+def build_statement(query, job_config, columns=None):
+    """
+    Expresses a query job as script statements that honour the destination,
+    create disposition and write disposition of its QueryJobConfig.
+    An existing destination is truncated and refilled in one transaction
+    rather than replaced, so it keeps its partitioning, clustering and other
+    settings. The query runs at most once, and every terminator after it is
+    on its own line in case the query ends in a line comment.
+    :param query: str SQL query
+    :param job_config: bigquery.QueryJobConfig from create_job_config
+    :param columns: (optional) List[str] cached destination column names
+        for the INSERT column list; without them INSERT relies on the
+        destination's column order
+    :return: str statements without a trailing semicolon
+    """
+    query = query.strip().rstrip(';').rstrip()
+    if job_config.destination is None:
+        return query
+
+    dest = quote_table(job_config.destination)
+    create = job_config.create_disposition == CreateDisposition.CREATE_IF_NEEDED
+    write = job_config.write_disposition
+    if columns:
+        insert = 'INSERT INTO {} ({})\n{}\n;'.format(
+            dest, ', '.join('`{}`'.format(c) for c in columns), query)
+    else:
+        insert = 'INSERT INTO {}\n{}\n;'.format(dest, query)
+    if write == WriteDisposition.WRITE_TRUNCATE:
+        existing = ('BEGIN TRANSACTION;\n'
+                    'TRUNCATE TABLE {};\n'
+                    '{}\n'
+                    'COMMIT TRANSACTION;').format(dest, insert)
+    elif write == WriteDisposition.WRITE_APPEND:
+        existing = insert
+    else:
+        # WRITE_EMPTY
+        existing = ('ASSERT NOT EXISTS (SELECT 1 FROM {}) AS '
+                    '\'Destination table {} is not empty\';\n{}').format(
+                        dest, dest, insert)
+    if create:
+        existing = ('IF {} THEN\n'
+                    '{}\n'
+                    'ELSE\n'
+                    'CREATE TABLE {} AS\n{}\n;\n'
+                    'END IF').format(table_exists(job_config.destination),
+                                     existing, dest, query)
+    # assemble_script adds the final terminator.
+    return existing.rstrip(';').rstrip()
+
+
+def assemble_script(steps):
+    """
+    Joins step statements into a script and records the 1-based line range
+    of each step
+    :param steps: List[ScriptStep]
+    :return: str script
+    """
+    lines = []
+    for step in steps:
+        step.first_line = len(lines) + 1
+        lines.extend(step.statement.split('\n'))
+        # The terminator gets its own line in case the statement ends in a
+        # line comment.
+        lines.append(';')
+        step.last_line = len(lines)
+    return '\n'.join(lines)
+
+
+def step_at_line(steps, line):
+    """
+    :return: ScriptStep containing a script line, or None
+    """
+    for step in steps:
+        if step.first_line <= line <= step.last_line:
+            return step
+    return None
+
+
+def child_line(child):
+    """
+    :param child: bigquery.job.QueryJob child job of a script
+    :return: int script line the child job's statement starts at, or None
+    """
+    statistics = child.script_statistics
+    if statistics is None or not statistics.stack_frames:
+        return None
+    return statistics.stack_frames[0].start_line
+
+
+class ScriptBatcher():
+    """
+    Plans and runs a pipeline as a sequence of script jobs. Steps that cannot
+    be part of a script (GCS destinations, positional parameters) run on
+    their own through BQPipeline.run_query.
+    """
+
+    def __init__(self, pipeline, batch=True, create=True, overwrite=True,
+                 append=False, timeout=None, max_steps=50, rendered=None):
+        """
+        :param pipeline: BQPipeline
+        :param batch: run script jobs with batch priority
+        :param create: if False, destination tables must already exist
+        :param overwrite: if False, destination tables must not exist
+        :param append: if True, destination tables will be appended to
+        :param timeout: time in seconds to wait for each job
+        :param max_steps: maximum number of steps per script job
+        :param rendered: (optional) dict of sql path to SQL rendered ahead of
+            time
+        """
+        self.logger = logging.getLogger(__name__)
+        self.pipeline = pipeline
+        self.batch = batch
+        self.create = create
+        self.overwrite = overwrite
+        self.append = append
+        self.timeout = timeout
+        self.max_steps = max_steps
+        self.rendered = rendered or {}
+
+    def plan(self, query_paths, **kwargs):
+        """
+        Groups consecutive scriptable steps
+        :param query_paths: run_queries steps
+        :param kwargs: replacements for Jinja2 template
+        :return: List[Union[List[ScriptStep], str, tuple]] where a list is a
+            script job and anything else is a standalone run_query step
+        """
+        groups, current, params = [], [], {}
+        for index, query_details in enumerate(query_paths):
+            sql_path, destination, query_params, is_gcs_dest = \
+                self.pipeline.get_query_details(query_details)
+            if is_gcs_dest or isinstance(query_params, list):
+                if current:
+                    groups.append(current)
+                groups.append(query_details)
+                current, params = [], {}
+                continue
+
+            query_params = query_params or {}
+            conflict = any(key in params and params[key] != value
+                           for key, value in query_params.items())
+            if conflict or len(current) >= self.max_steps:
+                groups.append(current)
+                current, params = [], {}
+
+            job_config = self.pipeline.create_job_config(
+                dest=destination, create=self.create,
+                overwrite=self.overwrite, append=self.append)
+            query = self.rendered.get(sql_path)
+            if query is None:
+                query = self.pipeline.render_query(sql_path, **kwargs)
+            columns = None
+            if job_config.destination is not None:
+                metadata = self.pipeline.get_table_metadata(
+                    job_config.destination)
+                if metadata is not None:
+                    columns = metadata.column_names
+            statement = build_statement(query, job_config, columns)
+            current.append(ScriptStep(index, sql_path, statement,
+                                      query_params, job_config.destination))
+            params.update(query_params)
+        if current:
+            groups.append(current)
+        return groups
+
+    def run(self, query_paths, **kwargs):
+        """
+        :param query_paths: run_queries steps
+        :param kwargs: replacements for Jinja2 template
+        :return: List[bigquery.job.QueryJob] one job per step; the child job
+            of the last statement of a scripted step
+        """
+        jobs = []
+        for group in self.plan(query_paths, **kwargs):
+            if isinstance(group, list):
+                jobs.extend(self.run_script(group))
+            else:
+                sql_path = self.pipeline.get_query_details(group)[0]
+                jobs.append(self.pipeline.run_query(
+                    group, batch=self.batch, create=self.create,
+                    overwrite=self.overwrite, append=self.append,
+                    timeout=self.timeout, query=self.rendered.get(sql_path),
+                    **kwargs))
+        return jobs
+
+    def run_script(self, steps):
+        """
+        Runs steps as a single script job
+        :param steps: List[ScriptStep]
+        :return: List[bigquery.job.QueryJob] per step child jobs
+        """
+        script = assemble_script(steps)
+        destinations = [step.destination for step in steps
+                        if step.destination is not None]
+        client = self.pipeline.get_client(self.pipeline.get_query_location(
+            script, destinations[0] if destinations else None))
+        params = {}
+        for step in steps:
+            params.update(step.query_params)
+
+        # Scripts may not set a destination or dispositions; those are
+        # expressed by the statements themselves.
+        defaults = self.pipeline.create_job_config(batch=self.batch,
+                                                   query_params=params)
+        job_config = bigquery.QueryJobConfig(
+            priority=defaults.priority,
+            default_dataset=defaults.default_dataset,
+            query_parameters=defaults.query_parameters)
+        job = self.pipeline.track_job(
+            client.query(script, job_config=job_config,
+                         job_id_prefix=self.pipeline.job_id_prefix))
+        self.logger.info('Executing script of %d steps (%s .. %s) %s',
+                         len(steps), steps[0].sql_path, steps[-1].sql_path,
+                         job.job_id)
+        try:
+            job.result(timeout=self.timeout)
+        except GoogleAPICallError as error:
+            step = self.failed_step(job, steps, error)
+            if step is None:
+                raise
+            raise ScriptStepError(step, job.job_id, error.message)
+        finally:
+            for step in steps:
+                if step.destination is not None:
+                    self.pipeline.metadata_cache.invalidate(step.destination)
+        self.logger.info('Finished script %s', job.job_id)
+        return self.step_jobs(job, steps)
+
+    def children(self, job):
+        """
+        :return: List[bigquery.job.QueryJob] child jobs of a script in
+            execution order
+        """
+        client = self.pipeline.get_location_client(job.location)
+        children = list(client.list_jobs(parent_job=job.job_id))
+        return sorted(children, key=lambda child: child.created)
+
+    def failed_step(self, job, steps, error):
+        """
+        Maps a script failure to the step whose statement failed
+        :return: ScriptStep or None
+        """
+        for child in self.children(job):
+            if child.error_result is not None:
+                line = child_line(child)
+                if line is not None:
+                    return step_at_line(steps, line)
+        match = ERROR_POSITION.search(getattr(error, 'message', str(error)))
+        if match:
+            return step_at_line(steps, int(match.group(1)))
+        return None
+
+    def step_jobs(self, job, steps):
+        """
+        Picks the child job of the last statement of each step
+        :return: List[bigquery.job.QueryJob]
+        """
+        by_step = {}
+        for child in self.children(job):
+            line = child_line(child)
+            step = step_at_line(steps, line) if line is not None else None
+            if step is not None:
+                by_step[step.index] = child
+        return [by_step.get(step.index, job) for step in steps]
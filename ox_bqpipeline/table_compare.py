@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compares two tables inside BigQuery with one query per pair.
+
+For every partition of each table the query computes the row count and, per
+column, the sum of FARM_FINGERPRINT over the JSON encoding of the value. Sums
+do not depend on row order, and casting to BIGNUMERIC keeps them from
+overflowing. A fingerprint over each whole row catches values that moved
+between rows while every column sum stayed the same.
+"""
+
+import collections
+
+ROW = '_row'
+
+TIME_TYPES = ('TIMESTAMP', 'DATETIME')
+
+
+def partition_expression(metadata):
+    """
+    :param metadata: metadata_cache.TableMetadata
+    :return: SQL expression of the table's partition, or None if the table is
+        not partitioned
+    """
+    field = metadata.partition_field
+    if field is None:
+        return None
+    if field == '_PARTITIONTIME':
+        return 'DATE(_PARTITIONTIME)'
+    types = dict(metadata.schema)
+    if types.get(field) in TIME_TYPES:
+        return 'DATE(`{}`)'.format(field)
+    return '`{}`'.format(field)
+
+
+def common_columns(a, b):
+    """
+    :param a: TableMetadata
+    :param b: TableMetadata
+    :return: (List[str] columns with the same type in both tables,
+        dict of column to (type in a, type in b) for the other columns)
+    """
+    types_a, types_b = dict(a.schema), dict(b.schema)
+    columns, mismatched = [], collections.OrderedDict()
+    for name, type_a in a.schema:
+        if types_b.get(name) == type_a:
+            columns.append(name)
+        else:
+            mismatched[name] = (type_a, types_b.get(name))
+    for name, type_b in b.schema:
+        if name not in types_a:
+            mismatched[name] = (None, type_b)
+    return columns, mismatched
+
+
+def fingerprint(expression):
+    return ('SUM(CAST(FARM_FINGERPRINT(TO_JSON_STRING({})) AS BIGNUMERIC))'
+            .format(expression))
+
+
+def build_compare_sql(a, b, columns, partitioned=True):
+    """
+    :param a: TableMetadata
+    :param b: TableMetadata
+    :param columns: List[str] columns to fingerprint
+    :param partitioned: group by partition when both tables are partitioned
+        on the same column
+    :return: str query returning one row per side and partition with columns
+        side, part, row_count, _row and c0..cN in the order of columns
+    """
+    part_a, part_b = partition_expression(a), partition_expression(b)
+    if not partitioned or part_a is None or part_a != part_b:
+        part_a = part_b = 'NULL'
+    selects = []
+    for side, metadata, part in (('a', a, part_a), ('b', b, part_b)):
+        fields = ['{!r} AS side'.format(side),
+                  'CAST({} AS STRING) AS part'.format(part),
+                  'COUNT(*) AS row_count',
+                  '{} AS {}'.format(fingerprint('STRUCT({})'.format(
+                      ', '.join('t.`{}`'.format(c) for c in columns))), ROW)
+                  if columns else 'NULL AS {}'.format(ROW)]
+        fields.extend('{} AS c{}'.format(fingerprint('t.`{}`'.format(c)), i)
+                      for i, c in enumerate(columns))
+        selects.append('SELECT\n  {}\nFROM `{}` AS t\nGROUP BY part'.format(
+            ',\n  '.join(fields), metadata.table_spec))
+    return '\nUNION ALL\n'.join(selects)
+
+
+class TableComparison():
+    """
+    Outcome of comparing two tables
+    """
+
+    def __init__(self, a, b, columns, mismatched_columns, rows):
+        """
+        :param a: str table spec
+        :param b: str table spec
+        :param columns: List[str] fingerprinted columns
+        :param mismatched_columns: dict of column to (type in a, type in b)
+        :param rows: result rows of build_compare_sql as dicts
+        """
+        self.a = a
+        self.b = b
+        self.columns = columns
+        self.mismatched_columns = mismatched_columns
+        sides = {'a': {}, 'b': {}}
+        for row in rows:
+            sides[row['side']][row['part']] = row
+        self.row_counts = tuple(sum(r['row_count'] for r in sides[s].values())
+                                for s in ('a', 'b'))
+        self.partitions = collections.OrderedDict()
+        self.columns_differing = collections.OrderedDict()
+        for part in sorted(set(sides['a']) | set(sides['b']),
+                           key=lambda p: (p is None, p)):
+            row_a, row_b = sides['a'].get(part), sides['b'].get(part)
+            if row_a is None or row_b is None:
+                self.partitions[part] = ['missing in {}'.format(
+                    self.b if row_b is None else self.a)]
+                continue
+            differences = []
+            if row_a['row_count'] != row_b['row_count']:
+                differences.append('row_count')
+            for i, column in enumerate(columns):
+                key = 'c{}'.format(i)
+                if row_a[key] != row_b[key]:
+                    differences.append(column)
+                    self.columns_differing.setdefault(column, []).append(part)
+            if not differences and row_a[ROW] != row_b[ROW]:
+                differences.append(ROW)
+            if differences:
+                self.partitions[part] = differences
+
+    @property
+    def equal(self):
+        return not self.partitions and not self.mismatched_columns
+
+    def __bool__(self):
+        return self.equal
+
+    def __repr__(self):
+        return 'TableComparison({!r}, {!r}, equal={})'.format(
+            self.a, self.b, self.equal)
+
+    def summary(self):
+        """
+        :return: str describing the differences
+        """
+        if self.equal:
+            return '`{}` and `{}` match ({} rows)'.format(
+                self.a, self.b, self.row_counts[0])
+        lines = ['`{}` ({} rows) and `{}` ({} rows) differ'.format(
+            self.a, self.row_counts[0], self.b, self.row_counts[1])]
+        for column, (type_a, type_b) in self.mismatched_columns.items():
+            lines.append('  column {}: {} vs {}'.format(column, type_a,
+                                                       type_b))
+        for part, differences in self.partitions.items():
+            lines.append('  partition {}: {}'.format(
+                'ALL' if part is None else part, ', '.join(differences)))
+        return '\n'.join(lines)
@@ -0,0 +1,472 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Batched, backpressured writes of Python rows into a BigQuery table.
+
+Rows are collected into batches by row count and age on the caller's thread
+and handed to a worker thread over a bounded queue, so a producer that
+outruns BigQuery blocks instead of growing memory. The worker serializes each
+batch and sends it, splitting batches that exceed the byte limit.
+
+AT_LEAST_ONCE streams rows with insertAll (`insert_rows_json`). Row ids are
+derived from the run id and row position, which lets BigQuery drop some
+duplicates from retries on a best-effort basis.
+
+EXACTLY_ONCE appends each batch with a load job whose job id is derived from
+the run id and batch position. A batch whose request failed before the job
+was created is retried, and a re-run batch is resubmitted, with the same job
+id. BigQuery refuses to run the same job id twice, and the writer waits on
+the existing job instead. A load job that ran and failed wrote nothing, so it
+is retried under the next job id of the batch. Re-running a writer with the
+same run_id and the same rows in the same order therefore never duplicates
+data. Batch boundaries must be reproducible for this, so EXACTLY_ONCE batches
+only by size, not by time. Load jobs count against a daily per-table quota,
+so EXACTLY_ONCE batches are much larger than insertAll batches.
+"""
+
+import base64
+import datetime
+import decimal
+import io
+import itertools
+import json
+import logging
+import queue
+import re
+import threading
+import time
+import uuid
+
+from google.api_core.exceptions import Conflict
+from google.cloud import bigquery
+
+from ox_bqpipeline.metadata_cache import table_spec_str
+
+AT_LEAST_ONCE = 'at_least_once'
+EXACTLY_ONCE = 'exactly_once'
+
+# insertAll request size limit is 10MB; leave room for the envelope.
+DEFAULT_BATCH_BYTES = 8 * 1024 * 1024
+
+# Defaults per mode. A table allows 1,500 load jobs a day, so EXACTLY_ONCE
+# sends far fewer, larger batches than AT_LEAST_ONCE.
+DEFAULT_BATCH_SIZE = {AT_LEAST_ONCE: 500, EXACTLY_ONCE: 100000}
+DEFAULT_MODE_BATCH_BYTES = {AT_LEAST_ONCE: DEFAULT_BATCH_BYTES,
+                            EXACTLY_ONCE: 100 * 1024 * 1024}
+
+_CLOSE = object()
+
+
+def json_default(value):
+    """
+    json.dumps fallback for BigQuery types
+    """
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode('ascii')
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def batch_rows(rows):
+    """
+    :param rows: a dict row, an iterable of dict rows, or a record batch with
+        `to_pylist` (pyarrow.RecordBatch, pyarrow.Table)
+    :return: iterator of dict rows, consuming an iterable lazily
+    """
+    if isinstance(rows, dict):
+        return iter([rows])
+    if hasattr(rows, 'to_pylist'):
+        return iter(rows.to_pylist())
+    return iter(rows)
+
+
+def split_by_bytes(lines, max_bytes):
+    """
+    :param lines: List[str] serialized rows
+    :return: List[Tuple[int,int]] (start, end) ranges at most max_bytes long,
+        each holding at least one row
+    """
+    ranges, start, size = [], 0, 0
+    for i, line in enumerate(lines):
+        length = len(line) + 1
+        if i > start and size + length > max_bytes:
+            ranges.append((start, i))
+            start, size = i, 0
+        size += length
+    if start < len(lines):
+        ranges.append((start, len(lines)))
+    return ranges
+
+
+class LoadJobFailed(Exception):
+    """
+    Raised when a load job ran and failed, as opposed to a request that
+    failed before or while waiting on the job
+    """
+
+    def __init__(self, job_id, error_result):
+        super(LoadJobFailed, self).__init__('Load job {} failed: {}'.format(
+            job_id, error_result))
+        self.job_id = job_id
+        self.error_result = error_result
+
+
+class BigQueryBackend():
+    """
+    Sends batches with a bigquery.Client
+    """
+
+    def __init__(self, client, location=None):
+        self.client = client
+        self.location = location
+
+    def insert(self, table, rows, row_ids):
+        """
+        Streams rows with insertAll
+        :raises: RuntimeError listing the rejected rows
+        """
+        errors = self.client.insert_rows_json(table, rows, row_ids=row_ids)
+        if errors:
+            raise RuntimeError('insertAll into {} rejected rows: {}'.format(
+                table, errors))
+
+    def load(self, table, data, job_id):
+        """
+        Appends newline delimited JSON with a load job with a fixed job id
+        :return: bigquery.job.LoadJob
+        :raises: LoadJobFailed if the job completed with an error
+        """
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND)
+        try:
+            job = self.client.load_table_from_file(
+                io.BytesIO(data), table, job_id=job_id,
+                location=self.location, job_config=job_config)
+        except Conflict:
+            # Loaded by an earlier attempt or run.
+            job = self.client.get_job(job_id, location=self.location)
+        try:
+            job.result()
+        except Exception as error:
+            if job.state == 'DONE' and job.error_result is not None:
+                raise LoadJobFailed(job_id, job.error_result) from error
+            raise
+        return job
+
+
+class FakeBackend():
+    """
+    In-memory backend for tests and throughput measurements. Keeps rows
+    unless keep_rows is False, and drops loads with a job id it has seen.
+    """
+
+    def __init__(self, latency=0.0, keep_rows=True, sleep=time.sleep):
+        """
+        :param latency: seconds each call takes, simulating the API
+        """
+        self.latency = latency
+        self.keep_rows = keep_rows
+        self.sleep = sleep
+        self.rows = []
+        self.row_count = 0
+        self.calls = 0
+        self.job_ids = set()
+        self._lock = threading.Lock()
+
+    def _call(self, rows):
+        if self.latency:
+            self.sleep(self.latency)
+        with self._lock:
+            self.calls += 1
+            self.row_count += len(rows)
+            if self.keep_rows:
+                self.rows.extend(rows)
+
+    def insert(self, table, rows, row_ids):
+        self._call(rows)
+
+    def load(self, table, data, job_id):
+        with self._lock:
+            if job_id in self.job_ids:
+                return
+            self.job_ids.add(job_id)
+        self._call([json.loads(line) for line in
+                    data.decode('utf-8').splitlines()])
+
+
+class TableWriter():
+    """
+    Context manager writing rows into one table.
+
+        with bqp.table_writer('dataset.table') as writer:
+            for row in rows:
+                writer.write(row)
+
+    Errors raised on the worker thread are re-raised by the next call to
+    write or by close.
+    """
+
+    def __init__(self, backend, table, mode=AT_LEAST_ONCE, batch_size=None,
+                 batch_bytes=None, flush_interval=1.0,
+                 max_in_flight=4, run_id=None, max_retries=3, retry_wait=1.0,
+                 on_close=None, clock=time.time, sleep=time.sleep):
+        """
+        :param backend: BigQueryBackend or FakeBackend
+        :param table: str table spec `project.dataset.table` or
+            TableReference
+        :param mode: AT_LEAST_ONCE or EXACTLY_ONCE
+        :param batch_size: rows per batch, defaults to DEFAULT_BATCH_SIZE of
+            the mode
+        :param batch_bytes: maximum serialized bytes per request, defaults to
+            DEFAULT_MODE_BATCH_BYTES of the mode
+        :param flush_interval: seconds after which a partial batch is sent,
+            in AT_LEAST_ONCE mode
+        :param max_in_flight: batches queued for the worker before write
+            blocks
+        :param run_id: identifies this write for row and job ids. Reuse it to
+            resume an EXACTLY_ONCE write without duplicates.
+        :param max_retries: attempts per request, and in EXACTLY_ONCE mode
+            load jobs per batch
+        :param retry_wait: seconds between attempts, doubled each time
+        :param on_close: (optional) callable run after the last batch
+        """
+        if mode not in (AT_LEAST_ONCE, EXACTLY_ONCE):
+            raise ValueError('mode must be {!r} or {!r}'.format(
+                AT_LEAST_ONCE, EXACTLY_ONCE))
+        self.logger = logging.getLogger(__name__)
+        self.backend = backend
+        self.table = table
+        self.table_spec = table_spec_str(table)
+        self.mode = mode
+        self.batch_size = batch_size or DEFAULT_BATCH_SIZE[mode]
+        self.batch_bytes = batch_bytes or DEFAULT_MODE_BATCH_BYTES[mode]
+        self.flush_interval = flush_interval
+        self.run_id = run_id or uuid.uuid4().hex
+        self.max_retries = max_retries
+        self.retry_wait = retry_wait
+        self.on_close = on_close
+        self.clock = clock
+        self.sleep = sleep
+        self.queue = queue.Queue(maxsize=max_in_flight)
+        self.buffer = []
+        self.buffer_started = None
+        self.batches = 0
+        self.rows_written = 0
+        self.error = None
+        self.started = None
+        self.finished = None
+        self.closed = False
+        self._lock = threading.Lock()
+        self.worker = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Send what was written so far without masking the error.
+            try:
+                self.close()
+            except Exception:
+                self.logger.exception('Failed to flush %s', self.table_spec)
+
+    def open(self):
+        self.started = self.clock()
+        self.worker = threading.Thread(target=self._work,
+                                       name='TableWriter-' + self.table_spec)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+        if self.closed:
+            raise ValueError('write to closed TableWriter')
+
+    def write(self, rows):
+        """
+        Adds rows, blocking while max_in_flight batches wait for the worker
+        :param rows: dict row, iterable of dict rows, or record batch
+        """
+        self._check()
+        if self.worker is None:
+            self.open()
+        rows = batch_rows(rows)
+        while True:
+            with self._lock:
+                room = self.batch_size - len(self.buffer)
+            # Only the producer adds rows, so room can only grow meanwhile.
+            chunk = list(itertools.islice(rows, room))
+            if not chunk:
+                return
+            with self._lock:
+                if not self.buffer:
+                    self.buffer_started = self.clock()
+                self.buffer.extend(chunk)
+                full = len(self.buffer) >= self.batch_size
+            if full:
+                self.flush()
+            if len(chunk) < room:
+                return
+
+    def flush(self):
+        """
+        Hands the buffered rows to the worker
+        """
+        with self._lock:
+            batch, self.buffer = self.buffer, []
+            if not batch:
+                return
+            sequence = self.batches
+            self.batches += 1
+        self._put((sequence, batch))
+
+    def _put(self, item):
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self.queue.put(item, timeout=self.flush_interval)
+                return
+            except queue.Full:
+                continue
+
+    def close(self):
+        """
+        Sends buffered rows, waits for the worker and raises its error
+        """
+        if self.closed:
+            return
+        if self.worker is not None:
+            try:
+                self.flush()
+            finally:
+                self.closed = True
+                if self.worker.is_alive():
+                    self.queue.put(_CLOSE)
+                self.worker.join()
+        self.closed = True
+        self.finished = self.clock()
+        if self.error is not None:
+            raise self.error
+        self.logger.info('Wrote %d rows in %d batches to %s (%.0f rows/s)',
+                         self.rows_written, self.batches, self.table_spec,
+                         self.rows_per_second())
+        if self.on_close is not None:
+            self.on_close()
+
+    def rows_per_second(self):
+        end = self.finished if self.finished is not None else self.clock()
+        elapsed = end - (self.started if self.started is not None else end)
+        return self.rows_written / elapsed if elapsed > 0 else 0.0
+
+    def _work(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self._flush_stale()
+                continue
+            if item is _CLOSE:
+                return
+            try:
+                self._send(*item)
+            except Exception as error:
+                self.logger.exception('Writing batch %d to %s failed',
+                                      item[0], self.table_spec)
+                self.error = error
+                # Unblock a producer waiting on a full queue.
+                while True:
+                    try:
+                        self.queue.get_nowait()
+                    except queue.Empty:
+                        return
+
+    def _flush_stale(self):
+        if self.mode == EXACTLY_ONCE:
+            return
+        with self._lock:
+            stale = (self.buffer and
+                     self.clock() - self.buffer_started >= self.flush_interval)
+        if stale:
+            # A queued item cannot be put from this thread without risking a
+            # deadlock on a full queue, so the stale batch is sent directly.
+            with self._lock:
+                batch, self.buffer = self.buffer, []
+                sequence = self.batches
+                self.batches += 1
+            if batch:
+                self._send(sequence, batch)
+
+    def _send(self, sequence, rows):
+        lines = [json.dumps(row, default=json_default, sort_keys=True)
+                 for row in rows]
+        for part, (start, end) in enumerate(split_by_bytes(lines,
+                                                           self.batch_bytes)):
+            self._retry(self._send_part, sequence, part, rows[start:end],
+                        lines[start:end], start)
+            self.rows_written += end - start
+
+    def _send_part(self, sequence, part, rows, lines, offset):
+        if self.mode == EXACTLY_ONCE:
+            base_id = '{}_{}_{:08d}_{:04d}'.format(
+                re.sub(r'[.:$]', '_', self.table_spec), self.run_id,
+                sequence, part)
+            data = ('\n'.join(lines) + '\n').encode('utf-8')
+            # A failed job cannot be rerun under its id, so later attempts
+            # walk a fixed sequence of ids that a re-run walks too.
+            for attempt in range(self.max_retries):
+                job_id = base_id if attempt == 0 else '{}_{}'.format(
+                    base_id, attempt)
+                try:
+                    self.backend.load(self.table, data, job_id)
+                    return
+                except LoadJobFailed:
+                    if attempt + 1 == self.max_retries:
+                        raise
+                    self.logger.warning('Load job %s failed, retrying batch '
+                                        '%d to %s', job_id, sequence,
+                                        self.table_spec, exc_info=True)
+        else:
+            row_ids = ['{}-{}-{}'.format(self.run_id, sequence, offset + i)
+                       for i in range(len(rows))]
+            self.backend.insert(self.table,
+                                [json.loads(line) for line in lines], row_ids)
+
+    def _retry(self, func, *args):
+        wait = self.retry_wait
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                return func(*args)
+            except LoadJobFailed:
+                # Already retried under new job ids.
+                raise
+            except Exception:
+                if attempt == self.max_retries:
+                    raise
+                self.logger.warning('Retrying batch %d to %s (attempt %d)',
+                                    args[0], self.table_spec, attempt,
+                                    exc_info=True)
+                self.sleep(wait)
+                wait *= 2
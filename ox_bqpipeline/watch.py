@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Watch mode: keeps a pipeline process running while SQL templates are edited
+and re-runs only the steps affected by a change.
+"""
+
+import logging
+import os
+import re
+import time
+
+from jinja2 import meta
+
+from ox_bqpipeline.metadata_cache import table_spec_str
+from ox_bqpipeline.run_context import PipelineCancelled
+
+
+def snapshot(directory):
+    """
+    :param directory: directory to scan recursively
+    :return: dict of absolute file path to modification time
+    """
+    mtimes = {}
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.abspath(os.path.join(root, name))
+            try:
+                mtimes[path] = os.stat(path).st_mtime
+            except OSError:
+                # Removed between listing and stat, e.g. an editor swap file.
+                continue
+    return mtimes
+
+
+def changed_files(before, after):
+    """
+    :return: set of paths added, removed or modified between two snapshots
+    """
+    return set(path for path in set(before) | set(after)
+               if before.get(path) != after.get(path))
+
+
+def reads_table(query, table_spec):
+    """
+    Checks whether rendered SQL references a table by its full
+    `project.dataset.table` or `dataset.table` name, quoted or not. Parts
+    missing from a partial table spec match any qualifier.
+    :param query: str rendered SQL
+    :param table_spec: str 'project.dataset.table', 'dataset.table' or
+        'table'
+    :return: bool
+    """
+    parts = table_spec.split('.')
+    project, dataset_id = ([None, None] + parts[:-1])[-2:]
+    if dataset_id is None:
+        dataset = r'(?:\w+`?\.`?)?'
+    else:
+        dataset = r'{}`?\.`?'.format(re.escape(dataset_id))
+    pattern = r'(?<![\w.-])`?(?:{}`?\.`?)?{}{}(?![\w])'.format(
+        r'[\w-]+' if project is None else re.escape(project), dataset,
+        re.escape(parts[-1]))
+    return re.search(pattern, query) is not None
+
+
+class PipelineWatcher():
+    """
+    Polls a template directory and re-runs changed steps and the steps
+    downstream of them, reusing the pipeline and its client between runs.
+
+    A step is re-run when its template or any template it includes changes,
+    or when it reads the destination table of an earlier re-run step. Steps
+    are listed in dependency order, so one pass finds all dependents.
+    """
+
+    def __init__(self, pipeline, steps, watch_dir, poll_interval=1.0,
+                 run_kwargs=None, template_kwargs=None, sleep=time.sleep):
+        """
+        :param pipeline: BQPipeline whose template_dirs include watch_dir
+        :param steps: run_queries steps
+        :param watch_dir: directory of SQL templates to watch
+        :param poll_interval: seconds between directory scans
+        :param run_kwargs: keyword arguments for run_query
+        :param template_kwargs: replacements for Jinja2 templates
+        :param sleep: callable used to wait between scans
+        """
+        self.logger = logging.getLogger(__name__)
+        self.pipeline = pipeline
+        self.steps = steps
+        self.watch_dir = os.path.abspath(watch_dir)
+        self.poll_interval = poll_interval
+        self.run_kwargs = run_kwargs or {}
+        self.template_kwargs = template_kwargs or {}
+        self.sleep = sleep
+        self.mtimes = {}
+
+    def template_path(self, name):
+        return os.path.abspath(os.path.join(self.watch_dir, name))
+
+    def dependencies(self, sql_path):
+        """
+        :param sql_path: path to a template
+        :return: set of absolute paths of the template and every template it
+            includes, imports or extends, transitively
+        """
+        pending, seen = [os.path.abspath(sql_path)], set()
+        while pending:
+            path = pending.pop()
+            if path in seen or not os.path.exists(path):
+                continue
+            seen.add(path)
+            with open(path) as template_file:
+                ast = self.pipeline.jinja2.parse(template_file.read())
+            for name in meta.find_referenced_templates(ast):
+                if name is not None:
+                    pending.append(self.template_path(name))
+        return seen
+
+    def dirty_steps(self, changed):
+        """
+        :param changed: set of absolute paths of changed files
+        :return: List[int] indexes of steps to re-run, in pipeline order
+        """
+        dirty, written = [], []
+        for index, query_details in enumerate(self.steps):
+            sql_path, destination, _, is_gcs_dest = \
+                self.pipeline.get_query_details(query_details)
+            rerun = bool(self.dependencies(sql_path) & changed)
+            if not rerun and written:
+                query = self.pipeline.render_query(sql_path,
+                                                   **self.template_kwargs)
+                rerun = any(reads_table(query, table) for table in written)
+            if rerun:
+                dirty.append(index)
+                if destination is not None and not is_gcs_dest:
+                    written.append(table_spec_str(
+                        self.pipeline.resolve_table_spec(destination)))
+        return dirty
+
+    def run_steps(self, indexes):
+        """
+        Runs steps in order, stopping at the first failure
+        :return: List[bigquery.job.QueryJob]
+        """
+        jobs = []
+        for index in indexes:
+            jobs.append(self.pipeline.run_query(self.steps[index],
+                                                **dict(self.run_kwargs,
+                                                       **self.template_kwargs)))
+        return jobs
+
+    def poll(self):
+        """
+        Scans the watch directory once and re-runs affected steps
+        :return: List[int] indexes of steps that were re-run
+        """
+        current = snapshot(self.watch_dir)
+        changed = changed_files(self.mtimes, current)
+        self.mtimes = current
+        if not changed:
+            return []
+        self.logger.info('Changed: %s', ', '.join(
+            os.path.relpath(path, self.watch_dir) for path in sorted(changed)))
+        dirty = self.dirty_steps(changed)
+        if dirty:
+            self.logger.info('Re-running %d of %d steps', len(dirty),
+                             len(self.steps))
+            self.run_steps(dirty)
+        return dirty
+
+    def watch(self, iterations=None, initial_run=True):
+        """
+        Runs the pipeline, then re-runs affected steps on every change until
+        interrupted. Failures are logged and watching continues.
+        :param iterations: (optional) number of scans before returning
+        :param initial_run: run every step before watching
+        """
+        self.mtimes = snapshot(self.watch_dir)
+        if initial_run:
+            self.run_guarded(lambda: self.run_steps(range(len(self.steps))))
+        self.logger.info('Watching %s for changes', self.watch_dir)
+        count = 0
+        while iterations is None or count < iterations:
+            self.sleep(self.poll_interval)
+            self.run_guarded(self.poll)
+            count += 1
+
+    def run_guarded(self, run):
+        """
+        Calls run, logging failures other than cancellation
+        """
+        try:
+            run()
+        except PipelineCancelled:
+            raise
+        except Exception:
+            self.logger.exception('Watched run failed, waiting for the '
+                                  'next change')
@@ -28,15 +28,21 @@ release_status = 'Development Status :: 3 - Alpha'
 dependencies = [
     'google-cloud>=0.34.0',
     'google-api-python-client>=1.7.8',
-    'google-cloud-bigquery>=1.9.0',
+    'google-cloud-bigquery>=1.28.0',
     'Jinja2>=2.10',
     'j2cli>=0.3.8',
     'sqlparse>=0.3.0',
     'pylint>=1.9.4',
-    'google-cloud-bigquery >= 1.9.0',
+    'google-cloud-bigquery >= 1.28.0',
     'Jinja2 >= 2.10'
 ]
-extras = {}
+extras = {
+    'local_export': [
+        'google-cloud-bigquery-storage>=2.0.0',
+        'pyarrow>=1.0.0',
+        'fastavro>=0.21.0',
+    ],
+}
 
 
 # Setup boilerplate below this line.
@@ -65,9 +71,6 @@ setuptools.setup(
         'License :: OSI Approved :: Apache Software License',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
         'Operating System :: OS Independent',
         'Topic :: Internet',
@@ -76,7 +79,7 @@ setuptools.setup(
     packages=['ox_bqpipeline'],
     install_requires=dependencies,
     extras_require=extras,
-    python_requires='>=3.4',
+    python_requires='>=3.7',
     include_package_data=True,
     zip_safe=False,
 )
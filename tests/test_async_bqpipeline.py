@@ -0,0 +1,221 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import concurrent.futures
+import itertools
+import mock
+import threading
+import unittest
+
+from google.api_core.exceptions import BadRequest
+from google.cloud import bigquery
+
+from ox_bqpipeline import async_bqpipeline
+from ox_bqpipeline.async_bqpipeline import AsyncBQPipeline
+
+
+class FakeJob():
+    def __init__(self, job_id, reloads=2, error=None):
+        self.job_id = job_id
+        self.location = None
+        self.destination = bigquery.TableReference.from_string('p.d.result')
+        self.state = 'RUNNING'
+        self.error_result = None
+        self.reloads = reloads
+        self.error = error
+
+    def reload(self):
+        self.reloads -= 1
+        if self.reloads <= 0:
+            self.state = 'DONE'
+            if self.error is not None:
+                self.error_result = {'message': str(self.error)}
+
+    def result(self, timeout=None):
+        if self.error is not None:
+            raise self.error
+
+
+class FakeClient():
+    def __init__(self, reloads=2, error=None):
+        self.ids = itertools.count()
+        self.jobs = {}
+        self.reloads = reloads
+        self.error = error
+        self.project = 'p'
+        self.deleted = []
+        self.updated = []
+
+    def _job(self):
+        job = FakeJob('job-{}'.format(next(self.ids)), self.reloads,
+                      self.error)
+        self.jobs[job.job_id] = job
+        return job
+
+    def query(self, query, job_config=None, job_id_prefix=None):
+        job = self._job()
+        job.query = query
+        job.job_config = job_config
+        return job
+
+    def copy_table(self, sources, destination, **kwargs):
+        return self._job()
+
+    def extract_table(self, src, gcs_path, job_config=None):
+        return self._job()
+
+    def get_job(self, job_id, location=None):
+        return self.jobs[job_id]
+
+    def delete_table(self, table, not_found_ok=False):
+        self.deleted.append(table)
+
+    def update_table(self, table, fields):
+        self.updated.append((table.table_id, table.expires, fields))
+
+
+class TestAsyncBQPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def pipeline(self, client, **kwargs):
+        bqp = AsyncBQPipeline('testjob', poll_interval=0,
+                              default_project='p', default_dataset='d',
+                              **kwargs)
+        bqp.bq = client
+        return bqp
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_run_query_matches_sync_config(self):
+        client = FakeClient()
+        bqp = self.pipeline(client)
+        job = self.run_async(bqp.run_query(
+            ('./tests/sql/select_query1.sql', 'result', {'a': 1, 'b': 'one'}),
+            batch=True))
+        self.assertEqual(job.state, 'DONE')
+        self.assertEqual(job.reloads, 0)
+        self.assertEqual(job.job_config.to_api_repr(),
+                         bqp.create_job_config(
+                             batch=True, dest='result',
+                             query_params={'a': 1, 'b': 'one'}).to_api_repr())
+
+    def test_run_query_gcs_export(self):
+        client = FakeClient()
+        bqp = self.pipeline(client)
+        self.run_async(bqp.run_query(('./tests/sql/select_query3.sql',
+                                      'gs://bucket/path')))
+        self.assertEqual(len(client.jobs), 2)
+        self.assertTrue(all(j.state == 'DONE' for j in client.jobs.values()))
+
+    def test_failed_job_raises(self):
+        bqp = self.pipeline(FakeClient(error=BadRequest('bad query')))
+        with self.assertRaises(BadRequest):
+            self.run_async(bqp.run_query('./tests/sql/select_query3.sql'))
+
+    def test_timeout(self):
+        bqp = self.pipeline(FakeClient(reloads=10 ** 6))
+        bqp.poll_interval = 0.01
+        with self.assertRaises(concurrent.futures.TimeoutError):
+            self.run_async(bqp.copy_table('a', 'b', timeout=0.05))
+
+    def test_delete_tables(self):
+        client = FakeClient()
+        bqp = self.pipeline(client)
+        self.run_async(bqp.delete_tables(['a', 'd.b']))
+        self.assertEqual(sorted(client.deleted), ['p.d.a', 'p.d.b'])
+
+    def test_unsupported_options_raise(self):
+        bqp = self.pipeline(FakeClient())
+        for kwargs in ({'deadline': 60}, {'script': True},
+                       {'concurrency': mock.Mock()}):
+            with self.assertRaises(ValueError):
+                self.run_async(bqp.run_queries(
+                    ['./tests/sql/select_query3.sql'], **kwargs))
+        with self.assertRaises(ValueError):
+            self.run_async(bqp.run_query('./tests/sql/select_query3.sql',
+                                         scheduler=mock.Mock()))
+
+    def test_intermediate_tables(self):
+        client = FakeClient()
+        bqp = self.pipeline(client)
+        self.run_async(bqp.run_queries(
+            [('./tests/sql/select_query3.sql', 'tmp'),
+             ('./tests/sql/select_query3.sql', 'result')],
+            intermediate=['tmp']))
+        self.assertEqual([(table, fields) for table, expires, fields
+                          in client.updated], [('tmp', ['expires'])])
+        self.assertIsNotNone(client.updated[0][1])
+        self.assertEqual(client.deleted, ['p.d.tmp'])
+        self.assertEqual(bqp.intermediate_tables, {})
+
+    def test_intermediate_dropped_on_failure(self):
+        client = FakeClient(error=BadRequest('bad query'))
+        bqp = self.pipeline(client)
+        with self.assertRaises(BadRequest):
+            self.run_async(bqp.run_queries(
+                [('./tests/sql/select_query3.sql', 'tmp')],
+                intermediate=['tmp']))
+        self.assertEqual(client.deleted, ['p.d.tmp'])
+
+    def test_run_queries_prerender_and_compact(self):
+        client = FakeClient()
+        bqp = self.pipeline(client)
+        with mock.patch.object(bqp, 'render_query',
+                               wraps=bqp.render_query) as render, \
+                mock.patch.object(async_bqpipeline.JobRecord,
+                                  'from_job') as from_job:
+            jobs = self.run_async(bqp.run_queries(
+                ['./tests/sql/select_query3.sql'], prerender=True,
+                check_tables=False, compact=True))
+        render.assert_not_called()
+        self.assertEqual(jobs, [from_job.return_value])
+        self.assertEqual(from_job.call_args[0][0].job_id, 'job-0')
+        self.assertEqual(client.jobs['job-0'].query,
+                         bqp.render_query('./tests/sql/select_query3.sql'))
+
+    def test_run_query_renders_off_the_loop(self):
+        bqp = self.pipeline(FakeClient())
+        threads = []
+
+        def render_query(sql_path, **kwargs):
+            threads.append(threading.current_thread())
+            return 'SELECT 1'
+
+        bqp.render_query = render_query
+        self.run_async(bqp.run_query('./tests/sql/select_query3.sql'))
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+
+    def test_many_pipelines_share_small_executor(self):
+        executor = concurrent.futures.ThreadPoolExecutor(4)
+        pipelines = [self.pipeline(FakeClient(reloads=3), executor=executor)
+                     for _ in range(500)]
+
+        async def run_all():
+            return await asyncio.gather(*[
+                bqp.run_queries(['./tests/sql/select_query3.sql'] * 2)
+                for bqp in pipelines])
+
+        results = self.run_async(run_all())
+        executor.shutdown()
+        self.assertEqual(len(results), 500)
+        self.assertTrue(all(j.state == 'DONE' for jobs in results
+                            for j in jobs))
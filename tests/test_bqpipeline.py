@@ -292,3 +292,121 @@ class TestLogging(unittest.TestCase):
         cloud_logger = [(h for h in logger.handlers if type(h._name) == str and
                          socket.gethostname() in h._name)]
         self.assertEqual(len(cloud_logger), 1)
+
+
+class TestLocationRouting(unittest.TestCase):
+
+    def setUp(self):
+        self.bqp = bqpipeline.BQPipeline(
+            job_name='testjob', default_project='p', default_dataset='us_data',
+            auto_location=True)
+        self.bqp.bq = mock.Mock(project='p')
+        locations = {'p.us_data': 'US', 'p.eu_data': 'EU',
+                     'p.tokyo_data': 'asia-northeast1'}
+        self.bqp.bq.get_dataset.side_effect = \
+            lambda spec: mock.Mock(location=locations[spec])
+        self.regional = {}
+
+        def regional_client(project, location):
+            self.assertEqual(project, 'p')
+            return self.regional.setdefault(location, mock.Mock())
+
+        patcher = mock.patch.object(bqpipeline.bigquery, 'Client',
+                                    side_effect=regional_client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_dataset_location_is_cached(self):
+        self.assertEqual(self.bqp.get_table_location('eu_data.t'), 'EU')
+        self.assertEqual(self.bqp.get_table_location('p.eu_data.u'), 'EU')
+        self.assertEqual(self.bqp.bq.get_dataset.call_count, 1)
+
+    def test_query_location(self):
+        self.assertEqual(self.bqp.get_query_location(
+            'SELECT 1', destination='tokyo_data.t'), 'asia-northeast1')
+        self.assertEqual(self.bqp.get_query_location(
+            'SELECT * FROM `p.eu_data.t`', destination='gs://b/p'), 'EU')
+        self.assertEqual(self.bqp.get_query_location('SELECT 1'), 'US')
+
+    def test_clients_per_location(self):
+        self.bqp.submit_query('SELECT 1', destination='eu_data.t')
+        self.bqp.submit_query('SELECT 2', destination='eu_data.u')
+        self.bqp.submit_query('SELECT 3', destination='t')
+        self.assertEqual(list(self.regional), ['EU'])
+        self.assertEqual(self.regional['EU'].query.call_count, 2)
+        self.assertEqual(self.bqp.bq.query.call_count, 1)
+
+        self.bqp.start_copy_table(bqpipeline.to_tableref('p.eu_data.t'),
+                                  bqpipeline.to_tableref('p.eu_data.u'))
+        self.regional['EU'].copy_table.assert_called_once()
+
+    def test_clients_from_json_credentials(self):
+        bqp = bqpipeline.BQPipeline(job_name='testjob',
+                                    json_credentials_path='key.json')
+        with mock.patch.object(bqpipeline.bigquery.Client,
+                               'from_service_account_json') as from_json:
+            from_json.return_value.project = 'keyproject'
+            bqp.get_client()
+            bqp.get_client('EU')
+        self.assertEqual(from_json.call_args_list, [
+            mock.call('key.json', project=None, location='US'),
+            mock.call('key.json', project='keyproject', location='EU')])
+        self.assertEqual(bqp.default_project, 'keyproject')
+
+    def test_run_queries_by_location_keeps_order(self):
+        steps = [('./tests/sql/select_query3.sql', 'eu_data.a'),
+                 ('./tests/sql/select_query3.sql', 'us_data.b'),
+                 ('./tests/sql/select_query3.sql', 'eu_data.c')]
+        with mock.patch.object(bqpipeline.BQPipeline, 'run_query',
+                               side_effect=lambda path, **kw: path[1]):
+            with mock.patch.object(bqpipeline.concurrent.futures,
+                                   'ThreadPoolExecutor',
+                                   wraps=bqpipeline.concurrent.futures
+                                   .ThreadPoolExecutor) as pool:
+                jobs = self.bqp.run_queries(steps)
+        self.assertEqual(jobs, ['eu_data.a', 'us_data.b', 'eu_data.c'])
+        pool.assert_called_once_with(2)
+
+
+class TestIntermediateTables(unittest.TestCase):
+
+    def setUp(self):
+        self.bqp = bqpipeline.BQPipeline(
+            job_name='testjob', default_project='p', default_dataset='d',
+            intermediate_ttl=3600)
+        self.bqp.bq = mock.Mock(project='p')
+
+    def test_run_query_sets_expiration(self):
+        self.bqp.run_query(('./tests/sql/select_query3.sql', 'tmp'),
+                           intermediate=True)
+        self.assertEqual(list(self.bqp.intermediate_tables), ['p.d.tmp'])
+        table, fields = self.bqp.bq.update_table.call_args[0]
+        self.assertEqual(table.table_id, 'tmp')
+        self.assertEqual(fields, ['expires'])
+        self.assertIsNotNone(table.expires)
+
+    def test_run_queries_drops_intermediates(self):
+        steps = [('./tests/sql/select_query3.sql', 'tmp'),
+                 ('./tests/sql/select_query3.sql', 'final')]
+        self.bqp.run_queries(steps, intermediate=['tmp'])
+        self.bqp.bq.delete_table.assert_called_once_with('p.d.tmp',
+                                                         not_found_ok=True)
+        self.assertEqual(self.bqp.bq.update_table.call_count, 1)
+        self.assertEqual(list(self.bqp.intermediate_tables), [])
+
+    def test_cleanup_on_failure(self):
+        steps = [('./tests/sql/select_query3.sql', 'tmp1'),
+                 ('./tests/sql/select_query3.sql', 'tmp2')]
+        self.bqp.bq.query.side_effect = [mock.Mock(), ValueError('failed')]
+        with self.assertRaises(ValueError):
+            self.bqp.run_queries(steps, intermediate=['tmp1', 'd.tmp2'])
+        dropped = sorted(c[0][0] for c in
+                         self.bqp.bq.delete_table.call_args_list)
+        self.assertEqual(dropped, ['p.d.tmp1', 'p.d.tmp2'])
+
+    def test_drop_errors_are_logged(self):
+        self.bqp.mark_intermediate('a')
+        self.bqp.mark_intermediate('b')
+        self.bqp.bq.delete_table.side_effect = \
+            lambda table, not_found_ok: table == 'p.d.a' and 1 / 0
+        self.assertEqual(self.bqp.drop_intermediate_tables(), ['p.d.b'])
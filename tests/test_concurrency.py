@@ -0,0 +1,131 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import itertools
+import mock
+import threading
+import unittest
+
+from google.api_core.exceptions import BadRequest, Forbidden, TooManyRequests
+
+from ox_bqpipeline import bqpipeline
+from ox_bqpipeline.concurrency import AdaptiveConcurrency, \
+    is_concurrency_error, queue_seconds
+
+CREATED = datetime.datetime(2019, 7, 1)
+
+
+class FakeJob():
+    def __init__(self, queued=0.0):
+        self.created = CREATED
+        self.started = CREATED + datetime.timedelta(seconds=queued)
+
+
+def controller(**kwargs):
+    clock = itertools.count()
+    return AdaptiveConcurrency(clock=lambda: next(clock),
+                               sleep=lambda _: None, **kwargs)
+
+
+class TestAdaptiveConcurrency(unittest.TestCase):
+
+    def test_is_concurrency_error(self):
+        self.assertTrue(is_concurrency_error(TooManyRequests('slow down')))
+        self.assertTrue(is_concurrency_error(Forbidden(
+            'Exceeded rate limits: too many concurrent queries',
+            errors=[{'reason': 'rateLimitExceeded'}])))
+        self.assertFalse(is_concurrency_error(BadRequest('syntax error')))
+        self.assertFalse(is_concurrency_error(ValueError()))
+
+    def test_queue_seconds(self):
+        self.assertEqual(queue_seconds(FakeJob(7)), 7.0)
+        self.assertIsNone(queue_seconds(mock.Mock(started=None)))
+
+    def test_additive_increase(self):
+        concurrency = controller(initial=2, maximum=8)
+        results = concurrency.map(lambda i: FakeJob(), range(20))
+        self.assertEqual(len(results), 20)
+        self.assertGreater(concurrency.in_flight_limit, 2)
+        self.assertLessEqual(concurrency.in_flight_limit, 8)
+        limits = [limit for _, limit, _ in concurrency.history]
+        self.assertEqual(limits, sorted(limits))
+
+    def test_multiplicative_decrease_on_queueing(self):
+        concurrency = controller(initial=8, target_queue_seconds=10)
+        concurrency.map(lambda i: FakeJob(queued=60), range(8))
+        # All eight jobs were submitted before the first decrease.
+        self.assertEqual(concurrency.in_flight_limit, 4)
+        self.assertEqual(concurrency.history[-1][2], 'queued 60.0s')
+
+    def test_limit_bounds_jobs_in_flight(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+        concurrency = controller(initial=3, maximum=3)
+
+        def work(i):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            with lock:
+                state['running'] -= 1
+            return FakeJob()
+
+        concurrency.map(work, range(50))
+        self.assertLessEqual(state['peak'], 3)
+
+    def test_retries_concurrency_errors(self):
+        attempts = {}
+
+        def work(i):
+            attempts[i] = attempts.get(i, 0) + 1
+            if i == 1 and attempts[i] < 3:
+                raise TooManyRequests('too many concurrent queries')
+            return FakeJob()
+
+        concurrency = controller(initial=4)
+        self.assertEqual(len(concurrency.map(work, range(4))), 4)
+        self.assertEqual(attempts[1], 3)
+        self.assertEqual(concurrency.limit_errors, 2)
+        self.assertLess(concurrency.in_flight_limit, 4)
+
+    def test_other_errors_raise(self):
+        def work(i):
+            raise BadRequest('syntax error')
+
+        with self.assertRaises(BadRequest):
+            controller().map(work, range(3))
+
+    def test_retries_exhausted(self):
+        def work(i):
+            raise TooManyRequests('too many concurrent queries')
+
+        with self.assertRaises(TooManyRequests):
+            controller(max_retries=2).map(work, range(1))
+
+    def test_copy_tables(self):
+        bqp = bqpipeline.BQPipeline(job_name='testjob', default_project='p',
+                                    default_dataset='d')
+        job = mock.Mock(created=CREATED, started=CREATED)
+        with mock.patch.object(bqp, 'start_copy_table',
+                               return_value=job) as start, \
+                mock.patch.object(bqp, 'refresh_job', side_effect=lambda j: j):
+            jobs = bqp.copy_tables([('a', 'b'), ('c', 'e.f')],
+                                   concurrency=controller())
+        self.assertEqual(jobs, [job, job])
+        start.assert_any_call('p.d.c', 'p.e.f', overwrite=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from google.cloud import bigquery
+
+from ox_bqpipeline import bqpipeline
+from ox_bqpipeline.async_bqpipeline import AsyncBQPipeline
+from ox_bqpipeline.concurrency import AdaptiveConcurrency
+from ox_bqpipeline.consolidate import COPY, ConsolidationError, \
+    ShardConsolidator, find_shards
+from ox_bqpipeline.metadata_cache import TableMetadata
+
+DATES = ['20190701', '20190702', '20190703']
+
+
+def shard(table_id, num_rows=10):
+    return TableMetadata('p.d.' + table_id, schema=[('id', 'INT64')],
+                         num_rows=num_rows)
+
+
+class TestConsolidate(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.dir, 'state.json')
+        self.tables = [shard('events_' + date) for date in DATES] + [
+            shard('events_latest'), shard('other_20190701')]
+        self.partitions = {date: 10 for date in DATES}
+        self.bqp = self.pipeline(bqpipeline.BQPipeline)
+
+    def pipeline(self, cls):
+        bqp = cls(job_name='testjob', default_project='p',
+                  default_dataset='d')
+        bqp.bq = mock.Mock(project='p')
+        bqp.bq.get_table.return_value.schema = [
+            bigquery.SchemaField('id', 'INT64')]
+        bqp.bq.query.side_effect = lambda *args, **kwargs: mock.Mock(
+            result=lambda: [{'partition_id': k, 'total_rows': v}
+                            for k, v in self.partitions.items()])
+        for name, value in (('prefetch_table_metadata',
+                             lambda dataset: self.tables),
+                            ('refresh_job', lambda job: job)):
+            patcher = mock.patch.object(bqp, name, side_effect=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return bqp
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def job(self):
+        return mock.Mock(job_id='j', created=None, started=None)
+
+    def consolidate(self, **kwargs):
+        with mock.patch.object(self.bqp, 'start_copy_table',
+                               return_value=self.job()) as copy:
+            summary = self.bqp.consolidate_shards(
+                'events_', 'events', state_file=self.state_file,
+                concurrency=AdaptiveConcurrency(sleep=lambda _: None),
+                **kwargs)
+        return summary, copy
+
+    def test_find_shards(self):
+        self.assertEqual(list(find_shards(self.tables, 'events_')), DATES)
+
+    def test_copy_shards_into_partitions(self):
+        summary, copy = self.consolidate(clustering_fields=['id'])
+        self.assertEqual(sorted(c[0][1] for c in copy.call_args_list),
+                         ['p.d.events$' + date for date in DATES])
+        table = self.bqp.bq.create_table.call_args[0][0]
+        self.assertIsNone(table.time_partitioning.field)
+        self.assertEqual(table.clustering_fields, ['id'])
+        self.assertEqual(summary['migrated'], 3)
+        self.assertEqual(summary['rows'], 30)
+        with open(self.state_file) as state_file:
+            state = json.load(state_file)['shards']
+        self.assertEqual(set(s['status'] for s in state.values()),
+                         {'verified'})
+
+    def test_resume_skips_done_shards(self):
+        with open(self.state_file, 'w') as state_file:
+            json.dump({'shards': {'20190701': {'status': 'copied'}}},
+                      state_file)
+        summary, copy = self.consolidate()
+        self.assertEqual(copy.call_count, 2)
+        self.assertEqual(summary['skipped'], 1)
+
+    def test_row_count_mismatch(self):
+        self.partitions['20190702'] = 7
+        with self.assertRaises(ConsolidationError) as raised:
+            self.consolidate(delete_shards=True)
+        self.assertEqual(raised.exception.mismatches, {'20190702': (10, 7)})
+        self.bqp.bq.delete_table.assert_not_called()
+
+    def test_delete_verified_shards(self):
+        summary, _ = self.consolidate(delete_shards=True)
+        self.assertEqual(sorted(summary['deleted']),
+                         ['p.d.events_' + date for date in DATES])
+        self.assertEqual(self.bqp.bq.delete_table.call_count, 3)
+
+    def test_delete_shards_of_async_pipeline(self):
+        self.bqp = self.pipeline(AsyncBQPipeline)
+        summary, _ = self.consolidate(delete_shards=True)
+        self.assertEqual(len(summary['deleted']), 3)
+        self.assertEqual(self.bqp.bq.delete_table.call_count, 3)
+
+    def test_query_mode_derives_partition_column(self):
+        with mock.patch.object(self.bqp, 'submit_query',
+                               return_value=self.job()) as submit:
+            self.bqp.consolidate_shards(
+                'd.events_', 'events', partition_field='day',
+                concurrency=AdaptiveConcurrency(sleep=lambda _: None))
+        query = [c for c in submit.call_args_list
+                 if c[1]['destination'] == 'p.d.events$20190701'][0][0][0]
+        self.assertEqual(query, "SELECT *, PARSE_DATE('%Y%m%d', '20190701') "
+                                'AS `day` FROM `p.d.events_20190701`')
+        table = self.bqp.bq.create_table.call_args[0][0]
+        self.assertEqual(table.time_partitioning.field, 'day')
+        self.assertEqual([f.name for f in table.schema], ['id', 'day'])
+
+    def test_copy_mode_needs_ingestion_time(self):
+        with self.assertRaises(ValueError):
+            ShardConsolidator(self.bqp, 'p.d.events_', 'p.d.events',
+                              partition_field='day', mode=COPY)
+
+
+if __name__ == '__main__':
+    unittest.main()
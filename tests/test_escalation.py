@@ -0,0 +1,194 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import mock
+import unittest
+
+from ox_bqpipeline import bqpipeline
+from ox_bqpipeline import escalation
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeJob():
+    """Job that stays PENDING for `queued` seconds of the fake clock."""
+
+    def __init__(self, job_id, clock, queued, runtime=30):
+        self.job_id = job_id
+        self.clock = clock
+        self.start_at = clock() + queued
+        self.runtime = runtime
+        self.state = 'PENDING'
+        self.error_result = None
+        self.started = None
+        self.ended = None
+        self.total_bytes_billed = 10 * 1024 ** 2
+        self.slot_millis = 5000
+
+    def reload(self):
+        if self.state == 'PENDING' and self.clock() >= self.start_at:
+            self.state = 'RUNNING'
+
+    def cancel(self):
+        self.state = 'DONE'
+        self.error_result = {'reason': 'stopped'}
+
+    def result(self, timeout=None):
+        start = max(self.clock(), self.start_at)
+        self.started = datetime.datetime.fromtimestamp(start)
+        self.ended = self.started + datetime.timedelta(seconds=self.runtime)
+        self.clock.now = start + self.runtime
+        self.state = 'DONE'
+
+
+class TestDeadlineScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.submitted = []
+        self.pipeline = mock.Mock()
+        self.pipeline.submit_query.side_effect = self.submit
+
+    def submit(self, query, batch=False, **kwargs):
+        queued = 3600 if batch else 0
+        job = FakeJob('job-{}'.format(len(self.submitted)), self.clock,
+                      queued=queued)
+        self.submitted.append((job, batch))
+        return job
+
+    def scheduler(self, deadline, steps):
+        return escalation.DeadlineScheduler(
+            self.pipeline, deadline, steps=steps, step_estimate=60,
+            poll_interval=10, clock=self.clock, sleep=self.clock.sleep)
+
+    def test_no_escalation_with_slack(self):
+        scheduler = self.scheduler(deadline=10 * 3600, steps=2)
+        job = scheduler.run_step('q1.sql', 'SELECT 1')
+        self.assertEqual([b for _, b in self.submitted], [True])
+        self.assertEqual(job.job_id, 'job-0')
+        self.assertEqual(scheduler.escalations, [])
+        self.assertEqual(scheduler.durations, [30])
+
+    def test_escalates_when_deadline_at_risk(self):
+        # 3 steps of 60s estimated leaves 120s to wait in the queue.
+        scheduler = self.scheduler(deadline=300, steps=3)
+        job = scheduler.run_step('q1.sql', 'SELECT 1', destination='t1')
+        self.assertEqual([b for _, b in self.submitted], [True, False])
+        self.assertEqual(job.job_id, 'job-1')
+        self.assertEqual(len(scheduler.escalations), 1)
+        record = scheduler.escalations[0]
+        self.assertEqual(record.batch_job_id, 'job-0')
+        self.assertEqual(record.interactive_job_id, 'job-1')
+        self.assertGreaterEqual(record.queued_seconds, 120)
+        self.assertEqual(record.bytes_billed, 10 * 1024 ** 2)
+        self.assertEqual(self.pipeline.submit_query.call_args[1]['destination'],
+                         't1')
+        self.assertEqual(scheduler.summary()['escalations'], 1)
+
+    def test_interactive_when_deadline_already_at_risk(self):
+        scheduler = self.scheduler(deadline=100, steps=3)
+        job = scheduler.run_step('q1.sql', 'SELECT 1')
+        self.assertEqual([b for _, b in self.submitted], [False])
+        record, = scheduler.escalations
+        self.assertIsNone(record.batch_job_id)
+        self.assertEqual(record.interactive_job_id, job.job_id)
+        self.assertEqual(record.queued_seconds, 0)
+        self.assertEqual(record.projected_overrun, 80)
+        self.assertEqual(record.slot_millis, 5000)
+
+    def test_remaining_estimate_uses_observed_runtime(self):
+        scheduler = self.scheduler(deadline=10 * 3600, steps=3)
+        self.assertEqual(scheduler.estimate_remaining(), 180)
+        scheduler.run_step('q1.sql', 'SELECT 1')
+        self.assertEqual(scheduler.estimate_remaining(), 60)
+
+    def test_completed_job_is_not_resubmitted(self):
+        scheduler = self.scheduler(deadline=90, steps=1)
+        job = FakeJob('job-0', self.clock, queued=3600)
+        job.cancel = lambda: setattr(job, 'state', 'DONE')
+        self.pipeline.submit_query.side_effect = [job]
+        scheduler.run_step('q1.sql', 'SELECT 1')
+        self.assertEqual(self.pipeline.submit_query.call_count, 1)
+        self.assertEqual(scheduler.escalations, [])
+
+    def test_stuck_cancel_is_bounded(self):
+        scheduler = self.scheduler(deadline=90, steps=1)
+        job = FakeJob('job-0', self.clock, queued=3600)
+        job.cancel = lambda: None
+        self.pipeline.submit_query.side_effect = [job]
+        start = self.clock()
+        self.assertIs(scheduler.run_step('q1.sql', 'SELECT 1'), job)
+        self.assertEqual(self.pipeline.submit_query.call_count, 1)
+        self.assertEqual(scheduler.escalations, [])
+        # Gave up after cancel_timeout, then waited for the job itself.
+        self.assertLess(self.clock() - start, 3600 + 60)
+
+    def test_summarize_escalations(self):
+        records = [escalation.EscalationRecord('a.sql', 'b1', 'i1', 10, 5),
+                   escalation.EscalationRecord('b.sql', 'b2', 'i2', 20, 5)]
+        records[0].bytes_billed = 100
+        summary = escalation.summarize_escalations(records)
+        self.assertEqual(summary, {'escalations': 2, 'queued_seconds': 30,
+                                   'bytes_billed': 100, 'slot_millis': 0})
+
+    def test_to_epoch(self):
+        dt = datetime.datetime(2019, 7, 1, tzinfo=datetime.timezone.utc)
+        self.assertEqual(escalation.to_epoch(dt), dt.timestamp())
+        self.assertEqual(escalation.to_epoch(60, clock=lambda: 100), 160)
+
+
+class TestRunQueriesDeadline(unittest.TestCase):
+
+    def test_run_queries_passes_scheduler(self):
+        bqp = bqpipeline.BQPipeline(
+            job_name='testjob', default_project='testproject',
+            default_dataset='testdataset')
+        with mock.patch.object(bqpipeline.BQPipeline, 'run_query') as run:
+            bqp.run_queries(['a.sql', 'b.sql'], deadline=3600)
+            schedulers = {c[1]['scheduler'] for c in run.call_args_list}
+        self.assertEqual(len(schedulers), 1)
+        scheduler = schedulers.pop()
+        self.assertIsInstance(scheduler, escalation.DeadlineScheduler)
+        self.assertEqual(scheduler.steps_left, 2)
+        self.assertEqual(bqp.escalation_summary()['escalations'], 0)
+
+    def test_escalations_recorded_when_step_fails(self):
+        bqp = bqpipeline.BQPipeline(job_name='testjob')
+        record = escalation.EscalationRecord('a.sql', 'b1', 'i1', 10, 5)
+
+        def run_query(path, scheduler=None, **kwargs):
+            scheduler.escalations.append(record)
+            raise ValueError('step failed')
+
+        with mock.patch.object(bqpipeline.BQPipeline, 'run_query',
+                               side_effect=run_query):
+            with self.assertRaises(ValueError):
+                bqp.run_queries(['a.sql'], deadline=3600)
+        self.assertEqual(bqp.escalations, [record])
+
+    def test_run_queries_without_deadline(self):
+        bqp = bqpipeline.BQPipeline(job_name='testjob')
+        with mock.patch.object(bqpipeline.BQPipeline, 'run_query') as run:
+            bqp.run_queries(['a.sql'])
+        self.assertIsNone(run.call_args[1]['scheduler'])
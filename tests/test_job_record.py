@@ -0,0 +1,71 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import unittest
+
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import bigquery
+
+from ox_bqpipeline import bqpipeline
+from ox_bqpipeline.job_record import JobRecord
+
+
+def query_job(job_id='job-1'):
+    client = bigquery.Client(project='p', credentials=AnonymousCredentials())
+    return bigquery.QueryJob.from_api_repr({
+        'jobReference': {'projectId': 'p', 'location': 'EU', 'jobId': job_id},
+        'configuration': {'query': {
+            'query': 'SELECT 1',
+            'destinationTable': {'projectId': 'p', 'datasetId': 'd',
+                                 'tableId': 't'}}},
+        'status': {'state': 'DONE'},
+        'statistics': {'creationTime': '1562000000000',
+                       'startTime': '1562000001000',
+                       'endTime': '1562000009500',
+                       'query': {'totalBytesProcessed': '100',
+                                 'totalBytesBilled': '10485760'}},
+    }, client)
+
+
+class TestJobRecord(unittest.TestCase):
+
+    def test_from_job(self):
+        record = JobRecord.from_job(query_job())
+        self.assertEqual(record.job_id, 'job-1')
+        self.assertEqual(record.location, 'EU')
+        self.assertEqual(record.job_type, 'query')
+        self.assertEqual(record.destination, 'p.d.t')
+        self.assertEqual(record.total_bytes_processed, 100)
+        self.assertEqual(record.total_bytes_billed, 10485760)
+        self.assertEqual(record.duration, 8.5)
+        self.assertTrue(record.done())
+        self.assertIsNone(record.error_result)
+        self.assertFalse(hasattr(record, '__dict__'))
+
+    def test_full_job(self):
+        client = mock.Mock()
+        JobRecord.from_job(query_job()).full_job(client)
+        client.get_job.assert_called_with('job-1', project='p', location='EU')
+
+    def test_run_queries_compact(self):
+        bqp = bqpipeline.BQPipeline(job_name='testjob')
+        bqp.bq = mock.Mock()
+        with mock.patch.object(bqpipeline.BQPipeline, 'run_query',
+                               side_effect=[query_job('a'), query_job('b')]):
+            records = bqp.run_queries(['a.sql', 'b.sql'], compact=True)
+        self.assertEqual([type(r) for r in records], [JobRecord, JobRecord])
+        self.assertEqual([r.job_id for r in records], ['a', 'b'])
+        bqp.get_job(records[1])
+        bqp.bq.get_job.assert_called_with('b', project='p', location='EU')
@@ -0,0 +1,107 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from ox_bqpipeline import bqpipeline
+from ox_bqpipeline import local_export
+
+try:
+    import fastavro
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+@unittest.skipIf(pyarrow is None, 'pyarrow and fastavro are not installed')
+class TestExportToLocal(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.table = pyarrow.table({
+            'a': list(range(1000)),
+            'b': ['row-{}'.format(i) for i in range(1000)],
+            's': [{'x': i * 0.5} for i in range(1000)],
+        })
+        self.service = local_export.LocalReadService(
+            {'p.d.t': self.table}, batch_size=64)
+        self.bqp = bqpipeline.BQPipeline(
+            job_name='testjob', default_project='p', default_dataset='d')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_parquet(self):
+        manifest = self.bqp.export_to_local('t', self.directory, streams=3,
+                                            read_service=self.service)
+        self.assertEqual(manifest['table'], 'p.d.t')
+        self.assertEqual(manifest['total_rows'], 1000)
+        self.assertEqual(len(manifest['files']), 3)
+        with open(os.path.join(self.directory, 'manifest.json')) as f:
+            self.assertEqual(json.load(f), manifest)
+
+        tables = [pyarrow.parquet.read_table(
+            os.path.join(self.directory, f['path']))
+                  for f in manifest['files']]
+        self.assertEqual([t.num_rows for t in tables],
+                         [f['rows'] for f in manifest['files']])
+        self.assertTrue(pyarrow.concat_tables(tables).equals(self.table))
+
+    def test_avro(self):
+        manifest = self.bqp.export_to_local('d.t', self.directory, streams=2,
+                                            file_format='avro',
+                                            compression=None,
+                                            read_service=self.service)
+        self.assertEqual(manifest['format'], 'AVRO')
+        rows = []
+        for entry in manifest['files']:
+            self.assertTrue(entry['path'].endswith('.avro'))
+            with open(os.path.join(self.directory, entry['path']), 'rb') as f:
+                rows.extend(fastavro.reader(f))
+        self.assertEqual(len(rows), 1000)
+        self.assertEqual(rows[999], {'a': 999, 'b': 'row-999',
+                                     's': {'x': 499.5}})
+
+    def test_avro_default_compression(self):
+        manifest = self.bqp.export_to_local('t', self.directory, streams=1,
+                                            file_format='AVRO',
+                                            read_service=self.service)
+        self.assertEqual(manifest['compression'], 'deflate')
+        path = os.path.join(self.directory, manifest['files'][0]['path'])
+        with open(path, 'rb') as f:
+            reader = fastavro.reader(f)
+            self.assertEqual(reader.codec, 'deflate')
+            self.assertEqual(len(list(reader)), 1000)
+
+    def test_parquet_row_groups(self):
+        manifest = local_export.export_to_local(
+            self.service, 'p.d.t', self.directory, streams=1,
+            row_group_size=300)
+        self.assertEqual(manifest['compression'], 'snappy')
+        metadata = pyarrow.parquet.ParquetFile(os.path.join(
+            self.directory, manifest['files'][0]['path'])).metadata
+        # 64 row batches are buffered into full row groups.
+        self.assertEqual([metadata.row_group(i).num_rows
+                          for i in range(metadata.num_row_groups)],
+                         [300, 300, 300, 100])
+
+    def test_invalid_format(self):
+        with self.assertRaises(ValueError):
+            local_export.export_to_local(self.service, 'p.d.t',
+                                         self.directory, file_format='CSV')
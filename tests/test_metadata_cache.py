@@ -0,0 +1,179 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import mock
+import multiprocessing.pool
+import unittest
+
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
+
+from ox_bqpipeline import bqpipeline
+from ox_bqpipeline import metadata_cache
+
+
+MODIFIED = datetime.datetime(2019, 7, 1, tzinfo=datetime.timezone.utc)
+
+
+def metadata_row(table_name, num_rows=10):
+    return {
+        'table_name': table_name,
+        'table_type': 'BASE TABLE',
+        'num_rows': num_rows,
+        'modified': MODIFIED,
+        'num_partitions': 2,
+        'columns': [
+            {'column_name': 'dt', 'data_type': 'DATE',
+             'is_partitioning_column': 'YES',
+             'clustering_ordinal_position': None},
+            {'column_name': 'b', 'data_type': 'STRING',
+             'is_partitioning_column': 'NO',
+             'clustering_ordinal_position': 2},
+            {'column_name': 'a', 'data_type': 'INT64',
+             'is_partitioning_column': 'NO',
+             'clustering_ordinal_position': 1},
+        ],
+    }
+
+
+class TestTableMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.cache = metadata_cache.TableMetadataCache(
+            ttl=10, max_size=2, clock=lambda: self.now)
+
+    def test_ttl(self):
+        self.cache.put(metadata_cache.TableMetadata('p.d.t'))
+        self.assertIn('p.d.t', self.cache)
+        self.now = 11
+        self.assertIsNone(self.cache.get('p.d.t'))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_lru_eviction(self):
+        for name in ('p.d.a', 'p.d.b'):
+            self.cache.put(metadata_cache.TableMetadata(name))
+        self.cache.get('p.d.a')
+        self.cache.put(metadata_cache.TableMetadata('p.d.c'))
+        self.assertIn('p.d.a', self.cache)
+        self.assertNotIn('p.d.b', self.cache)
+        self.assertIn('p.d.c', self.cache)
+
+    def test_missing_and_datasets(self):
+        self.cache.put_missing('p.d.gone')
+        self.assertEqual(self.cache.lookup('p.d.gone'), (True, None))
+        self.assertNotIn('p.d.gone', self.cache)
+        self.cache.invalidate('p.d.gone')
+        self.assertEqual(self.cache.lookup('p.d.gone'), (False, None))
+        self.cache.put_dataset('p.d')
+        self.assertTrue(self.cache.has_dataset('p.d'))
+        self.now = 11
+        self.assertFalse(self.cache.has_dataset('p.d'))
+
+    def test_invalidate_tableref(self):
+        self.cache.put(metadata_cache.TableMetadata('p.d.t'))
+        self.cache.invalidate(bqpipeline.to_tableref('p.d.t'))
+        self.assertNotIn('p.d.t', self.cache)
+
+
+class TestTableMetadata(unittest.TestCase):
+
+    def test_from_row(self):
+        metadata = metadata_cache.TableMetadata.from_row(
+            'p', 'd', metadata_row('t'))
+        self.assertEqual(metadata.table_spec, 'p.d.t')
+        self.assertEqual(metadata.schema, [('dt', 'DATE'), ('b', 'STRING'),
+                                           ('a', 'INT64')])
+        self.assertEqual(metadata.partition_field, 'dt')
+        self.assertEqual(metadata.clustering_fields, ['a', 'b'])
+        self.assertEqual(metadata.num_rows, 10)
+        self.assertEqual(metadata.modified, MODIFIED)
+
+    def test_from_table(self):
+        table = bigquery.Table('p.d.t', schema=[
+            bigquery.SchemaField('a', 'INTEGER'),
+            bigquery.SchemaField('r', 'RECORD', mode='REPEATED', fields=[
+                bigquery.SchemaField('x', 'FLOAT')]),
+        ])
+        table.time_partitioning = bigquery.TimePartitioning()
+        metadata = metadata_cache.TableMetadata.from_table(table)
+        self.assertEqual(metadata.table_spec, 'p.d.t')
+        self.assertEqual(metadata.schema, [
+            ('a', 'INT64'), ('r', 'ARRAY<STRUCT<x FLOAT64>>')])
+        self.assertEqual(metadata.partition_field, '_PARTITIONTIME')
+
+
+class TestPipelineMetadata(unittest.TestCase):
+
+    def setUp(self):
+        self.bqp = bqpipeline.BQPipeline(
+            job_name='testjob', default_project='p', default_dataset='d')
+        self.client = mock.Mock()
+        self.bqp.bq = self.client
+        self.client.query.return_value.result.return_value = [
+            metadata_row('t1'), metadata_row('t2', num_rows=20)]
+
+    def test_prefetch_whole_dataset(self):
+        self.assertEqual(self.bqp.get_table_metadata('t1').num_rows, 10)
+        self.assertEqual(self.bqp.get_table_metadata('d.t2').num_rows, 20)
+        self.assertEqual(self.client.query.call_count, 1)
+        query = self.client.query.call_args[0][0]
+        self.assertIn('`p.d.INFORMATION_SCHEMA.TABLES`', query)
+        self.assertIn('`p.d.INFORMATION_SCHEMA.PARTITIONS`', query)
+        self.client.get_table.assert_not_called()
+
+    def test_fallback_to_get_table(self):
+        self.client.get_table.return_value = bigquery.Table('p.d.view')
+        metadata = self.bqp.get_table_metadata('view')
+        self.assertEqual(metadata.table_spec, 'p.d.view')
+        self.client.get_table.side_effect = NotFound('missing')
+        self.assertIsNone(self.bqp.get_table_metadata('missing'))
+
+    def test_missing_table_is_cached(self):
+        self.client.get_table.side_effect = NotFound('missing')
+        self.assertIsNone(self.bqp.get_table_metadata('missing'))
+        self.assertIsNone(self.bqp.get_table_metadata('missing'))
+        self.assertEqual(self.client.query.call_count, 1)
+        self.assertEqual(self.client.get_table.call_count, 1)
+
+    def test_missing_dataset(self):
+        self.client.query.return_value.result.side_effect = NotFound('d')
+        self.assertIsNone(self.bqp.get_table_metadata('nodataset.t'))
+        self.assertIsNone(self.bqp.get_table_metadata('nodataset.t'))
+        self.assertEqual(self.client.query.call_count, 1)
+
+    def test_concurrent_lookups_prefetch_once(self):
+        pool = multiprocessing.pool.ThreadPool(8)
+        try:
+            results = pool.map(self.bqp.get_table_metadata, ['t1', 't2'] * 8)
+        finally:
+            pool.close()
+        self.assertEqual([m.num_rows for m in results[:2]], [10, 20])
+        self.assertEqual(self.client.query.call_count, 1)
+
+    def test_invalidate_on_write(self):
+        # Tables written after the prefetch are fetched individually.
+        self.client.get_table.side_effect = bigquery.Table
+        self.bqp.get_table_metadata('t1')
+        self.bqp.delete_table('t1')
+        self.assertNotIn('p.d.t1', self.bqp.metadata_cache)
+
+        self.bqp.get_table_metadata('t2')
+        self.bqp.copy_table('t1', 't2')
+        self.assertNotIn('p.d.t2', self.bqp.metadata_cache)
+
+        self.bqp.get_table_metadata('t1')
+        self.bqp.submit_query('SELECT 1', destination='t1')
+        self.assertNotIn('p.d.t1', self.bqp.metadata_cache)
@@ -0,0 +1,128 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import bigquery
+
+from ox_bqpipeline import bqpipeline
+from ox_bqpipeline.plan_history import PlanHistory, PlanRecord
+
+
+def resource(job_id, slot_ms=1000, bytes_processed=1000, compute_ms_max=2000,
+             spilled=0):
+    return {
+        'jobReference': {'projectId': 'p', 'location': 'US', 'jobId': job_id},
+        'configuration': {'query': {'query': 'SELECT 1'}},
+        'status': {'state': 'DONE'},
+        'statistics': {
+            'endTime': '1562000009000',
+            'query': {
+                'totalSlotMs': str(slot_ms),
+                'totalBytesProcessed': str(bytes_processed),
+                'totalBytesBilled': '10485760',
+                'queryPlan': [
+                    {'name': 'S00: Input', 'slotMs': '600',
+                     'computeMsAvg': '1000', 'computeMsMax': '1500',
+                     'computeRatioAvg': 0.5, 'computeRatioMax': 0.75,
+                     'waitRatioAvg': 0.1, 'waitRatioMax': 0.2,
+                     'shuffleOutputBytes': '512'},
+                    {'name': 'S01: Join+', 'slotMs': '400',
+                     'computeMsAvg': '250',
+                     'computeMsMax': str(compute_ms_max),
+                     'shuffleOutputBytes': '2048',
+                     'shuffleOutputBytesSpilled': str(spilled)},
+                ],
+            },
+        },
+    }
+
+
+class TestPlanHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'history.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_from_resource(self):
+        record = PlanRecord.from_resource('a.sql', resource('j1'))
+        self.assertEqual(record.job_id, 'j1')
+        self.assertEqual(record.slot_ms, 1000)
+        self.assertEqual(record.shuffle_bytes, 2560)
+        self.assertEqual(record.stages[0]['wait_ratio_max'], 0.2)
+        self.assertFalse(record.stages[0]['skewed'])
+        self.assertTrue(record.stages[1]['skewed'])
+        self.assertEqual(record.flags,
+                         ['skew: S01: Join+ slowest worker 8.0x average'])
+
+    def test_spill_and_small_skew(self):
+        record = PlanRecord.from_resource(
+            'a.sql', resource('j1', compute_ms_max=900, spilled=4096))
+        self.assertEqual(record.spilled_bytes, 4096)
+        self.assertEqual(record.flags,
+                         ['spill: S01: Join+ spilled 4096 shuffle bytes to '
+                          'disk'])
+
+    def test_regression_against_rolling_baseline(self):
+        history = PlanHistory(self.path, window=3, margin=0.5)
+        for i, slot_ms in enumerate([1000, 5000, 1100, 900]):
+            self.assertEqual(history.record(
+                'a.sql', resource('j%d' % i, slot_ms=slot_ms)).alerts, [])
+        self.assertEqual(history.baseline('a.sql', 'slot_ms'), 1100)
+        record = history.record('a.sql', resource('slow', slot_ms=2000,
+                                                  bytes_processed=1400))
+        self.assertEqual(record.alerts,
+                         ['slot_ms 2000 is 82% above baseline 1100'])
+        self.assertIsNone(history.baseline('b.sql', 'slot_ms'))
+
+    def test_history_persists(self):
+        PlanHistory(self.path).record('a.sql', resource('j1'))
+        history = PlanHistory(self.path)
+        self.assertEqual([r.job_id for r in history.history('a.sql')], ['j1'])
+        self.assertEqual(history.history('a.sql')[0].stages[1]['name'],
+                         'S01: Join+')
+
+    def test_run_query_records_plan(self):
+        client = bigquery.Client(project='p',
+                                 credentials=AnonymousCredentials())
+        job = bigquery.QueryJob.from_api_repr(resource('j1'), client)
+        bqp = bqpipeline.BQPipeline(job_name='testjob', default_project='p',
+                                    default_dataset='d',
+                                    plan_history=self.path)
+        bqp.bq = mock.Mock()
+        bqp.bq.query.return_value = job
+        with mock.patch.object(job, 'result'), \
+                mock.patch.object(bqp, 'refresh_job', return_value=job):
+            bqp.run_query('./tests/sql/select_query3.sql')
+        records = bqp.plan_history.history('./tests/sql/select_query3.sql')
+        self.assertEqual([r.job_id for r in records], ['j1'])
+        expected = PlanRecord.from_resource('./tests/sql/select_query3.sql',
+                                            resource('j1'))
+        self.assertEqual(records[0].slot_ms, 1000)
+        self.assertEqual(records[0].bytes_billed, 10485760)
+        self.assertEqual(records[0].end_time, 1562000009000)
+        self.assertEqual(records[0].stages, expected.stages)
+        self.assertEqual(records[0].flags, expected.flags)
+
+
+if __name__ == '__main__':
+    unittest.main()
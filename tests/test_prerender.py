@@ -0,0 +1,138 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from ox_bqpipeline import bqpipeline
+from ox_bqpipeline.metadata_cache import TableMetadata
+from ox_bqpipeline.prerender import PipelineValidationError, render_all
+
+
+class TestPrerender(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.write('macros.sql', '{% macro cols() %}a, b{% endmacro %}')
+        self.write('stage.sql', "{% import 'macros.sql' as m %}"
+                                'SELECT {{ m.cols() }} FROM `p.d.src` '
+                                "WHERE day = '{{ day }}'")
+        self.write('final.sql', 'SELECT * FROM `p.d.stage` JOIN `p.d.dim`')
+        self.write('broken.sql', 'SELECT {{ missing }} {% if %}')
+        self.write('undefined.sql', 'SELECT {{ missing_var }}')
+        self.bqp = bqpipeline.BQPipeline(job_name='testjob',
+                                         default_project='p',
+                                         default_dataset='d',
+                                         template_dirs=[self.dir])
+        existing = {'p.d.src', 'p.d.dim'}
+        patcher = mock.patch.object(
+            self.bqp, 'get_table_metadata',
+            side_effect=lambda table: TableMetadata(table)
+            if table in existing else None)
+        self.get_table_metadata = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def write(self, name, text):
+        with open(self.path(name), 'w') as sql_file:
+            sql_file.write(text)
+
+    def test_renders_each_template_once(self):
+        steps = [(self.path('stage.sql'), 'stage'),
+                 (self.path('stage.sql'), 'stage_copy'),
+                 (self.path('final.sql'), 'final')]
+        rendered = self.bqp.prerender(steps, day='2019-07-01')
+        self.assertEqual(rendered[self.path('stage.sql')],
+                         "SELECT a, b FROM `p.d.src` WHERE day = '2019-07-01'")
+        self.assertEqual(len(rendered), 2)
+
+    def test_reports_all_problems(self):
+        steps = [self.path('broken.sql'),
+                 self.path('undefined.sql'),
+                 (self.path('final.sql'), 'final'),
+                 (self.path('stage.sql'), 'stage', {'bad': object()})]
+        with self.assertRaises(PipelineValidationError) as raised:
+            self.bqp.prerender(steps, strict=True, day='2019-07-01')
+        errors = raised.exception.errors
+        self.assertEqual([(i, os.path.basename(p)) for i, p, _ in errors],
+                         [(0, 'broken.sql'), (1, 'undefined.sql'),
+                          (2, 'final.sql'), (3, 'stage.sql')])
+        self.assertIn('TemplateSyntaxError', errors[0][2])
+        self.assertIn("'missing_var' is undefined", errors[1][2])
+        self.assertEqual(errors[2][2], 'table `p.d.stage` does not exist')
+        self.assertIn('invalid query parameters', errors[3][2])
+        self.assertIn('4 problem(s)', str(raised.exception))
+
+    def test_uses_pipeline_environment(self):
+        self.write('optional.sql',
+                   "SELECT {{ day | quoted }}{% if extra %}, extra{% endif %}")
+        self.bqp.jinja2.filters['quoted'] = lambda value: "'{}'".format(value)
+        rendered = self.bqp.prerender([self.path('optional.sql')],
+                                      day='2019-07-01')
+        self.assertEqual(rendered[self.path('optional.sql')],
+                         "SELECT '2019-07-01'")
+        with self.assertRaises(PipelineValidationError):
+            self.bqp.prerender([self.path('optional.sql')], strict=True,
+                               day='2019-07-01')
+
+    def test_location_routing_uses_prerendered_sql(self):
+        self.bqp.auto_location = True
+        steps = [self.path('final.sql'), self.path('stage.sql')]
+        with mock.patch.object(self.bqp, 'render_query') as render_query, \
+                mock.patch.object(self.bqp, 'run_query'), \
+                mock.patch.object(self.bqp, 'get_query_location',
+                                  return_value='US') as get_query_location:
+            self.bqp.run_queries(steps, prerender=True, check_tables=False,
+                                 day='2019-07-01')
+        render_query.assert_not_called()
+        get_query_location.assert_any_call(
+            'SELECT * FROM `p.d.stage` JOIN `p.d.dim`')
+
+    def test_process_pool(self):
+        paths = [self.path('stage.sql'), self.path('final.sql')]
+        rendered = render_all(paths, template_dirs=[self.dir], processes=2,
+                              day='2019-07-02')
+        self.assertEqual(rendered[paths[1]],
+                         ('SELECT * FROM `p.d.stage` JOIN `p.d.dim`', None))
+
+    def test_run_queries_fails_before_submitting(self):
+        self.bqp.bq = mock.Mock(project='p')
+        with self.assertRaises(PipelineValidationError):
+            self.bqp.run_queries([(self.path('stage.sql'), 'stage'),
+                                  self.path('undefined.sql')],
+                                 prerender=True, prerender_strict=True,
+                                 day='2019-07-01')
+        self.bqp.bq.query.assert_not_called()
+
+    def test_run_queries_submits_prerendered_sql(self):
+        steps = [(self.path('stage.sql'), 'stage'),
+                 (self.path('final.sql'), 'final')]
+        with mock.patch.object(self.bqp, 'render_query') as render_query, \
+                mock.patch.object(self.bqp, 'run_query') as run_query:
+            self.bqp.run_queries(steps, prerender=True, day='2019-07-01')
+        render_query.assert_not_called()
+        self.assertEqual(run_query.call_args_list[1][1]['query'],
+                         'SELECT * FROM `p.d.stage` JOIN `p.d.dim`')
+
+
+if __name__ == '__main__':
+    unittest.main()
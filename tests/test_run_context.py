@@ -0,0 +1,157 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import mock
+import os
+import signal
+import threading
+import time
+import unittest
+
+from google.api_core.exceptions import BadRequest
+
+from ox_bqpipeline import bqpipeline
+from ox_bqpipeline.run_context import PipelineCancelled
+
+
+class FakeJob():
+    def __init__(self, job_id, state='RUNNING'):
+        self.job_id = job_id
+        self.state = state
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+        self.state = 'DONE'
+        return True
+
+    def result(self, timeout=None):
+        if self.cancelled.wait(timeout if timeout is not None else 5):
+            raise BadRequest('Job execution was cancelled')
+
+
+class TestPipelineRunContext(unittest.TestCase):
+
+    def setUp(self):
+        self.bqp = bqpipeline.BQPipeline(job_name='testjob',
+                                         default_project='p',
+                                         default_dataset='d')
+        self.bqp.bq = mock.Mock(project='p')
+        ids = itertools.count()
+        self.bqp.bq.query.side_effect = \
+            lambda *args, **kwargs: FakeJob('job-{}'.format(next(ids)))
+
+    def submit(self, count):
+        return [self.bqp.submit_query('SELECT 1') for _ in range(count)]
+
+    def test_success_leaves_jobs_running(self):
+        with self.bqp.run_context() as run:
+            jobs = self.submit(2)
+        self.assertFalse(any(job.cancelled.is_set() for job in jobs))
+        self.assertIsNone(run.summary['reason'])
+        self.assertEqual(run.summary['submitted_jobs'], 2)
+        self.assertIsNone(self.bqp.active_run)
+
+    def test_done_jobs_are_pruned(self):
+        with self.bqp.run_context() as run:
+            jobs = self.submit(2)
+            jobs[0].state = 'DONE'
+            self.submit(1)
+            self.assertEqual([job.job_id for job in run.jobs],
+                             ['job-1', 'job-2'])
+        self.assertEqual(run.summary['submitted_jobs'], 3)
+
+    def test_error_cancels_outstanding_jobs(self):
+        with self.assertRaises(ValueError):
+            with self.bqp.run_context() as run:
+                jobs = self.submit(3)
+                jobs[0].state = 'DONE'
+                raise ValueError('step failed')
+        self.assertFalse(jobs[0].cancelled.is_set())
+        self.assertTrue(jobs[1].cancelled.is_set())
+        self.assertEqual(run.summary['cancelled_jobs'], ['job-1', 'job-2'])
+        self.assertIn('ValueError', run.summary['reason'])
+
+    def test_deadline(self):
+        with self.assertRaises(PipelineCancelled) as raised:
+            with self.bqp.run_context(deadline=0.05):
+                self.submit(1)[0].result()
+        self.assertEqual(raised.exception.reason, 'deadline')
+        self.assertEqual(raised.exception.summary['cancelled_jobs'],
+                         ['job-0'])
+        with self.assertRaises(PipelineCancelled):
+            with self.bqp.run_context(deadline=0.01) as run:
+                time.sleep(0.1)
+                self.submit(1)
+        self.assertEqual(len(run.jobs), 1)
+        self.assertTrue(run.jobs[0].cancelled.is_set())
+
+    def test_sigterm(self):
+        previous = signal.getsignal(signal.SIGTERM)
+        with self.assertRaises(PipelineCancelled) as raised:
+            with self.bqp.run_context():
+                jobs = self.submit(2)
+                os.kill(os.getpid(), signal.SIGTERM)
+                time.sleep(1)
+        self.assertEqual(raised.exception.reason, 'SIGTERM')
+        self.assertTrue(all(job.cancelled.is_set() for job in jobs))
+        self.assertEqual(signal.getsignal(signal.SIGTERM), previous)
+
+    def test_deadline_after_block_completes(self):
+        with self.assertRaises(PipelineCancelled) as raised:
+            with self.bqp.run_context(deadline=0.01) as run:
+                jobs = self.submit(1)
+                run._timer.join()
+        self.assertEqual(raised.exception.reason, 'deadline')
+        self.assertTrue(jobs[0].cancelled.is_set())
+
+    def test_second_signal_during_cancel(self):
+        received = []
+        previous = signal.signal(signal.SIGTERM,
+                                 lambda signum, frame: received.append(signum))
+        self.addCleanup(signal.signal, signal.SIGTERM, previous)
+
+        cancel = FakeJob.cancel
+
+        def cancel_and_signal(job):
+            os.kill(os.getpid(), signal.SIGTERM)
+            return cancel(job)
+
+        with mock.patch.object(FakeJob, 'cancel', autospec=True,
+                               side_effect=cancel_and_signal):
+            with self.assertRaises(PipelineCancelled) as raised:
+                with self.bqp.run_context():
+                    jobs = self.submit(1)
+                    os.kill(os.getpid(), signal.SIGTERM)
+                    time.sleep(1)
+        # The second signal reached the previous handler instead of
+        # re-entering the cancellation.
+        self.assertEqual(received, [signal.SIGTERM])
+        self.assertEqual(raised.exception.summary['cancelled_jobs'],
+                         ['job-0'])
+        self.assertTrue(jobs[0].cancelled.is_set())
+
+    def test_drops_intermediate_tables(self):
+        with self.assertRaises(ValueError):
+            with self.bqp.run_context() as run:
+                self.bqp.mark_intermediate('tmp')
+                raise ValueError('step failed')
+        self.bqp.bq.delete_table.assert_called_once_with('p.d.tmp',
+                                                         not_found_ok=True)
+        self.assertEqual(run.summary['dropped_tables'], ['p.d.tmp'])
+
+
+if __name__ == '__main__':
+    unittest.main()
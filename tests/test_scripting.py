@@ -0,0 +1,185 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import mock
+import unittest
+
+from google.api_core.exceptions import BadRequest
+from google.cloud import bigquery
+
+from ox_bqpipeline import bqpipeline
+from ox_bqpipeline import scripting
+from ox_bqpipeline.metadata_cache import TableMetadata, table_spec_str
+
+
+def child_job(line, created, error_result=None):
+    child = mock.Mock()
+    child.script_statistics.stack_frames = [mock.Mock(start_line=line)]
+    child.created = datetime.datetime(2019, 7, 1, 0, 0, created)
+    child.error_result = error_result
+    return child
+
+
+class TestBuildStatement(unittest.TestCase):
+
+    def setUp(self):
+        self.bqp = bqpipeline.BQPipeline(
+            job_name='testjob', default_project='p', default_dataset='d')
+
+    def statement(self, columns=None, **kwargs):
+        return scripting.build_statement(
+            'SELECT 1;\n', self.bqp.create_job_config(dest='t', **kwargs),
+            columns)
+
+    def test_no_destination(self):
+        self.assertEqual(scripting.build_statement(
+            'CREATE TEMP TABLE x AS SELECT 1;', self.bqp.create_job_config()),
+            'CREATE TEMP TABLE x AS SELECT 1')
+
+    def test_truncate(self):
+        self.assertEqual(self.statement(columns=['a', 'b']), (
+            "IF EXISTS (SELECT 1 FROM `p.d.INFORMATION_SCHEMA.TABLES` "
+            "WHERE table_name = 't') THEN\n"
+            'BEGIN TRANSACTION;\n'
+            'TRUNCATE TABLE `p.d.t`;\n'
+            'INSERT INTO `p.d.t` (`a`, `b`)\nSELECT 1\n;\n'
+            'COMMIT TRANSACTION;\n'
+            'ELSE\n'
+            'CREATE TABLE `p.d.t` AS\nSELECT 1\n;\n'
+            'END IF'))
+        self.assertNotIn('CREATE OR REPLACE', self.statement())
+        self.assertEqual(self.statement(create=False),
+                         'BEGIN TRANSACTION;\nTRUNCATE TABLE `p.d.t`;\n'
+                         'INSERT INTO `p.d.t`\nSELECT 1\n;\n'
+                         'COMMIT TRANSACTION')
+
+    def test_append(self):
+        self.assertEqual(self.statement(create=False, overwrite=False,
+                                        append=True),
+                         'INSERT INTO `p.d.t`\nSELECT 1')
+        self.assertEqual(self.statement(columns=['a'], create=False,
+                                        overwrite=False, append=True),
+                         'INSERT INTO `p.d.t` (`a`)\nSELECT 1')
+        statement = self.statement(overwrite=False, append=True)
+        self.assertEqual(statement, (
+            "IF EXISTS (SELECT 1 FROM `p.d.INFORMATION_SCHEMA.TABLES` "
+            "WHERE table_name = 't') THEN\n"
+            'INSERT INTO `p.d.t`\nSELECT 1\n;\n'
+            'ELSE\n'
+            'CREATE TABLE `p.d.t` AS\nSELECT 1\n;\n'
+            'END IF'))
+        self.assertNotIn('LIMIT 0', statement)
+
+    def test_write_empty(self):
+        statement = self.statement(create=False, overwrite=False)
+        self.assertTrue(statement.startswith(
+            'ASSERT NOT EXISTS (SELECT 1 FROM `p.d.t`)'))
+        statement = self.statement(overwrite=False)
+        self.assertIn("INFORMATION_SCHEMA.TABLES` WHERE table_name = 't'",
+                      statement)
+        self.assertIn('CREATE TABLE `p.d.t` AS', statement)
+
+    def test_trailing_comment(self):
+        job_config = self.bqp.create_job_config(dest='t', overwrite=False)
+        statement = scripting.build_statement('SELECT 1 -- note', job_config)
+        for line in statement.split('\n'):
+            if '-- note' in line:
+                self.assertEqual(line, 'SELECT 1 -- note')
+
+    def test_assemble_script(self):
+        steps = [scripting.ScriptStep(0, 'a.sql', 'SELECT 1 -- comment'),
+                 scripting.ScriptStep(1, 'b.sql', 'TRUNCATE TABLE t;\n'
+                                      'INSERT INTO t\nSELECT 1')]
+        script = scripting.assemble_script(steps)
+        self.assertEqual(script.split('\n')[1], ';')
+        self.assertEqual((steps[0].first_line, steps[0].last_line), (1, 2))
+        self.assertEqual((steps[1].first_line, steps[1].last_line), (3, 6))
+        self.assertIs(scripting.step_at_line(steps, 4), steps[1])
+        self.assertIsNone(scripting.step_at_line(steps, 7))
+
+
+class TestScriptBatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.bqp = bqpipeline.BQPipeline(
+            job_name='testjob', default_project='p', default_dataset='d')
+        self.client = mock.Mock()
+        self.bqp.bq = self.client
+        self.metadata = {'p.d.t2': TableMetadata(
+            'p.d.t2', schema=[('id', 'INT64'), ('name', 'STRING')])}
+        patcher = mock.patch.object(
+            self.bqp, 'get_table_metadata',
+            side_effect=lambda table: self.metadata.get(table_spec_str(table)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.steps = [('./tests/sql/select_query1.sql', 't1', {'a': 1}),
+                      ('./tests/sql/select_query3.sql', 't2'),
+                      ('./tests/sql/select_query3.sql', 'gs://bucket/path'),
+                      ('./tests/sql/select_query1.sql', 't3', {'a': 2})]
+
+    def test_plan(self):
+        batcher = scripting.ScriptBatcher(self.bqp)
+        groups = batcher.plan(self.steps)
+        self.assertEqual([len(g) if isinstance(g, list) else g
+                          for g in groups], [2, self.steps[2], 1])
+        self.assertEqual(groups[0][1].destination.table_id, 't2')
+        self.assertIn('INSERT INTO `p.d.t2` (`id`, `name`)',
+                      groups[0][1].statement)
+        self.assertIn('INSERT INTO `p.d.t1`\n', groups[0][0].statement)
+
+    def test_plan_splits_conflicting_params(self):
+        batcher = scripting.ScriptBatcher(self.bqp)
+        groups = batcher.plan([self.steps[0], self.steps[3]])
+        self.assertEqual([len(g) for g in groups], [1, 1])
+
+    def test_run_maps_child_jobs_to_steps(self):
+        batcher = scripting.ScriptBatcher(self.bqp)
+        steps = batcher.plan(self.steps[:2])[0]
+        scripting.assemble_script(steps)
+        script_job = self.client.query.return_value
+        # Child jobs are listed newest first.
+        self.client.list_jobs.return_value = [
+            child_job(steps[1].first_line, 2), child_job(1, 1)]
+        jobs = batcher.run_script(steps)
+        self.assertEqual([j.created.second for j in jobs], [1, 2])
+
+        script, = self.client.query.call_args[0]
+        job_config = self.client.query.call_args[1]['job_config']
+        self.assertIn('CREATE TABLE `p.d.t1` AS', script)
+        self.assertIsNone(job_config.destination)
+        self.assertEqual(job_config.priority, bigquery.QueryPriority.BATCH)
+        self.assertEqual(job_config.query_parameters,
+                         [bigquery.ScalarQueryParameter('a', 'INT64', 1)])
+        self.client.list_jobs.assert_called_with(parent_job=script_job.job_id)
+
+    def test_failure_maps_to_step(self):
+        batcher = scripting.ScriptBatcher(self.bqp)
+        steps = batcher.plan(self.steps[:2])[0]
+        scripting.assemble_script(steps)
+        self.client.query.return_value.result.side_effect = BadRequest(
+            'Query error: Table not found at [{}:3]'.format(
+                steps[1].first_line + 1))
+        self.client.list_jobs.return_value = []
+        with self.assertRaises(scripting.ScriptStepError) as ctx:
+            batcher.run_script(steps)
+        self.assertIs(ctx.exception.step, steps[1])
+        self.assertIn('select_query3.sql', str(ctx.exception))
+
+    def test_run_queries_script(self):
+        with mock.patch.object(scripting.ScriptBatcher, 'run') as run:
+            self.bqp.run_queries(self.steps, script=True, project='p')
+        run.assert_called_with(self.steps, project='p')
+        with self.assertRaises(ValueError):
+            self.bqp.run_queries(self.steps, script=True, deadline=60)
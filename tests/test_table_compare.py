@@ -0,0 +1,122 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import unittest
+
+from google.api_core.exceptions import NotFound
+
+from ox_bqpipeline import bqpipeline
+from ox_bqpipeline.metadata_cache import TableMetadata
+from ox_bqpipeline.table_compare import TableComparison, build_compare_sql, \
+    common_columns, partition_expression
+
+SCHEMA = [('day', 'DATE'), ('id', 'INT64'), ('name', 'STRING')]
+
+
+def metadata(table_spec, schema=SCHEMA, partition_field='day'):
+    return TableMetadata(table_spec, schema=schema,
+                         partition_field=partition_field)
+
+
+def row(side, part, row_count=10, c0=1, c1=2, c2=3, fp=4):
+    return {'side': side, 'part': part, 'row_count': row_count, '_row': fp,
+            'c0': c0, 'c1': c1, 'c2': c2}
+
+
+class TestTableCompare(unittest.TestCase):
+
+    def test_partition_expression(self):
+        self.assertEqual(partition_expression(metadata('p.d.a')), '`day`')
+        self.assertEqual(partition_expression(metadata(
+            'p.d.a', schema=[('ts', 'TIMESTAMP')], partition_field='ts')),
+            'DATE(`ts`)')
+        self.assertEqual(partition_expression(metadata(
+            'p.d.a', partition_field='_PARTITIONTIME')),
+            'DATE(_PARTITIONTIME)')
+        self.assertIsNone(partition_expression(metadata(
+            'p.d.a', partition_field=None)))
+
+    def test_common_columns(self):
+        columns, mismatched = common_columns(
+            metadata('p.d.a'),
+            metadata('p.d.b', schema=[('day', 'DATE'), ('id', 'STRING'),
+                                      ('extra', 'BOOL')]))
+        self.assertEqual(columns, ['day'])
+        self.assertEqual(dict(mismatched), {'id': ('INT64', 'STRING'),
+                                            'name': ('STRING', None),
+                                            'extra': (None, 'BOOL')})
+
+    def test_build_compare_sql(self):
+        sql = build_compare_sql(metadata('p.d.a'), metadata('p.d.b'),
+                                ['id', 'name'])
+        self.assertEqual(sql.count('FROM `p.d.a` AS t'), 1)
+        self.assertEqual(sql.count('FROM `p.d.b` AS t'), 1)
+        self.assertIn('CAST(`day` AS STRING) AS part', sql)
+        self.assertIn('SUM(CAST(FARM_FINGERPRINT(TO_JSON_STRING(t.`name`)) '
+                      'AS BIGNUMERIC)) AS c1', sql)
+        self.assertIn('TO_JSON_STRING(STRUCT(t.`id`, t.`name`))', sql)
+        unpartitioned = build_compare_sql(
+            metadata('p.d.a'), metadata('p.d.b', partition_field=None),
+            ['id'])
+        self.assertIn('CAST(NULL AS STRING) AS part', unpartitioned)
+
+    def test_comparison_reports_differences(self):
+        comparison = TableComparison('p.d.a', 'p.d.b', ['day', 'id', 'name'],
+                                     {}, [
+            row('a', '2019-07-01'), row('b', '2019-07-01'),
+            row('a', '2019-07-02'), row('b', '2019-07-02', c2=9),
+            row('a', '2019-07-03'), row('b', '2019-07-03', fp=5),
+            row('a', '2019-07-04')])
+        self.assertFalse(comparison.equal)
+        self.assertEqual(comparison.row_counts, (40, 30))
+        self.assertEqual(dict(comparison.partitions), {
+            '2019-07-02': ['name'],
+            '2019-07-03': ['_row'],
+            '2019-07-04': ['missing in p.d.b']})
+        self.assertEqual(dict(comparison.columns_differing),
+                         {'name': ['2019-07-02']})
+        self.assertIn('partition 2019-07-02: name', comparison.summary())
+
+    def test_equal(self):
+        comparison = TableComparison('p.d.a', 'p.d.b', ['day', 'id', 'name'],
+                                     {}, [row('a', None), row('b', None)])
+        self.assertTrue(comparison)
+        self.assertEqual(comparison.summary(),
+                         '`p.d.a` and `p.d.b` match (10 rows)')
+
+    def test_compare_table_pairs(self):
+        bqp = bqpipeline.BQPipeline(job_name='testjob', default_project='p',
+                                    default_dataset='d')
+        bqp.bq = mock.Mock(project='p')
+        bqp.bq.query.return_value.result.return_value = [
+            row('a', None), row('b', None, row_count=11)]
+        with mock.patch.object(bqp, 'get_table_metadata',
+                               side_effect=lambda t: metadata('p.d.' + t)):
+            results = bqp.compare_table_pairs([('a', 'b'), ('c', 'd')])
+        self.assertEqual([(r.a, r.b, r.equal) for r in results],
+                         [('p.d.a', 'p.d.b', False),
+                          ('p.d.c', 'p.d.d', False)])
+        self.assertEqual(bqp.bq.query.call_count, 2)
+
+    def test_missing_table(self):
+        bqp = bqpipeline.BQPipeline(job_name='testjob', default_project='p',
+                                    default_dataset='d')
+        with mock.patch.object(bqp, 'get_table_metadata', return_value=None):
+            with self.assertRaises(NotFound):
+                bqp.compare_tables('a', 'b')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,199 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import decimal
+import mock
+import threading
+import time
+import unittest
+
+import pyarrow
+from google.api_core.exceptions import BadRequest, Conflict, \
+    ServiceUnavailable
+
+from ox_bqpipeline import bqpipeline
+from ox_bqpipeline.table_writer import BigQueryBackend, EXACTLY_ONCE, \
+    FakeBackend, LoadJobFailed, TableWriter, split_by_bytes
+
+
+def rows(count, start=0):
+    return [{'id': i, 'name': 'row-%d' % i} for i in range(start, start + count)]
+
+
+class TestTableWriter(unittest.TestCase):
+
+    def test_split_by_bytes(self):
+        self.assertEqual(split_by_bytes(['aaaa', 'bb', 'cccccccc', 'd'], 8),
+                         [(0, 2), (2, 3), (3, 4)])
+
+    def test_batches_by_size(self):
+        backend = FakeBackend()
+        with TableWriter(backend, 'p.d.t', batch_size=10) as writer:
+            for row in rows(25):
+                writer.write(row)
+        self.assertEqual(backend.rows, rows(25))
+        self.assertEqual(backend.calls, 3)
+        self.assertEqual(writer.rows_written, 25)
+
+    def test_batches_by_bytes(self):
+        backend = FakeBackend()
+        with TableWriter(backend, 'p.d.t', batch_size=100,
+                         batch_bytes=100) as writer:
+            writer.write(rows(10))
+        self.assertEqual(backend.row_count, 10)
+        self.assertGreater(backend.calls, 1)
+
+    def test_flushes_by_time(self):
+        backend = FakeBackend()
+        writer = TableWriter(backend, 'p.d.t', batch_size=1000,
+                             flush_interval=0.01)
+        with writer:
+            writer.write(rows(3))
+            for _ in range(200):
+                if backend.row_count:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(backend.row_count, 3)
+
+    def test_record_batches_and_types(self):
+        backend = FakeBackend()
+        batch = pyarrow.RecordBatch.from_pydict({'id': [1, 2]})
+        with TableWriter(backend, 'p.d.t') as writer:
+            writer.write(batch)
+            writer.write({'day': datetime.date(2019, 7, 1),
+                          'amount': decimal.Decimal('1.50'), 'raw': b'\x00'})
+        self.assertEqual(backend.rows, [
+            {'id': 1}, {'id': 2},
+            {'day': '2019-07-01', 'amount': '1.50', 'raw': 'AA=='}])
+
+    def test_backpressure(self):
+        release = threading.Event()
+        backend = FakeBackend(latency=1, sleep=lambda _: release.wait())
+        writer = TableWriter(backend, 'p.d.t', batch_size=1, max_in_flight=1)
+        writer.open()
+        producer = threading.Thread(target=writer.write, args=(rows(5),))
+        producer.start()
+        producer.join(0.2)
+        # One batch sending, one queued, one waiting to be put.
+        self.assertTrue(producer.is_alive())
+        release.set()
+        producer.join()
+        writer.close()
+        self.assertEqual(backend.row_count, 5)
+
+    def test_worker_error_raised_to_producer(self):
+        backend = mock.Mock()
+        backend.insert.side_effect = RuntimeError('rejected')
+        writer = TableWriter(backend, 'p.d.t', batch_size=1, max_retries=2,
+                             sleep=lambda _: None)
+        with self.assertRaises(RuntimeError):
+            with writer:
+                for row in rows(100):
+                    writer.write(row)
+        self.assertEqual(backend.insert.call_count, 2)
+
+    def test_at_least_once_row_ids(self):
+        backend = mock.Mock()
+        with TableWriter(backend, 'p.d.t', run_id='r', batch_size=2) as writer:
+            writer.write(rows(3))
+        backend.insert.assert_any_call('p.d.t', rows(1, 2), ['r-1-0'])
+
+    def test_exactly_once_rerun_does_not_duplicate(self):
+        backend = FakeBackend()
+        for _ in range(2):
+            with TableWriter(backend, 'p.d.t', mode=EXACTLY_ONCE, run_id='r',
+                             batch_size=10) as writer:
+                writer.write(rows(25))
+        self.assertEqual(backend.rows, rows(25))
+        self.assertEqual(sorted(backend.job_ids)[0], 'p_d_t_r_00000000_0000')
+
+    def test_consumes_iterables_lazily(self):
+        backend = FakeBackend()
+        writer = TableWriter(backend, 'p.d.t', batch_size=10)
+        batches_seen = []
+
+        def generate():
+            for row in rows(25):
+                batches_seen.append(writer.batches)
+                yield row
+
+        with writer:
+            writer.write(generate())
+        # The first batch was handed over before row 11 was produced.
+        self.assertEqual(batches_seen[10], 1)
+        self.assertEqual(backend.rows, rows(25))
+
+    def test_exactly_once_default_batches_are_large(self):
+        writer = TableWriter(FakeBackend(), 'p.d.t', mode=EXACTLY_ONCE)
+        self.assertEqual(writer.batch_size, 100000)
+        self.assertEqual(TableWriter(FakeBackend(), 'p.d.t').batch_size, 500)
+
+    def test_table_reference(self):
+        backend = FakeBackend()
+        table = bqpipeline.to_tableref('p.d.t')
+        with TableWriter(backend, table, mode=EXACTLY_ONCE,
+                         run_id='r') as writer:
+            writer.write(rows(2))
+            self.assertEqual(writer.worker.name, 'TableWriter-p.d.t')
+        self.assertEqual(backend.job_ids, {'p_d_t_r_00000000_0000'})
+
+    def test_exactly_once_retries(self):
+        client = mock.Mock()
+        failed = mock.Mock(state='DONE', error_result={'reason': 'invalid'})
+        failed.result.side_effect = BadRequest('invalid')
+        loaded = mock.Mock()
+        # Transport error before the job exists, then a job that fails.
+        client.load_table_from_file.side_effect = [
+            ServiceUnavailable('unavailable'), failed, loaded]
+        with TableWriter(BigQueryBackend(client), 'p.d.t', mode=EXACTLY_ONCE,
+                         run_id='r', sleep=lambda _: None) as writer:
+            writer.write(rows(2))
+        self.assertEqual(
+            [c[1]['job_id'] for c in client.load_table_from_file.call_args_list],
+            ['p_d_t_r_00000000_0000', 'p_d_t_r_00000000_0000',
+             'p_d_t_r_00000000_0000_1'])
+
+    def test_exactly_once_gives_up_on_failed_jobs(self):
+        client = mock.Mock()
+        failed = mock.Mock(state='DONE', error_result={'reason': 'invalid'})
+        failed.result.side_effect = BadRequest('invalid')
+        client.load_table_from_file.return_value = failed
+        with self.assertRaises(LoadJobFailed):
+            with TableWriter(BigQueryBackend(client), 'p.d.t',
+                             mode=EXACTLY_ONCE, max_retries=2,
+                             sleep=lambda _: None) as writer:
+                writer.write(rows(2))
+        self.assertEqual(client.load_table_from_file.call_count, 2)
+
+    def test_bigquery_backend_reuses_existing_job(self):
+        client = mock.Mock()
+        client.load_table_from_file.side_effect = Conflict('already exists')
+        BigQueryBackend(client, 'EU').load('p.d.t', b'{}\n', 'job-1')
+        client.get_job.assert_called_with('job-1', location='EU')
+        client.get_job.return_value.result.assert_called_with()
+
+    def test_pipeline_table_writer(self):
+        bqp = bqpipeline.BQPipeline(job_name='testjob', default_project='p',
+                                    default_dataset='d')
+        backend = FakeBackend()
+        with mock.patch.object(bqp.metadata_cache, 'invalidate') as invalidate:
+            with bqp.table_writer('t', backend=backend) as writer:
+                writer.write(rows(2))
+        self.assertEqual(writer.table, 'p.d.t')
+        invalidate.assert_called_with('p.d.t')
+
+
+if __name__ == '__main__':
+    unittest.main()
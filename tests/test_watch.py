@@ -0,0 +1,136 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from ox_bqpipeline import bqpipeline
+from ox_bqpipeline.run_context import PipelineCancelled
+from ox_bqpipeline.watch import PipelineWatcher, reads_table
+
+
+class TestPipelineWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.write('common.sql', 'SELECT 1 AS x')
+        self.write('a.sql', "{% include 'common.sql' %}")
+        self.write('b.sql', 'SELECT * FROM `p.d.a`')
+        self.write('c.sql', 'SELECT 2')
+        self.write('d.sql', 'SELECT * FROM d.b')
+        self.bqp = bqpipeline.BQPipeline(job_name='testjob',
+                                         default_project='p',
+                                         default_dataset='d',
+                                         template_dirs=[self.dir])
+        self.steps = [(self.path(name), name[0]) for name in
+                      ('a.sql', 'b.sql', 'c.sql', 'd.sql')]
+        self.watcher = PipelineWatcher(self.bqp, self.steps, self.dir,
+                                       sleep=lambda _: None)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def write(self, name, text):
+        with open(self.path(name), 'w') as sql_file:
+            sql_file.write(text)
+
+    def changed(self, *names):
+        return set(os.path.abspath(self.path(name)) for name in names)
+
+    def test_reads_table(self):
+        self.assertTrue(reads_table('SELECT * FROM `p.d.t`', 'p.d.t'))
+        self.assertTrue(reads_table('SELECT * FROM p.d.t', 'p.d.t'))
+        self.assertTrue(reads_table('SELECT * FROM d.t JOIN x', 'p.d.t'))
+        self.assertFalse(reads_table('SELECT * FROM d.t2', 'p.d.t'))
+        self.assertFalse(reads_table('SELECT * FROM q.d.t', 'p.d.t'))
+
+    def test_reads_partial_table_spec(self):
+        self.assertTrue(reads_table('SELECT * FROM `p.d.t`', 'd.t'))
+        self.assertTrue(reads_table('SELECT * FROM d.t', 'd.t'))
+        self.assertFalse(reads_table('SELECT * FROM e.t', 'd.t'))
+        self.assertTrue(reads_table('SELECT * FROM t', 't'))
+        self.assertTrue(reads_table('SELECT * FROM `p.e.t`', 't'))
+        self.assertFalse(reads_table('SELECT * FROM t2', 't'))
+
+    def test_include_renders(self):
+        self.assertEqual(self.bqp.render_query(self.path('a.sql')),
+                         'SELECT 1 AS x')
+
+    def test_dependencies_include_templates(self):
+        self.assertEqual(self.watcher.dependencies(self.path('a.sql')),
+                         self.changed('a.sql', 'common.sql'))
+
+    def test_dirty_steps_follow_include_and_downstream(self):
+        self.assertEqual(self.watcher.dirty_steps(self.changed('common.sql')),
+                         [0, 1, 3])
+        self.assertEqual(self.watcher.dirty_steps(self.changed('c.sql')), [2])
+        self.assertEqual(self.watcher.dirty_steps(self.changed('b.sql')),
+                         [1, 3])
+        self.assertEqual(self.watcher.dirty_steps(self.changed('other.txt')),
+                         [])
+
+    def test_dirty_steps_without_default_project(self):
+        self.bqp.default_project = None
+        self.watcher.steps = [(self.path('a.sql'), 'd.a'),
+                              (self.path('b.sql'), 'd.b'),
+                              (self.path('d.sql'), 'd.d')]
+        self.assertEqual(self.watcher.dirty_steps(self.changed('a.sql')),
+                         [0, 1, 2])
+
+    def test_poll_reruns_changed_steps(self):
+        self.watcher.mtimes = {path: 0 for path in
+                               self.changed('common.sql', 'a.sql', 'b.sql',
+                                            'c.sql', 'd.sql')}
+        self.watcher.mtimes[os.path.abspath(self.path('c.sql'))] = \
+            os.stat(self.path('c.sql')).st_mtime
+        with mock.patch.object(self.bqp, 'run_query') as run_query:
+            # Everything but c.sql looks modified.
+            self.assertEqual(self.watcher.poll(), [0, 1, 3])
+            self.assertEqual(run_query.call_count, 3)
+            run_query.reset_mock()
+            self.assertEqual(self.watcher.poll(), [])
+            run_query.assert_not_called()
+
+    def test_watch_survives_failures(self):
+        with mock.patch.object(self.bqp, 'run_query') as run_query, \
+                mock.patch.object(self.watcher, 'poll',
+                                  side_effect=ValueError('bad sql')) as poll:
+            self.watcher.watch(iterations=2)
+        self.assertEqual(run_query.call_count, len(self.steps))
+        self.assertEqual(poll.call_count, 2)
+
+    def test_watch_survives_failed_initial_run(self):
+        with mock.patch.object(self.bqp, 'run_query',
+                               side_effect=ValueError('bad sql')), \
+                mock.patch.object(self.watcher, 'poll') as poll:
+            self.watcher.watch(iterations=2)
+        self.assertEqual(poll.call_count, 2)
+
+    def test_watch_stops_on_cancel(self):
+        with mock.patch.object(self.bqp, 'run_query',
+                               side_effect=PipelineCancelled('stop')), \
+                mock.patch.object(self.watcher, 'poll') as poll:
+            with self.assertRaises(PipelineCancelled):
+                self.watcher.watch(iterations=2)
+        poll.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()